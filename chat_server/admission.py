@@ -0,0 +1,92 @@
+'''
+새 접속의 수락 여부를 정하는 token bucket.
+
+서버를 다시 시작하면 접속해 있던 클라이언트들이 한꺼번에 다시 접속한다. 이를 모두 바로 받으면
+hello 와 입장 처리가 몰려서 기존 연결들의 메시지가 밀린다.
+
+  - 서버 전체 bucket: 초당 rate 개씩 token 이 채워지고 burst 개까지 모인다. token 이 없으면
+    select engine 은 accept 를 잠시 멈추고 남은 접속은 커널의 accept 큐(--listen_backlog)에서 기다린다.
+  - IP 별 bucket: 한 IP 가 빠르게 접속을 되풀이하면 그 접속은 받자마자 닫는다.
+
+main 쓰레드(asyncio 면 event loop)에서만 사용하므로 lock 이 없다.
+'''
+
+
+# 다 채워진 IP 별 bucket 을 정리하는 간격(초). 새로 만든 bucket 과 같으므로 지워도 된다.
+PRUNE_INTERVAL = 10.0
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now: float) -> bool:
+        '''token 하나를 쓴다. 없으면 False'''
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self, now: float) -> float:
+        '''다음 token 이 생길 때까지 남은 시간. 지금 쓸 수 있으면 0'''
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionControl:
+    '''
+    rate 나 per_ip_rate 가 0 이면 그 제한은 쓰지 않는다. burst 는 1 보다 작을 수 없다.
+    '''
+    def __init__(self, rate: float, burst: float, per_ip_rate: float, per_ip_burst: float, now: float):
+        self.bucket = TokenBucket(rate, max(burst, 1), now) if rate > 0 else None
+        self.per_ip_rate = per_ip_rate
+        self.per_ip_burst = max(per_ip_burst, 1)
+        self.ip_buckets: dict[str, TokenBucket] = {}
+        self.next_prune = now + PRUNE_INTERVAL
+
+    def wait_time(self, now: float) -> float:
+        '''서버 전체 token 이 다시 생길 때까지 남은 시간. 지금 받을 수 있으면 0'''
+        if self.bucket is None:
+            return 0
+        return self.bucket.wait_time(now)
+
+    def admit(self, ip: str, now: float) -> str | None:
+        '''
+        ip 에서 온 접속을 받을 수 있으면 token 을 쓰고 None 을, 아니면 거절 이유를 반환한다.
+        두 bucket 에 모두 token 이 있을 때만 쓰므로, 거절된 접속은 어느 bucket 의 token 도 쓰지 않는다.
+        '''
+        bucket = None
+        if self.per_ip_rate > 0:
+            if now >= self.next_prune:
+                self.prune(now)
+            bucket = self.ip_buckets.get(ip)
+            if bucket is None:
+                bucket = self.ip_buckets[ip] = TokenBucket(self.per_ip_rate, self.per_ip_burst, now)
+            if bucket.wait_time(now):
+                return 'per_ip'
+
+        if self.bucket is not None and not self.bucket.take(now):
+            return 'rate'
+        if bucket is not None:
+            bucket.take(now)
+        return None
+
+    def prune(self, now: float):
+        for ip, bucket in list(self.ip_buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.ip_buckets[ip]
+        self.next_prune = now + PRUNE_INTERVAL
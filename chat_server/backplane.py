@@ -0,0 +1,702 @@
+'''
+여러 chat 서버(node)가 대화방을 공유하기 위한 backplane.
+
+Backplane 은 방 번호 발급, 방 목록과 멤버 이름, 그리고 다른 node 에 있는 방 멤버들에게
+메시지를 전달하는 일을 맡는다. 서버는 자기 node 에 접속한 멤버들에게만 직접 보내고,
+나머지는 publish() 로 넘긴다.
+
+  - LoopbackBackplane: 한 프로세스 안에서만 동작한다. 기본값이며, 같은 LoopbackHub 를
+    공유하는 여러 backplane 을 만들면 여러 node 를 한 프로세스에서 흉내 낼 수 있다.
+  - roombus.RoomBusClient: --processes 로 fork 된 서버 프로세스들이 부모의 hub 를 공유한다.
+  - RedisBackplane: Redis 서버를 공유하는 여러 호스트의 node 들. 방 정보는 Redis 에 두고
+    메시지는 Redis pub/sub 으로 전달한다.
+'''
+import bisect
+import collections
+import concurrent.futures
+import itertools
+import os
+import socket
+import threading
+import time
+
+from log import logger
+
+
+class BackplaneError(RuntimeError):
+    pass
+
+
+class RedisError(BackplaneError):
+    '''Redis 가 명령에 오류로 응답했다. 연결은 그대로 쓸 수 있다.'''
+    pass
+
+
+class RoomDirectory:
+    '''
+    방 번호, 방제, 멤버 이름과 방마다 멤버가 있는 node 들을 관리한다.
+    lock 을 잡지 않으므로 호출하는 쪽에서 한 번에 하나씩 부르도록 해야 한다.
+
+    방 목록은 방이 생기거나 없어질 때 정렬된 방 번호 list 를 고쳐 두고, 멤버 이름 목록은
+    멤버가 바뀐 방만 다시 만든다. 그래서 list_rooms() 는 요청한 페이지의 방들만 본다.
+    '''
+    def __init__(self):
+        self.next_room_id = 0
+        # 방 번호 -> (방제, {(node_id, conn_id): 이름})
+        self.rooms: dict[int, tuple[str, dict[tuple[int, int], str]]] = {}
+        # 방 번호 -> 그 방의 멤버가 있는 node 별 멤버 수
+        self.room_nodes: dict[int, collections.Counter] = {}
+        # 있는 방들의 번호. 방 번호는 커지기만 하므로 생성할 때 뒤에 붙이면 정렬이 유지된다.
+        self.room_ids: list[int] = []
+        # 방 번호 -> 마지막으로 만든 멤버 이름 목록. 멤버가 바뀌면 지운다.
+        self.member_names: dict[int, tuple[str, ...]] = {}
+
+    def create_room(self, node_id, title, conn_id, name):
+        self.next_room_id += 1
+        room_id = self.next_room_id
+        self.rooms[room_id] = (title, {(node_id, conn_id): name})
+        self.room_nodes[room_id] = collections.Counter({node_id: 1})
+        self.room_ids.append(room_id)
+        logger.info('방[%d]: 생성됨. 방제: %s', room_id, title)
+        return room_id
+
+    def restore_rooms(self, rooms: dict[int, str], last_room_id: int):
+        '''저장해 둔 방들을 멤버 없이 되살린다. 방 번호는 last_room_id 다음부터 발급한다.'''
+        for room_id, title in sorted(rooms.items()):
+            self.rooms[room_id] = (title, {})
+            self.room_nodes[room_id] = collections.Counter()
+            self.room_ids.append(room_id)
+        self.next_room_id = max(self.next_room_id, last_room_id)
+
+    def join_room(self, node_id, room_id, conn_id, name):
+        '''방이 있으면 멤버로 추가하고 방제를 반환한다. 없으면 None'''
+        room = self.rooms.get(room_id)
+        if not room:
+            return None
+        title, members = room
+        members[(node_id, conn_id)] = name
+        self.room_nodes[room_id][node_id] += 1
+        self.member_names.pop(room_id, None)
+        return title
+
+    def leave_room(self, node_id, room_id, conn_id, reason) -> bool:
+        '''멤버를 뺀다. 마지막 멤버여서 방을 지웠으면 True'''
+        room = self.rooms.get(room_id)
+        if not room or room[1].pop((node_id, conn_id), None) is None:
+            return False
+
+        nodes = self.room_nodes[room_id]
+        nodes[node_id] -= 1
+        if not nodes[node_id]:
+            del nodes[node_id]
+        self.member_names.pop(room_id, None)
+
+        if not room[1]:
+            logger.info('방[%d]: %s', room_id, reason)
+            del self.rooms[room_id]
+            del self.room_nodes[room_id]
+            del self.room_ids[bisect.bisect_left(self.room_ids, room_id)]
+            return True
+        return False
+
+    def rename_member(self, node_id, room_id, conn_id, name):
+        room = self.rooms.get(room_id)
+        if room and (node_id, conn_id) in room[1]:
+            room[1][(node_id, conn_id)] = name
+            self.member_names.pop(room_id, None)
+
+    def list_rooms(self, node_id, cursor=0, limit=0, with_members=True):
+        start = bisect.bisect_right(self.room_ids, cursor)
+        end = start + limit if limit else len(self.room_ids)
+        rooms = []
+        for room_id in self.room_ids[start:end]:
+            title, members = self.rooms[room_id]
+            names = ()
+            if with_members:
+                names = self.member_names.get(room_id)
+                if names is None:
+                    names = self.member_names[room_id] = tuple(members.values())
+            rooms.append((room_id, title, len(members), names))
+        next_cursor = rooms[-1][0] if end < len(self.room_ids) else 0
+        return rooms, next_cursor
+
+    def drop_node(self, node_id, reason):
+        '''node 의 멤버들을 모든 방에서 뺀다.'''
+        for room_id, (title, members) in list(self.rooms.items()):
+            for key in [key for key in members if key[0] == node_id]:
+                self.leave_room(node_id, room_id, key[1], reason)
+
+    def nodes_of(self, room_id):
+        return self.room_nodes.get(room_id, ())
+
+
+class Backplane:
+    '''
+    backplane 구현들의 공통 interface.
+
+    다른 node 에서 publish 된 메시지는 on_deliver(room_id, messages) 로, 종료 요청은
+    on_shutdown() 으로 전달된다. 구현에 따라 backplane 전용 쓰레드에서 호출될 수 있다.
+
+    blocking 이 True 인 구현은 다른 프로세스의 응답을 기다리는 메서드가 있으므로 asyncio engine 은
+    event loop 밖의 쓰레드에서 부른다.
+    '''
+    blocking = False
+
+    def start(self, on_deliver, on_shutdown):
+        self.on_deliver = on_deliver
+        self.on_shutdown = on_shutdown
+
+    def create_room(self, title, conn_id, name) -> int:
+        raise NotImplementedError()
+
+    def join_room(self, room_id, conn_id, name) -> str:
+        '''방에 입장하고 방제를 반환한다. 방이 없으면 None'''
+        raise NotImplementedError()
+
+    def leave_room(self, room_id, conn_id, reason):
+        '''방에서 나간다. 모든 node 에서 마지막 멤버였다면 방이 없어진다.'''
+        raise NotImplementedError()
+
+    def rename_member(self, room_id, conn_id, name):
+        raise NotImplementedError()
+
+    def list_rooms(self, cursor=0, limit=0, with_members=True) -> tuple[list[tuple[int, str, int, tuple[str, ...]]], int]:
+        '''
+        모든 node 의 방들 중 번호가 cursor 보다 큰 방들을 번호 순서로 최대 limit 개(0 이면 전부)
+        (방 번호, 방제, 멤버 수, 멤버 이름들) 로 반환한다. with_members 가 아니면 멤버 이름들은 비어 있다.
+        다음 페이지가 있으면 그 cursor 를, 없으면 0 을 함께 반환한다.
+        '''
+        raise NotImplementedError()
+
+    def publish(self, room_id, messages):
+        '''이 방의 멤버가 있는 다른 node 들에게 메시지를 전달한다.'''
+        raise NotImplementedError()
+
+    def request_shutdown(self):
+        '''모든 node 에 종료를 요청한다.'''
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class LoopbackHub:
+    '''같은 프로세스 안의 LoopbackBackplane 들이 공유하는 방 정보'''
+    def __init__(self):
+        self.directory = RoomDirectory()
+        self.nodes: dict[int, 'LoopbackBackplane'] = {}
+        self.mutex = threading.Lock()
+
+
+class LoopbackBackplane(Backplane):
+    '''
+    한 프로세스 안에서 동작하는 backplane. 메시지는 복사나 직렬화 없이 publish() 를
+    부른 쓰레드에서 바로 다른 node 의 on_deliver 로 넘어간다.
+
+    on_room_destroyed(room_id) 가 있으면 이 node 의 멤버가 나가서 방이 없어질 때 hub 의 lock 을
+    잡은 채로 부른다. 서버 종료로 node 가 빠질 때는 부르지 않는다.
+    '''
+    def __init__(self, hub: LoopbackHub = None):
+        self.hub = hub or LoopbackHub()
+        self.on_room_destroyed = None
+        with self.hub.mutex:
+            self.node_id = len(self.hub.nodes)
+            self.hub.nodes[self.node_id] = self
+
+    def create_room(self, title, conn_id, name):
+        with self.hub.mutex:
+            return self.hub.directory.create_room(self.node_id, title, conn_id, name)
+
+    def join_room(self, room_id, conn_id, name):
+        with self.hub.mutex:
+            return self.hub.directory.join_room(self.node_id, room_id, conn_id, name)
+
+    def leave_room(self, room_id, conn_id, reason):
+        with self.hub.mutex:
+            if self.hub.directory.leave_room(self.node_id, room_id, conn_id, reason) and self.on_room_destroyed:
+                self.on_room_destroyed(room_id)
+
+    def rename_member(self, room_id, conn_id, name):
+        with self.hub.mutex:
+            self.hub.directory.rename_member(self.node_id, room_id, conn_id, name)
+
+    def list_rooms(self, cursor=0, limit=0, with_members=True):
+        with self.hub.mutex:
+            return self.hub.directory.list_rooms(self.node_id, cursor, limit, with_members)
+
+    def restore_rooms(self, rooms, last_room_id):
+        with self.hub.mutex:
+            self.hub.directory.restore_rooms(rooms, last_room_id)
+
+    def publish(self, room_id, messages):
+        with self.hub.mutex:
+            targets = [self.hub.nodes[node_id] for node_id in self.hub.directory.nodes_of(room_id) if node_id != self.node_id]
+        for target in targets:
+            target.on_deliver(room_id, messages)
+
+    def request_shutdown(self):
+        with self.hub.mutex:
+            targets = list(self.hub.nodes.values())
+        for target in targets:
+            target.on_shutdown()
+
+    def close(self):
+        with self.hub.mutex:
+            self.hub.directory.drop_node(self.node_id, '서버 종료로 인한 방폭')
+            del self.hub.nodes[self.node_id]
+
+
+class RespConnection:
+    '''
+    Redis 서버와의 RESP 연결. 명령은 bulk string 배열로 보내고 응답은 Python 값으로 바꾼다.
+    '''
+    def __init__(self, host: str, port: int):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        self.send_mutex = threading.Lock()
+
+    def send(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(f'${len(arg)}\r\n'.encode())
+            parts.append(arg)
+            parts.append(b'\r\n')
+        with self.send_mutex:
+            self.sock.sendall(b''.join(parts))
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise BackplaneError('Redis 연결이 끊어졌음')
+
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value
+        if kind == b'-':
+            raise RedisError(f'Redis 오류: {value.decode("utf-8")}')
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if value == b'-1':
+                return None
+            data = self.reader.read(int(value) + 2)
+            return data[:-2]
+        if kind == b'*':
+            if value == b'-1':
+                return None
+            return [self.read_reply() for _ in range(int(value))]
+        raise BackplaneError(f'알 수 없는 Redis 응답: {line!r}')
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.close()
+        self.sock.close()
+
+
+# 방 하나에 대한 Redis 명령들은 Lua script 로 묶어서 다른 node 의 요청과 섞이지 않게 한다.
+# KEYS: 방 번호 set, 방 hash, 방 멤버 hash
+CREATE_ROOM_SCRIPT = '''
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[1])
+redis.call('HSET', KEYS[2], 'title', ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[3], ARGV[4])
+return 1
+'''
+
+JOIN_ROOM_SCRIPT = '''
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return false
+end
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+return redis.call('HGET', KEYS[2], 'title')
+'''
+
+LEAVE_ROOM_SCRIPT = '''
+if redis.call('HDEL', KEYS[3], ARGV[2]) == 0 or redis.call('HLEN', KEYS[3]) > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+redis.call('ZREM', KEYS[1], ARGV[1])
+return 1
+'''
+
+RENAME_MEMBER_SCRIPT = '''
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+'''
+
+# Redis 연결이 끊어졌을 때 다시 연결을 시도하는 횟수와 간격(초). 모두 실패하면 서버를 종료한다.
+RECONNECT_ATTEMPTS = 5
+RECONNECT_INTERVAL = 1.0
+# 방 channel 의 subscribe 를 Redis 가 확인하기를 기다리는 최대 시간(초)
+SUBSCRIBE_TIMEOUT = 5.0
+
+
+class RedisBackplane(Backplane):
+    '''
+    Redis 를 공유하는 node 들의 backplane.
+
+    방 정보는 다음 key 들에 저장한다.
+      {prefix}:next_room_id        방 번호 발급용 counter
+      {prefix}:rooms               방 번호 sorted set (score 도 방 번호)
+      {prefix}:room:{id}           방 hash (title)
+      {prefix}:room:{id}:members   "{node id}:{연결 번호}" -> 이름
+    메시지는 {prefix}:room:{id} channel 로 publish 하고, 각 node 는 자기 멤버가 있는
+    방의 channel 만 subscribe 한다. encode/decode 는 메시지 목록과 bytes 사이의 변환이다.
+
+    명령 연결은 응답을 기다리지 않고 이어서 보내고(pipelining), 응답은 전용 쓰레드가 보낸 순서대로
+    읽어서 기다리는 쪽에 넘긴다. publish() 처럼 결과가 필요 없는 명령은 응답을 기다리지 않는다.
+
+    방에 입장할 때는 그 방의 channel 을 subscribe 했다고 Redis 가 확인한 뒤에 반환하므로, 입장한
+    뒤에 다른 node 가 publish 한 메시지는 놓치지 않는다.
+
+    연결이 끊어지면 다시 연결하고, subscribe 연결이면 이 node 의 방들을 다시 subscribe 한다.
+    다시 연결하는 동안의 요청은 기다리지 않고 BackplaneError 가 된다. 끊어진 동안 publish 된
+    메시지는 받지 못한다. 다시 연결하지 못하면 on_shutdown() 을 부른다.
+
+    node 가 비정상 종료하면 그 node 의 멤버들은 Redis 에 남는다.
+    '''
+    blocking = True
+
+    def __init__(self, address: str, prefix: str, encode, decode):
+        host, _, port = address.rpartition(':')
+        self.host = host or 'localhost'
+        self.port = int(port)
+        self.prefix = prefix
+        self.encode = encode
+        self.decode = decode
+        # 자기가 publish 한 메시지를 구별하기 위한 고정 길이 node id
+        self.node_id = os.urandom(8).hex().encode()
+
+        # 명령 연결. 보낸 순서대로 응답이 오므로, 응답을 기다리는 Future 를 보내는 순서대로 replies 에 넣는다.
+        # 결과가 필요 없는 명령은 None 을 넣는다. 보내기와 replies 에 넣기는 commands_mutex 로 묶는다.
+        self.commands = RespConnection(self.host, self.port)
+        self.commands_mutex = threading.Lock()
+        self.replies: collections.deque[concurrent.futures.Future | None] = collections.deque()
+        # 명령 연결을 다시 맺는 중이면 False. commands_mutex 로 보호한다.
+        self.commands_connected = True
+        # subscribe 상태의 연결은 다른 명령을 쓸 수 없으므로 따로 연다.
+        self.subscriber = RespConnection(self.host, self.port)
+        # subscribe 연결을 다시 맺는 중이면 False. local_members_mutex 로 보호한다.
+        self.subscriber_connected = True
+        # channel -> 보낸 SUBSCRIBE 마다 그 확인을 기다리는 Future. 확인은 보낸 순서대로 온다.
+        # local_members_mutex 로 보호한다.
+        self.subscribe_acks: dict[bytes, collections.deque[concurrent.futures.Future]] = {}
+        # close() 가 연결을 닫았으면 True. 이때 연결이 끊어지는 것은 오류가 아니다.
+        self.closing = False
+
+        # 이 node 에 있는 방별 멤버들. 첫 멤버가 들어올 때 subscribe 하고 마지막 멤버가 나가면 unsubscribe 한다.
+        self.local_members: dict[int, set[int]] = {}
+        self.local_members_mutex = threading.Lock()
+
+        self.rooms_key = f'{prefix}:rooms'
+        self.shutdown_channel = f'{prefix}:shutdown'.encode()
+        self.room_channel_prefix = f'{prefix}:room:'.encode()
+
+    def start(self, on_deliver, on_shutdown):
+        super().start(on_deliver, on_shutdown)
+        # subscribe 가 확인된 뒤에 시작해야 그 직후에 요청된 종료를 놓치지 않는다.
+        with self.local_members_mutex:
+            subscribed = self.send_subscribe([self.shutdown_channel])
+        while not subscribed.done():
+            self.dispatch(self.subscriber.read_reply())
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        self.reply_reader = threading.Thread(target=self.reply_loop, daemon=True)
+        self.reply_reader.start()
+
+    def room_keys(self, room_id):
+        room_key = f'{self.prefix}:room:{room_id}'
+        return [self.rooms_key, room_key, f'{room_key}:members']
+
+    def member_field(self, conn_id):
+        return self.node_id + b':' + str(conn_id).encode()
+
+    def send_command(self, reply: concurrent.futures.Future | None, *args):
+        with self.commands_mutex:
+            if not self.commands_connected:
+                raise BackplaneError('Redis 명령 연결을 다시 맺는 중')
+            self.replies.append(reply)
+            try:
+                self.commands.send(*args)
+            except OSError as err:
+                raise BackplaneError(f'Redis 에 명령을 보내지 못함: {err}') from err
+
+    def execute(self, *args):
+        '''명령을 보내고 응답을 기다린다.'''
+        reply = concurrent.futures.Future()
+        self.send_command(reply, *args)
+        return reply.result()
+
+    def execute_async(self, *args):
+        '''명령을 보내기만 한다. 오류 응답은 reply_loop() 가 로그로 남긴다.'''
+        self.send_command(None, *args)
+
+    def room_channel(self, room_id) -> bytes:
+        return self.room_channel_prefix + str(room_id).encode()
+
+    def send_subscribe(self, channels: list[bytes]) -> concurrent.futures.Future:
+        '''
+        local_members_mutex 를 잡은 채로 부른다. SUBSCRIBE 를 보내고, 마지막 channel 의 확인을 기다릴
+        Future 를 반환한다. 확인은 read_loop() 가 받아서 알린다.
+        '''
+        for channel in channels:
+            subscribed = concurrent.futures.Future()
+            self.subscribe_acks.setdefault(channel, collections.deque()).append(subscribed)
+        self.subscriber.send('SUBSCRIBE', *channels)
+        return subscribed
+
+    def reconnect(self, what: str) -> RespConnection | None:
+        '''
+        Redis 에 다시 연결한다. lock 을 잡지 않고 부른다. RECONNECT_ATTEMPTS 번 모두 실패하면
+        서버 종료를 요청하고 None 을 반환한다.
+        '''
+        for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+            if self.closing:
+                return None
+            try:
+                conn = RespConnection(self.host, self.port)
+            except OSError as err:
+                logger.warning('Redis backplane: %s 연결 재시도 %d/%d 실패: %s', what, attempt, RECONNECT_ATTEMPTS, err)
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            logger.info('Redis backplane: %s 연결을 다시 맺음', what)
+            return conn
+
+        if not self.closing:
+            logger.error('Redis backplane: %s 연결을 다시 맺지 못해서 서버를 종료함', what)
+            self.on_shutdown()
+        return None
+
+    def add_local_member(self, room_id, conn_id):
+        '''멤버를 추가하고, 방의 channel 을 subscribe 했다고 Redis 가 확인할 때까지 기다린다.'''
+        channel = self.room_channel(room_id)
+        with self.local_members_mutex:
+            if not self.subscriber_connected:
+                raise BackplaneError('Redis subscribe 연결을 다시 맺는 중')
+            members = self.local_members.setdefault(room_id, set())
+            members.add(conn_id)
+            subscribed = None
+            if len(members) == 1:
+                try:
+                    subscribed = self.send_subscribe([channel])
+                except OSError:
+                    # 연결이 끊어졌다. read_loop() 가 다시 연결하면서 local_members 의 방들을 subscribe 한다.
+                    pass
+            elif channel in self.subscribe_acks:
+                # 먼저 입장한 멤버가 보낸 SUBSCRIBE 가 아직 확인되지 않았다.
+                subscribed = self.subscribe_acks[channel][-1]
+
+        if subscribed is None:
+            return
+        try:
+            subscribed.result(SUBSCRIBE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            self.remove_local_member(room_id, conn_id)
+            raise BackplaneError(f'{SUBSCRIBE_TIMEOUT}초 안에 방[{room_id}]의 subscribe 가 확인되지 않음')
+        except BackplaneError:
+            self.remove_local_member(room_id, conn_id)
+            raise
+
+    def remove_local_member(self, room_id, conn_id):
+        with self.local_members_mutex:
+            members = self.local_members.get(room_id)
+            if members is None or conn_id not in members:
+                return
+            members.discard(conn_id)
+            if not members:
+                del self.local_members[room_id]
+                if not self.subscriber_connected:
+                    return
+                try:
+                    self.subscriber.send('UNSUBSCRIBE', self.room_channel(room_id))
+                except OSError:
+                    pass
+
+    def create_room(self, title, conn_id, name):
+        # 다른 node 가 입장해서 보내는 메시지를 놓치지 않도록 방을 만들기 전에 subscribe 를 마친다.
+        room_id = self.execute('INCR', f'{self.prefix}:next_room_id')
+        self.add_local_member(room_id, conn_id)
+        self.execute('EVAL', CREATE_ROOM_SCRIPT, 3, *self.room_keys(room_id), room_id, title, self.member_field(conn_id), name)
+        logger.info('방[%d]: 생성됨. 방제: %s', room_id, title)
+        return room_id
+
+    def join_room(self, room_id, conn_id, name):
+        # 입장한 뒤의 메시지를 놓치지 않도록 방에 멤버로 추가하기 전에 subscribe 를 마친다.
+        self.add_local_member(room_id, conn_id)
+        title = self.execute('EVAL', JOIN_ROOM_SCRIPT, 3, *self.room_keys(room_id), room_id, self.member_field(conn_id), name)
+        if title is None:
+            self.remove_local_member(room_id, conn_id)
+            return None
+        return title.decode('utf-8')
+
+    def leave_room(self, room_id, conn_id, reason):
+        self.remove_local_member(room_id, conn_id)
+        if self.execute('EVAL', LEAVE_ROOM_SCRIPT, 3, *self.room_keys(room_id), room_id, self.member_field(conn_id)):
+            logger.info('방[%d]: %s', room_id, reason)
+
+    def rename_member(self, room_id, conn_id, name):
+        self.execute_async('EVAL', RENAME_MEMBER_SCRIPT, 1, self.room_keys(room_id)[2], self.member_field(conn_id), name)
+
+    def list_rooms(self, cursor=0, limit=0, with_members=True):
+        # 방들의 key 를 Lua script 에서 만들면 cluster 에서 쓸 수 없으므로, 방 번호들을 먼저 읽고
+        # 방마다의 명령은 응답을 기다리지 않고 한꺼번에 보낸 뒤 응답을 모은다.
+        # 방 하나의 정보를 원자적으로 읽지는 않으므로 그 사이에 없어진 방은 목록에서 뺀다.
+        args = ['ZRANGEBYSCORE', self.rooms_key, f'({cursor}', '+inf']
+        if limit:
+            args += ['LIMIT', 0, limit + 1]
+        room_ids = [int(room_id) for room_id in self.execute(*args)]
+        next_cursor = 0
+        if limit and len(room_ids) > limit:
+            room_ids = room_ids[:limit]
+            next_cursor = room_ids[-1]
+
+        pending = []
+        for room_id in room_ids:
+            _, room_key, members_key = self.room_keys(room_id)
+            commands = [('HGET', room_key, 'title'), ('HVALS', members_key) if with_members else ('HLEN', members_key)]
+            replies = [concurrent.futures.Future() for _ in commands]
+            for reply, command in zip(replies, commands):
+                self.send_command(reply, *command)
+            pending.append((room_id, replies))
+
+        rooms = []
+        for room_id, (title, members) in pending:
+            title, members = title.result(), members.result()
+            if title is None:
+                continue
+            names = tuple(name.decode('utf-8') for name in members) if with_members else ()
+            rooms.append((room_id, title.decode('utf-8'), len(names) if with_members else members, names))
+        return rooms, next_cursor
+
+    def publish(self, room_id, messages):
+        self.execute_async('PUBLISH', self.room_channel(room_id), self.node_id + self.encode(messages))
+
+    def request_shutdown(self):
+        self.execute_async('PUBLISH', self.shutdown_channel, self.node_id)
+
+    def reply_loop(self):
+        while True:
+            try:
+                result = self.commands.read_reply()
+            except RedisError as err:
+                result = err
+            except (BackplaneError, OSError, ValueError) as err:
+                if self.closing:
+                    break
+                logger.error('Redis backplane: 명령 연결이 끊어짐: %s', err)
+                # 응답을 기다리던 쪽들은 오류로 깨우고, 다시 연결할 때까지 새 명령은 바로 실패시킨다.
+                with self.commands_mutex:
+                    self.commands_connected = False
+                    replies, self.replies = self.replies, collections.deque()
+                    self.commands.close()
+                for reply in replies:
+                    if reply:
+                        reply.set_exception(BackplaneError(f'Redis 명령 연결이 끊어졌음: {err}'))
+
+                commands = self.reconnect('명령')
+                if commands is None:
+                    break
+                with self.commands_mutex:
+                    self.commands = commands
+                    self.commands_connected = True
+                continue
+
+            reply = self.replies.popleft()
+            if reply is None:
+                if isinstance(result, RedisError):
+                    logger.warning('Redis backplane: %s', result)
+            elif isinstance(result, RedisError):
+                reply.set_exception(result)
+            else:
+                reply.set_result(result)
+
+    def read_loop(self):
+        while True:
+            try:
+                reply = self.subscriber.read_reply()
+            except (BackplaneError, OSError, ValueError) as err:
+                if self.closing:
+                    break
+                logger.error('Redis backplane: subscribe 연결이 끊어짐: %s', err)
+                if not self.resubscribe():
+                    break
+                continue
+
+            try:
+                self.dispatch(reply)
+            except Exception as err:
+                # 메시지 하나를 처리하지 못해도 다른 방들의 메시지는 계속 받는다.
+                logger.exception('Redis backplane: 받은 메시지를 처리하지 못함: %s', err)
+
+    def resubscribe(self) -> bool:
+        '''
+        subscribe 연결을 다시 맺고 종료 channel 과 이 node 의 방들을 다시 subscribe 한다.
+        확인을 기다리던 입장 요청들은 오류로 깨우고, 다시 연결하는 동안의 입장 요청은 바로 실패시킨다.
+        '''
+        with self.local_members_mutex:
+            self.subscriber_connected = False
+            self.subscriber.close()
+            acks, self.subscribe_acks = self.subscribe_acks, {}
+        for subscribed in itertools.chain.from_iterable(acks.values()):
+            subscribed.set_exception(BackplaneError('Redis subscribe 연결이 끊어졌음'))
+
+        while True:
+            subscriber = self.reconnect('subscribe')
+            if subscriber is None:
+                return False
+            # 다시 연결하는 동안 바뀌었을 수 있으므로 지금의 방들을 subscribe 한다. 확인은 read_loop() 가 받는다.
+            with self.local_members_mutex:
+                self.subscriber = subscriber
+                channels = [self.shutdown_channel] + [self.room_channel(room_id) for room_id in self.local_members]
+                try:
+                    self.send_subscribe(channels)
+                except OSError as err:
+                    logger.warning('Redis backplane: 다시 subscribe 하지 못함: %s', err)
+                    self.subscribe_acks = {}
+                    subscriber.close()
+                    continue
+                self.subscriber_connected = True
+            logger.warning('Redis backplane: 방 %d개를 다시 subscribe 함. 끊어진 동안의 메시지는 받지 못했음', len(channels) - 1)
+            return True
+
+    def dispatch(self, reply):
+        if reply[0] == b'subscribe':
+            with self.local_members_mutex:
+                acks = self.subscribe_acks.get(reply[1])
+                if acks:
+                    acks.popleft().set_result(None)
+                    if not acks:
+                        del self.subscribe_acks[reply[1]]
+            return
+        if reply[0] != b'message':
+            return
+
+        _, channel, payload = reply
+        if channel == self.shutdown_channel:
+            self.on_shutdown()
+        elif payload[:len(self.node_id)] != self.node_id:
+            room_id = int(channel[len(self.room_channel_prefix):])
+            self.on_deliver(room_id, self.decode(payload[len(self.node_id):]))
+
+    def close(self):
+        # 정상 종료할 때는 이 node 의 멤버들을 Redis 에서 지운다.
+        with self.local_members_mutex:
+            local_members = [(room_id, conn_id) for room_id, members in self.local_members.items() for conn_id in members]
+        try:
+            for room_id, conn_id in local_members:
+                self.leave_room(room_id, conn_id, '서버 종료로 인한 방폭')
+        except BackplaneError as err:
+            # 비정상 종료했을 때처럼 남은 멤버들은 Redis 에 남는다.
+            logger.warning('Redis backplane: 종료하면서 멤버들을 지우지 못함: %s', err)
+
+        self.closing = True
+        self.subscriber.close()
+        self.commands.close()
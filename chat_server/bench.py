@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+'''
+chat_server 내부 경로에 대한 microbenchmark.
+
+사용 예:
+  python3 bench.py --case=recv_copy --messages=20000 --message_size=100
+  python3 bench.py --case=fanout --format=protobuf
+  python3 bench.py --case=drain --room_size=10000
+  python3 bench.py --case=envelope --format=protobuf
+  python3 bench.py --case=codec
+  python3 bench.py --case=history --history_depth=100
+  python3 bench.py --case=chatlog --messages=100000
+  python3 bench.py --case=admission --messages=100000 --addresses=10000
+'''
+import collections
+import json
+import random
+import tempfile
+import time
+
+from absl import app, flags
+
+import admission
+import backplane
+import chatlog
+import codec
+import framing
+from framing import ReceiveBuffer
+import message_pb2 as pb
+import server
+
+
+FLAGS = flags.FLAGS
+
+# server 모듈의 필수 flag. benchmark 는 소켓을 열지 않으므로 아무 값이나 상관없다.
+FLAGS.set_default('port', 0)
+
+flags.DEFINE_enum('case', 'recv_copy', ['recv_copy', 'fanout', 'drain', 'envelope', 'codec', 'history', 'chatlog', 'admission'], help='실행할 benchmark')
+flags.DEFINE_integer('messages', 20000, help='메시지 개수')
+flags.DEFINE_integer('message_size', 100, help='메시지 본문의 대략적인 크기(바이트)')
+flags.DEFINE_integer('chunk_size', 65536, help='recv() 한 번에 읽는 최대 바이트 수')
+flags.DEFINE_list('room_sizes', ['10', '100', '500', '1000'], help='fanout benchmark 의 방 인원 수들')
+flags.DEFINE_integer('repeat', 200, help='방 크기별로 반복할 broadcast 횟수')
+flags.DEFINE_integer('room_size', 10000, help='drain benchmark 의 방 인원 수')
+flags.DEFINE_integer('addresses', 10000, help='admission benchmark 에서 접속하는 클라이언트 IP 수')
+
+
+class BurstSocket:
+  '''
+  미리 만들어 둔 바이트열을 chunk_size 단위로 돌려주는 가짜 소켓.
+  큰 burst 가 한 번에 도착한 상황을 흉내 낸다.
+  '''
+  def __init__(self, data, chunk_size):
+    self.data = memoryview(data)
+    self.offset = 0
+    self.chunk_size = chunk_size
+
+  def recv(self, max_bytes):
+    size = min(max_bytes, self.chunk_size)
+    chunk = self.data[self.offset:self.offset + size].tobytes()
+    self.offset += len(chunk)
+    return chunk
+
+  def recv_into(self, buffer):
+    size = min(len(buffer), self.chunk_size, len(self.data) - self.offset)
+    buffer[:size] = self.data[self.offset:self.offset + size]
+    self.offset += size
+    return size
+
+
+def make_burst(num_messages, message_size):
+  frames = []
+  for i in range(num_messages):
+    serialized = json.dumps({'type': 'CSChat', 'text': f'{i:08d}'.ljust(message_size, 'x')}).encode('utf-8')
+    frames.append(len(serialized).to_bytes(2, byteorder='big') + serialized)
+  return b''.join(frames)
+
+
+def receive_with_bytes(sock):
+  '''
+  bytes 를 이어 붙이고 잘라내던 기존 방식. 복사되는 바이트 수를 함께 센다.
+  '''
+  socket_buffer = b''
+  current_message_len = None
+  num_messages = 0
+  bytes_copied = 0
+
+  while True:
+    received_buff = sock.recv(65536)
+    if not received_buff:
+      break
+
+    socket_buffer += received_buff
+    bytes_copied += len(socket_buffer)
+
+    while True:
+      if current_message_len is None:
+        if len(socket_buffer) < 2:
+          break
+        current_message_len = int.from_bytes(socket_buffer[0:2], byteorder='big')
+        socket_buffer = socket_buffer[2:]
+        bytes_copied += len(socket_buffer)
+
+      if len(socket_buffer) < current_message_len:
+        break
+
+      serialized = socket_buffer[:current_message_len]
+      socket_buffer = socket_buffer[current_message_len:]
+      bytes_copied += len(serialized) + len(socket_buffer)
+      current_message_len = None
+
+      json.loads(serialized)
+      num_messages += 1
+
+  return num_messages, bytes_copied
+
+
+def receive_with_buffer(sock):
+  '''
+  ReceiveBuffer 와 recv_into() 를 쓰는 방식. 메시지 본문은 memoryview 로 넘어간다.
+  '''
+  socket_buffer = ReceiveBuffer()
+  num_messages = 0
+
+  while socket_buffer.recv_into(sock):
+    for serialized in socket_buffer.next_frames():
+      json.loads(str(serialized, encoding='utf-8'))
+      num_messages += 1
+
+  return num_messages, socket_buffer.bytes_copied
+
+
+def bench_recv_copy():
+  data = make_burst(FLAGS.messages, FLAGS.message_size)
+  print(f'메시지 {FLAGS.messages}개, 총 {len(data)}바이트, recv 단위 {FLAGS.chunk_size}바이트')
+
+  for name, receive in [('bytes', receive_with_bytes), ('ReceiveBuffer', receive_with_buffer)]:
+    sock = BurstSocket(data, FLAGS.chunk_size)
+    started = time.perf_counter()
+    num_messages, bytes_copied = receive(sock)
+    elapsed = time.perf_counter() - started
+    assert num_messages == FLAGS.messages
+
+    print(f'{name:>14}: 메시지당 복사 {bytes_copied / num_messages:10.1f}바이트, {num_messages / elapsed:12.0f} msg/s')
+
+
+class NullConnection(server.UserConnection):
+  '''소켓 없이 큐에만 쌓는 연결'''
+  def __init__(self, member_id):
+    super().__init__(None, ('bench', member_id))
+
+  def request_send(self):
+    pass
+
+
+def make_chat_messages(name, text):
+  if FLAGS.format == 'json':
+    return [{'type': 'SCChat', 'member': name, 'text': text}]
+  return [pb.Type(type=pb.Type.MessageType.SC_CHAT), pb.SCChat(member=name, text=text)]
+
+
+def fanout_per_member(members, messages, sender):
+  '''멤버마다 직렬화하던 기존 방식. 로그용 문자열도 매번 만들었다.'''
+  for member in members:
+    if member is not sender:
+      member.send_encoded(server.encode_messages(messages))
+      server.describe_messages(messages)
+
+
+def bench_fanout():
+  text = 'x' * FLAGS.message_size
+  print(f'포맷 {FLAGS.format}, 메시지 {FLAGS.message_size}바이트, 방 크기별 broadcast {FLAGS.repeat}회')
+
+  for room_size in [int(size) for size in FLAGS.room_sizes]:
+    members = [NullConnection(i) for i in range(room_size)]
+    sender = members[0]
+
+    results = []
+    for fanout in [fanout_per_member, server.broadcast_messages]:
+      started = time.perf_counter()
+      for i in range(FLAGS.repeat):
+        fanout(members, make_chat_messages(sender.name, text), sender)
+      elapsed = time.perf_counter() - started
+      results.append(FLAGS.repeat * (room_size - 1) / elapsed)
+
+      for member in members:
+        member.pending_data.clear()
+        member.pending_kinds.clear()
+        member.pending_bytes = 0
+
+    print(f'방 인원 {room_size:>6}: 멤버별 직렬화 {results[0]:12.0f} 전달/s, 한 번 직렬화 {results[1]:12.0f} 전달/s')
+
+
+def bench_drain():
+  '''
+  큰 방의 모든 멤버가 한꺼번에 접속을 끊는 상황(load balancer drain 등).
+  '''
+  members = [NullConnection(i) for i in range(FLAGS.room_size)]
+
+  server.chat_backplane = backplane.LoopbackBackplane()
+  room_id = server.chat_backplane.create_room('drain', members[0].conn_id, members[0].name)
+  room = server.join_local_room(room_id, 'drain', members[0])
+  members[0].current_room = room
+  for member in members[1:]:
+    assert server.chat_backplane.join_room(room_id, member.conn_id, member.name) == 'drain'
+    assert room.add_member(member)
+    member.current_room = room
+
+  # 접속 종료는 입장 순서와 상관없이 일어난다.
+  drain_order = list(members)
+  random.Random(0).shuffle(drain_order)
+
+  started = time.perf_counter()
+  for member in drain_order:
+    member.disconnect()
+  elapsed = time.perf_counter() - started
+  assert room.closed and not room.members
+
+  # 비교용: 멤버를 list 로 관리하던 기존 방식
+  member_list = list(members)
+  list_started = time.perf_counter()
+  for member in drain_order:
+    member_list.remove(member)
+  list_elapsed = time.perf_counter() - list_started
+
+  print(f'방 인원 {FLAGS.room_size}명 drain: ChatRoom {elapsed * 1000:.1f}ms, list.remove() {list_elapsed * 1000:.1f}ms')
+
+
+def make_protobuf_chat_stream(num_messages, message_size, envelope):
+  '''클라이언트가 보내는 CSChat 들을 Type + 본문 두 frame 또는 Envelope 한 frame 으로 만든다.'''
+  bodies = []
+  for i in range(num_messages):
+    chat = pb.CSChat(text=f'{i:08d}'.ljust(message_size, 'x'))
+    if envelope:
+      bodies.append(pb.Envelope(cs_chat=chat).SerializeToString())
+    else:
+      bodies.append(pb.Type(type=pb.Type.MessageType.CS_CHAT).SerializeToString())
+      bodies.append(chat.SerializeToString())
+  return framing.frame_bodies(bodies, framing.Framing.LEGACY, framing.LEGACY_MAX_FRAME_SIZE), len(bodies)
+
+
+def bench_envelope():
+  '''
+  CSChat 을 받아서 같은 방의 다른 멤버에게 SCChat 을 보내기까지, frame 분리부터
+  메시지 처리와 직렬화를 거쳐 상대 큐에 넣는 과정의 처리량.
+  '''
+  if FLAGS.format != 'protobuf':
+    print('--format=protobuf 로 실행해야 됩니다.')
+    return
+
+  server.chat_backplane = backplane.LoopbackBackplane()
+  print(f'CSChat {FLAGS.messages}개, 본문 {FLAGS.message_size}바이트, recv 단위 {FLAGS.chunk_size}바이트')
+
+  for name, envelope in [('Type + 본문', False), ('Envelope', True)]:
+    sender, receiver = NullConnection(0), NullConnection(1)
+    sender.envelope = receiver.envelope = envelope
+    room_id = server.chat_backplane.create_room('envelope', sender.conn_id, sender.name)
+    sender.current_room = server.join_local_room(room_id, 'envelope', sender)
+    server.chat_backplane.join_room(room_id, receiver.conn_id, receiver.name)
+    receiver.current_room = server.join_local_room(room_id, 'envelope', receiver)
+
+    data, num_frames = make_protobuf_chat_stream(FLAGS.messages, FLAGS.message_size, envelope)
+    sock = BurstSocket(data, FLAGS.chunk_size)
+    started = time.perf_counter()
+    while sender.socket_buffer.recv_into(sock):
+      sender.handle_messages(sender.socket_buffer.next_frames())
+    elapsed = time.perf_counter() - started
+
+    sent_bytes = sum(len(buffer) for buffer in receiver.pending_data)
+    assert len(receiver.pending_data) == FLAGS.messages
+    print(f'{name:>10}: {FLAGS.messages / elapsed:10.0f} msg/s, 메시지당 frame {num_frames / FLAGS.messages:.0f}개, '
+          f'수신 {len(data) / FLAGS.messages:.1f}바이트, 송신 {sent_bytes / FLAGS.messages:.1f}바이트')
+
+    sender.disconnect()
+    receiver.disconnect()
+
+
+def bench_codec():
+  '''
+  JSON 메시지 decode(스키마 검사 포함) 와 SCChat encode 의 처리량을 설치된 codec 별로 비교한다.
+  '''
+  data = make_burst(FLAGS.messages, FLAGS.message_size)
+  bodies = framing.split_frames(data, framing.Framing.LEGACY)
+  print(f'메시지 {FLAGS.messages}개, 본문 {FLAGS.message_size}바이트')
+
+  for name, codec_class in codec.json_codecs.items():
+    if not codec_class:
+      print(f'{name:>8}: 설치되지 않음')
+      continue
+
+    json_codec = codec_class()
+    started = time.perf_counter()
+    for body in bodies:
+      msg_type, msg = json_codec.decode(body)
+      json_codec.encode({'type': 'SCChat', 'member': 'bench', 'text': msg.text})
+    elapsed = time.perf_counter() - started
+    print(f'{name:>8}: {FLAGS.messages / elapsed:12.0f} msg/s')
+
+
+def bench_history():
+  '''
+  방에 입장할 때 지난 채팅을 보내는 비용. 채팅마다 다시 직렬화해서 보내는 방식과 직렬화해 둔
+  기록에 길이만 붙여서 한 번에 보내는 방식을 비교한다.
+  '''
+  text = 'x' * FLAGS.message_size
+  history = [make_chat_messages(f'member{i}', text) for i in range(FLAGS.history_depth)]
+  entries = [server.serialize_messages(messages) for messages in history]
+  member = NullConnection(0)
+  # 보낸 버퍼를 비우지 않으므로 slow consumer 정책이 버리지 않게 한다.
+  member.send_high_watermark = 0
+  print(f'포맷 {FLAGS.format}, 지난 채팅 {FLAGS.history_depth}개, 본문 {FLAGS.message_size}바이트, 입장 {FLAGS.repeat}회')
+
+  results = []
+  for replay in [lambda: [member.send_messages(messages) for messages in history], lambda: member.send_history(entries)]:
+    started = time.perf_counter()
+    for i in range(FLAGS.repeat):
+      replay()
+    results.append(FLAGS.repeat / (time.perf_counter() - started))
+    num_buffers = len(member.pending_data)
+    member.pending_data.clear()
+    member.pending_kinds.clear()
+    member.pending_bytes = 0
+
+  print(f'채팅마다 직렬화 {results[0]:10.0f} 입장/s, 기록을 한 번에 {results[1]:10.0f} 입장/s (입장마다 버퍼 {num_buffers // FLAGS.repeat}개)')
+
+
+def bench_chatlog():
+  '''
+  작업 쓰레드가 채팅을 chat log 에 넣는 비용과, 모두 디스크에 쓰고 fsync 할 때까지의 시간.
+  fsync 를 여러 기록이 나눠 쓰므로 fsync 횟수는 기록 수보다 훨씬 적다.
+  '''
+  text = 'x' * FLAGS.message_size
+  entries = [server.serialize_messages(make_chat_messages('bench', f'{i:08d}{text}')) for i in range(FLAGS.messages)]
+  print(f'포맷 {FLAGS.format}, 채팅 {FLAGS.messages}개, 본문 {FLAGS.message_size}바이트, commit 간격 {FLAGS.chatlog_commit_interval}초')
+
+  with tempfile.TemporaryDirectory() as directory:
+    chat_log = chatlog.ChatLog(directory, FLAGS.format, FLAGS.history_depth, FLAGS.chatlog_segment_size, FLAGS.chatlog_commit_interval,
+                               FLAGS.chatlog_max_pending)
+    chat_log.recover()
+    chat_log.start()
+
+    started = time.perf_counter()
+    for i, bodies in enumerate(entries):
+      chat_log.chat(i % 100 + 1, bodies)
+    appended = time.perf_counter()
+    chat_log.close()
+    durable = time.perf_counter()
+
+  print(f'큐에 넣기 {FLAGS.messages / (appended - started):10.0f} msg/s, 디스크까지 {FLAGS.messages / (durable - started):10.0f} msg/s, '
+        f'fsync {chat_log.commits}회 (fsync 당 {chat_log.records_written / chat_log.commits:.0f}개), 큐가 가득 차서 기다림 {chat_log.append_waits}회')
+
+
+def bench_admission():
+  '''
+  재접속이 몰릴 때 접속마다 드는 admission control 비용. --messages 개의 접속이 --addresses 개의 IP 에서
+  1ms 간격으로 들어온다고 본다. --per_ip_accept_rate 가 0 이면 IP 별 bucket 비용을 재기 위해 1/s 로 둔다.
+  '''
+  addresses = [f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(FLAGS.addresses)]
+  order = [random.choice(addresses) for _ in range(FLAGS.messages)]
+  per_ip_rate = FLAGS.per_ip_accept_rate or 1
+  print(f'접속 {FLAGS.messages}개, IP {FLAGS.addresses}개, 전체 {FLAGS.accept_rate}/s, IP 별 {per_ip_rate}/s')
+
+  control = admission.AdmissionControl(FLAGS.accept_rate, FLAGS.accept_burst, per_ip_rate, FLAGS.per_ip_accept_burst, 0)
+  results = collections.Counter()
+  started = time.perf_counter()
+  for i, ip in enumerate(order):
+    now = i * 0.001
+    # select engine 처럼 전체 token 이 없으면 accept 하지 않는다.
+    if control.wait_time(now):
+      results['throttled'] += 1
+    else:
+      results[control.admit(ip, now) or 'accepted'] += 1
+  elapsed = time.perf_counter() - started
+
+  print(f'{FLAGS.messages / elapsed:10.0f} 접속/s (접속당 {elapsed / FLAGS.messages * 1e9:.0f}ns), '
+        f'IP 별 bucket {len(control.ip_buckets)}개, 결과 {dict(results)}')
+
+
+benchmarks = {
+  'recv_copy': bench_recv_copy,
+  'fanout': bench_fanout,
+  'drain': bench_drain,
+  'envelope': bench_envelope,
+  'codec': bench_codec,
+  'history': bench_history,
+  'chatlog': bench_chatlog,
+  'admission': bench_admission,
+}
+
+
+def main(argv):
+  benchmarks[FLAGS.case]()
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,308 @@
+'''
+대화방과 채팅을 디스크에 남기는 append-only 로그(write-ahead log).
+
+서버를 다시 시작해도 방 목록과 방마다 최근 채팅이 남도록 방 생성/삭제와 채팅을 기록한다.
+
+  - 기록은 segment 파일({번호:08d}.log)에 뒤로만 붙인다. segment 가 segment_size 를 넘으면
+    다음 번호의 파일로 넘어간다. 서버를 시작할 때마다 새 segment 를 연다.
+  - 작업 쓰레드는 큐에 넣기만 하고, 파일 쓰기와 fsync 는 전용 쓰레드가 한다. 그동안 쌓인
+    기록들을 한 번에 쓰고 fsync 도 한 번만 한다(group commit). commit_interval 이 있으면
+    그만큼 기다렸다가 모아서 쓴다.
+  - 디스크가 느려서 큐에 max_pending 개가 쌓이면 작업 쓰레드는 writer 가 큐를 비울 때까지
+    기다린다. 기록을 버리거나 메모리가 끝없이 늘어나는 대신 채팅 처리가 디스크 속도로 느려진다.
+  - 쓰기나 fsync 가 실패하면(ENOSPC, EIO 등) 그 뒤로는 기록하지 않고 on_failure() 를 부른다.
+    기다리던 작업 쓰레드들도 깨어나서 기록 없이 돌아간다.
+  - 방마다 최근 채팅 history_depth 개의 위치(segment, offset, 길이)만 메모리에 둔다.
+    채팅 내용은 필요할 때 segment 를 mmap 해서 읽는다.
+  - 시작할 때 모든 segment 를 mmap 으로 훑어서 살아 있는 방들과 위 index 를 다시 만든다.
+    마지막 segment 끝의 쓰다 만 기록(crash)은 잘라낸다.
+
+기록 형식: [payload 길이 4B][crc32 4B][종류 1B][방 번호 4B][payload]. 모두 network byte order 이고
+crc32 는 종류부터 payload 까지에 대한 값이다. 채팅 payload 는 serialize_messages() 한 결과들을
+4byte 길이와 함께 이어 붙인 것이다.
+'''
+import collections
+import enum
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import framing
+from log import logger
+
+
+class RecordKind(enum.IntEnum):
+    ROOM_CREATED = 1
+    ROOM_DESTROYED = 2
+    CHAT = 3
+
+
+# segment 파일 맨 앞. 채팅은 서버의 --format 으로 직렬화되어 있으므로 그것도 기록한다.
+SEGMENT_MAGIC = b'CHATLOG1'
+SEGMENT_FORMATS = ['json', 'protobuf']
+SEGMENT_HEADER_SIZE = len(SEGMENT_MAGIC) + 1
+
+RECORD_HEADER = struct.Struct('>IIBI')
+# crc32 를 계산하는 범위는 종류부터다.
+RECORD_CRC_OFFSET = 8
+
+
+def encode_record(kind: RecordKind, room_id: int, payload: bytes) -> bytes:
+    checked = struct.pack('>BI', kind, room_id) + payload
+    return struct.pack('>II', len(payload), zlib.crc32(checked)) + checked
+
+
+class ChatLog:
+    def __init__(self, directory: str, format_name: str, history_depth: int,
+                 segment_size: int = 64 * 1024 * 1024, commit_interval: float = 0, max_pending: int = 65536,
+                 on_failure=None):
+        self.directory = directory
+        self.format_name = format_name
+        self.history_depth = history_depth
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.max_pending = max(max_pending, 1)
+        self.on_failure = on_failure
+
+        # 방 번호 -> 최근 채팅들의 (segment 번호, payload offset, payload 길이)
+        self.index: dict[int, collections.deque[tuple[int, int, int]]] = {}
+        self.index_mutex = threading.Lock()
+        # segment 번호 -> 읽기용 mmap. 쓰고 있는 segment 는 커지므로 부족하면 다시 만든다.
+        self.maps: dict[int, mmap.mmap] = {}
+
+        # 작업 쓰레드들이 넣고 writer 쓰레드가 꺼내는 기록들. (종류, 방 번호, 인코딩된 기록)
+        self.pending: list[tuple[RecordKind, int, bytes]] = []
+        self.pending_mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.pending_mutex)
+        self.not_full = threading.Condition(self.pending_mutex)
+        self.closing = False
+        # writer 쓰레드가 쓰기에 실패해서 멈췄으면 True. 이때 closing 도 True 다.
+        self.failed = False
+        self.closed_event = threading.Event()
+
+        self.segment_no = 0
+        self.segment_file = None
+        self.writer: threading.Thread = None
+
+        # 모니터링용 수치
+        self.records_written = 0
+        self.bytes_written = 0
+        self.commits = 0
+        self.append_waits = 0
+
+    def segment_path(self, segment_no: int) -> str:
+        return os.path.join(self.directory, f'{segment_no:08d}.log')
+
+    def segment_numbers(self) -> list[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log') and name[:-4].isdigit())
+
+    def recover(self) -> tuple[dict[int, str], int]:
+        '''
+        segment 들을 훑어서 index 를 만들고, 삭제되지 않은 방들의 {방 번호: 방제} 와
+        지금까지 쓴 가장 큰 방 번호를 반환한다. start() 전에 부른다.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        rooms: dict[int, str] = {}
+        last_room_id = 0
+        segment_numbers = self.segment_numbers()
+        for segment_no in segment_numbers:
+            last_room_id = max(last_room_id, self.scan_segment(segment_no, rooms, segment_no == segment_numbers[-1]))
+        self.segment_no = segment_numbers[-1] if segment_numbers else 0
+
+        logger.info('Chat log: segment %d개에서 방 %d개 복구', len(segment_numbers), len(rooms))
+        return rooms, last_room_id
+
+    def scan_segment(self, segment_no: int, rooms: dict[int, str], is_last: bool) -> int:
+        path = self.segment_path(segment_no)
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < SEGMENT_HEADER_SIZE:
+                data = b''
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if data[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            logger.warning('Chat log: %s 는 chat log segment 가 아니므로 건너뜀', path)
+            return 0
+        # 다른 --format 으로 쓴 채팅은 보낼 수 없으므로 방 정보만 읽는다.
+        same_format = SEGMENT_FORMATS[data[len(SEGMENT_MAGIC)]] == self.format_name
+
+        last_room_id = 0
+        offset = SEGMENT_HEADER_SIZE
+        while offset < size:
+            if offset + RECORD_HEADER.size > size:
+                break
+            payload_size, crc, kind, room_id = RECORD_HEADER.unpack_from(data, offset)
+            payload_offset = offset + RECORD_HEADER.size
+            end = payload_offset + payload_size
+            if end > size or zlib.crc32(data[offset + RECORD_CRC_OFFSET:end]) != crc:
+                break
+
+            if kind == RecordKind.ROOM_CREATED:
+                rooms[room_id] = str(data[payload_offset:end], encoding='utf-8')
+                last_room_id = max(last_room_id, room_id)
+            elif kind == RecordKind.ROOM_DESTROYED:
+                rooms.pop(room_id, None)
+                self.index.pop(room_id, None)
+            elif kind == RecordKind.CHAT and same_format:
+                self.add_to_index(room_id, segment_no, payload_offset, payload_size)
+            offset = end
+
+        if offset < size:
+            if is_last:
+                # 쓰는 도중에 멈춘 기록이다. 다음 기록이 그 뒤에 붙지 않도록 잘라낸다.
+                logger.warning('Chat log: %s 의 %d바이트 이후의 불완전한 기록을 잘라냄', path, offset)
+                data.close()
+                os.truncate(path, offset)
+                return last_room_id
+            logger.warning('Chat log: %s 의 %d바이트 이후가 손상되어 읽지 않음', path, offset)
+
+        if same_format and data:
+            self.maps[segment_no] = data
+        elif data:
+            data.close()
+        return last_room_id
+
+    def add_to_index(self, room_id, segment_no, offset, size):
+        entries = self.index.get(room_id)
+        if entries is None:
+            entries = self.index[room_id] = collections.deque(maxlen=self.history_depth)
+        entries.append((segment_no, offset, size))
+
+    def start(self):
+        '''새 segment 를 열고 writer 쓰레드를 시작한다.'''
+        self.open_next_segment()
+        self.writer = threading.Thread(target=self.write_loop, name='chatlog', daemon=True)
+        self.writer.start()
+
+    def open_next_segment(self):
+        if self.segment_file:
+            self.segment_file.close()
+        self.segment_no += 1
+        self.segment_file = open(self.segment_path(self.segment_no), 'xb')
+        self.segment_file.write(SEGMENT_MAGIC + bytes([SEGMENT_FORMATS.index(self.format_name)]))
+        self.segment_offset = SEGMENT_HEADER_SIZE
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        # 새 파일이 directory 에도 남도록 한다.
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def append(self, kind: RecordKind, room_id: int, payload: bytes):
+        '''
+        기록을 큐에 넣기만 하고 반환한다. 디스크에 쓰는 일은 writer 쓰레드가 한다.
+        큐가 가득 차 있으면 writer 가 큐를 가져갈 때까지 기다린다.
+        '''
+        record = encode_record(kind, room_id, payload)
+        with self.pending_mutex:
+            if len(self.pending) >= self.max_pending and not self.closing:
+                self.append_waits += 1
+                while len(self.pending) >= self.max_pending and not self.closing:
+                    self.not_full.wait()
+            if self.closing:
+                return
+            self.pending.append((kind, room_id, record))
+            self.not_empty.notify()
+
+    def room_created(self, room_id: int, title: str):
+        self.append(RecordKind.ROOM_CREATED, room_id, title.encode('utf-8'))
+
+    def room_destroyed(self, room_id: int):
+        self.append(RecordKind.ROOM_DESTROYED, room_id, b'')
+
+    def chat(self, room_id: int, bodies: list[bytes]):
+        self.append(RecordKind.CHAT, room_id, framing.frame_bodies(bodies, framing.Framing.U32, 0xFFFFFFFF))
+
+    def write_loop(self):
+        try:
+            self.write_pending()
+        except Exception as err:
+            logger.exception('Chat log: 기록을 쓰지 못해서 더 이상 기록하지 않음: %s', err)
+            with self.pending_mutex:
+                self.failed = True
+                self.closing = True
+                self.pending = []
+                self.not_empty.notify_all()
+                self.not_full.notify_all()
+            if self.on_failure:
+                self.on_failure()
+
+    def write_pending(self):
+        while True:
+            with self.pending_mutex:
+                while not self.pending and not self.closing:
+                    self.not_empty.wait()
+                batch, self.pending = self.pending, []
+                closing = self.closing
+                self.not_full.notify_all()
+
+            if batch:
+                self.write_batch(batch)
+            if closing:
+                break
+            if self.commit_interval:
+                # 그동안 쌓이는 기록들을 다음 fsync 에 모은다. 종료할 때는 바로 깨어난다.
+                self.closed_event.wait(self.commit_interval)
+
+    def write_batch(self, batch: list[tuple[RecordKind, int, bytes]]):
+        if self.segment_offset >= self.segment_size:
+            self.open_next_segment()
+
+        # index 에는 fsync 가 끝난 채팅만 넣는다.
+        offsets = []
+        for _, _, record in batch:
+            offsets.append(self.segment_offset + RECORD_HEADER.size)
+            self.segment_offset += len(record)
+        data = b''.join(record for _, _, record in batch)
+        self.segment_file.write(data)
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+
+        self.records_written += len(batch)
+        self.bytes_written += len(data)
+        self.commits += 1
+
+        with self.index_mutex:
+            for (kind, room_id, record), offset in zip(batch, offsets):
+                if kind == RecordKind.CHAT:
+                    self.add_to_index(room_id, self.segment_no, offset, len(record) - RECORD_HEADER.size)
+                elif kind == RecordKind.ROOM_DESTROYED:
+                    self.index.pop(room_id, None)
+
+    def read_payload(self, segment_no: int, offset: int, size: int) -> bytes:
+        '''index_mutex 를 잡은 채로 부른다.'''
+        data = self.maps.get(segment_no)
+        if data is None or offset + size > len(data):
+            if data is not None:
+                data.close()
+            with open(self.segment_path(segment_no), 'rb') as f:
+                data = self.maps[segment_no] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return data[offset:offset + size]
+
+    def recent_chats(self, room_id: int) -> list[list[bytes]]:
+        '''방의 최근 채팅들을 serialize_messages() 결과의 list 로 반환한다.'''
+        with self.index_mutex:
+            entries = list(self.index.get(room_id, ()))
+            payloads = [self.read_payload(*entry) for entry in entries]
+        return [[bytes(body) for body in framing.split_frames(payload, framing.Framing.U32)] for payload in payloads]
+
+    def close(self):
+        '''남은 기록을 모두 쓰고 fsync 한 뒤 닫는다.'''
+        with self.pending_mutex:
+            self.closing = True
+            self.not_empty.notify()
+            self.not_full.notify_all()
+        self.closed_event.set()
+        if self.writer:
+            self.writer.join()
+        if self.segment_file:
+            self.segment_file.close()
+        with self.index_mutex:
+            for data in self.maps.values():
+                data.close()
+            self.maps.clear()
@@ -5,9 +5,11 @@ import json
 import select
 import socket
 import sys
+import time
 
 from absl import app, flags
 
+import framing
 import message_pb2 as pb
 
 
@@ -16,6 +18,9 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string(name='ip', default='127.0.0.1', help='서버 IP 주소')
 flags.DEFINE_integer(name='port', default=None, required=True, help='서버 port 번호')
 flags.DEFINE_enum(name='format', default='json', enum_values=['json', 'protobuf'], help='메시지 포맷')
+flags.DEFINE_bool(name='envelope', default=False, help='protobuf 메시지를 Type + 본문 두 개 대신 Envelope 하나로 주고받는다. 서버와 hello 를 주고받는다')
+flags.DEFINE_bool(name='heartbeat', default=False, help='서버가 보내는 SCPing 에 CSPong 으로 응답한다. 서버와 hello 를 주고받는다')
+flags.DEFINE_enum(name='framing', default='legacy', enum_values=['legacy', 'u32', 'varint'], help='메시지 길이 encoding 방식. legacy 가 아니면 접속 직후 서버와 hello 를 주고받는다')
 #flags.DEFINE_integer(name='verbosity', default=0, required=False, help='디버그용 로그 메시지 출력 정도. 0, 1, 2 가능')
 
 
@@ -51,16 +56,84 @@ def make_connection_to_server(ip, port):
   return sock
 
 
+# 서버와 합의한 메시지 길이 encoding 방식과 서버가 받을 수 있는 최대 메시지 크기
+wire_framing = framing.Framing.LEGACY
+server_max_frame_size = framing.LEGACY_MAX_FRAME_SIZE
+
+# protobuf 메시지를 Envelope 하나로 주고받기로 서버와 합의했는지 여부
+use_envelope = False
+
+# 서버와 맺은 TCP socket. SCPing 에 응답할 때 쓴다.
+server_sock = None
+
+
+def negotiate_framing(sock, requested, requested_flags):
+  '''
+  서버에 hello 를 보내고 hello ack 를 받아서 메시지 길이 encoding 방식과 envelope 사용 여부를 정한다.
+  hello 를 모르는 예전 서버라면 응답이 없으므로 timeout 후 종료한다.
+
+  :param sock: 서버와 맺은 TCP socket
+  :param requested: 사용할 framing.Framing
+  :param requested_flags: 사용하고 싶은 framing.HELLO_FLAG_* 의 조합
+  '''
+  global wire_framing
+  global server_max_frame_size
+  global use_envelope
+
+  sock.sendall(framing.make_hello(requested, requested_flags))
+
+  sock.settimeout(5)
+  ack = b''
+  try:
+    while len(ack) < framing.HELLO_ACK_SIZE:
+      received_buffer = sock.recv(framing.HELLO_ACK_SIZE - len(ack))
+      if not received_buffer:
+        raise SocketClosed()
+      ack += received_buffer
+  except socket.timeout:
+    print('서버가 hello 에 응답하지 않음. --framing=legacy 로 접속해야 됩니다.')
+    sys.exit(3)
+  sock.settimeout(None)
+
+  wire_framing, accepted_flags, server_max_frame_size = framing.parse_hello_ack(ack)
+  print(f'framing {wire_framing.name} 사용. 서버 최대 메시지 크기 {server_max_frame_size}바이트')
+
+  use_envelope = bool(accepted_flags & framing.HELLO_FLAG_ENVELOPE)
+  if requested_flags & framing.HELLO_FLAG_ENVELOPE and not use_envelope:
+    print('서버가 envelope 를 지원하지 않음. Type 과 본문을 따로 보냅니다.')
+  if requested_flags & framing.HELLO_FLAG_HEARTBEAT and not accepted_flags & framing.HELLO_FLAG_HEARTBEAT:
+    print('서버가 heartbeat 를 지원하지 않음.')
+
+
+def wrap_envelopes(messages):
+  '''
+  Type 과 본문이 짝지어진 protobuf 메시지 list 를 Envelope list 로 바꾼다.
+
+  :param messages: [pb.Type, 본문, pb.Type, 본문, ...]
+  :returns: pb.Envelope list
+  '''
+  envelopes = []
+  for type_message, body in zip(messages[0::2], messages[1::2]):
+    envelope = pb.Envelope()
+    field_name = pb.Type.MessageType.Name(type_message.type).lower()
+    getattr(envelope, field_name).CopyFrom(body)
+    envelopes.append(envelope)
+  return envelopes
+
+
 def send_messages_to_server(sock, messages):
   '''
   TCP socket 상으로 message 를 전송한다.
-  앞에 길이에 해당하는 2 byte 를 network byte order 로 전송한다.
+  앞에 길이를 서버와 합의한 방식으로 붙인다. 기본은 network byte order 2 byte 다.
 
   :param sock: 서버와 맺은 TCP socket
   :param messages: 전송할 message list.각 메시지는 dict type 이거나 protobuf type 이어야 한다.
   '''
   assert isinstance(messages, list)
 
+  if use_envelope:
+    messages = wrap_envelopes(messages)
+
   for msg in messages:
     msg_str = None
     if FLAGS.format == 'json':
@@ -73,10 +146,13 @@ def send_messages_to_server(sock, messages):
     # TCP 에서 send() 함수는 일부만 전송될 수도 있다.
     # 따라서 보내려는 데이터를 다 못 보낸 경우 재시도 해야된다.
     to_send = len(serialized)
-    to_send_big_endian = int.to_bytes(to_send, byteorder='big', length=2)
+    limit = framing.frame_limit(wire_framing, server_max_frame_size)
+    if to_send > limit:
+      print(f'메시지가 너무 커서 보낼 수 없음: {to_send}바이트 (최대 {limit}바이트)')
+      return
 
-    # 받는 쪽에서 어디까지 읽어야 되는지 message boundary 를 알 수 있게끔 2byte 길이를 추가한다.
-    serialized = to_send_big_endian + serialized
+    # 받는 쪽에서 어디까지 읽어야 되는지 message boundary 를 알 수 있게끔 길이를 추가한다.
+    serialized = framing.encode_header(wire_framing, to_send) + serialized
 
     if FLAGS.verbosity >= 1:
       print(f'[C->S:총길이={len(serialized)}바이트] 0x{to_send:04x}(메시지크기) {"+ " + msg_str if msg_str else ""}')
@@ -141,15 +217,29 @@ def on_cs_name(sock, argv):
 
 def on_cs_rooms(sock, argv):
   '''
-  서버에 방 목록을 요청한다.
+  서버에 방 목록을 요청한다. 서버는 한 번에 한 페이지만 보내므로 다음 페이지는 응답에 나온 cursor 로 요청한다.
 
   :param sock: 서버와 연결된 TCP socket
-  :param argv: 사용되지 않음
+  :param argv: 문자열 list. 숫자는 cursor 이고, 'summary' 가 있으면 멤버 이름 없이 멤버 수만 받는다
   '''
+  cursor = 0
+  summary = False
+  for arg in argv:
+    if arg == 'summary':
+      summary = True
+    else:
+      try:
+        cursor = int(arg)
+      except ValueError:
+        print('사용법: /rooms [cursor] [summary]')
+        return
+
   messages = []
   if FLAGS.format == 'json':
     message = {
       'type': 'CSRooms',
+      'cursor': cursor,
+      'summary': summary,
     }
     messages.append(message)
   else:
@@ -158,6 +248,8 @@ def on_cs_rooms(sock, argv):
     messages.append(message)
 
     message = pb.CSRooms()
+    message.cursor = cursor
+    message.summary = summary
     messages.append(message)
 
   send_messages_to_server(sock, messages)
@@ -312,12 +404,37 @@ def on_cs_shutdown(sock, argv):
     message.type = pb.Type.MessageType.CS_SHUTDOWN
     messages.append(message)
 
-    message = pb.CSLeaveRoom()
+    message = pb.CSShutdown()
     messages.append(message)
 
   send_messages_to_server(sock, messages)
 
 
+def make_ping_messages(type_name, nonce):
+  '''
+  CSPing 이나 CSPong 메시지를 만든다.
+
+  :param type_name: 'CSPing' 또는 'CSPong'
+  :param nonce: 응답에 그대로 돌아오는 값
+  '''
+  if FLAGS.format == 'json':
+    return [{'type': type_name, 'nonce': nonce}]
+
+  message = pb.Type()
+  message.type = pb.Type.MessageType.CS_PING if type_name == 'CSPing' else pb.Type.MessageType.CS_PONG
+  return [message, getattr(pb, type_name)(nonce=nonce)]
+
+
+def on_cs_ping(sock, argv):
+  '''
+  서버에 ping 을 보낸다. 응답이 오면 왕복 시간을 출력한다.
+
+  :param sock: 서버와 연결된 TCP socket
+  :param argv: 사용되지 않음
+  '''
+  send_messages_to_server(sock, make_ping_messages('CSPing', time.monotonic_ns()))
+
+
 def on_sc_rooms_result(message):
   '''
   /rooms 명령어에 대한 서버 처리 결과를 받는다.
@@ -326,21 +443,25 @@ def on_sc_rooms_result(message):
   '''
   print('---')
   print('[방목록]')
-  print('방ID | 방제목 | 멤버들')
+  print('방ID | 방제목 | 멤버수 | 멤버들')
   if FLAGS.format == 'json':
     rooms = message.get('rooms', [])
     if rooms:
       for room in rooms:
-        print(f"{room['roomId']} | {room['title']} | {','.join([str(name) for name in room['members']])}")
+        print(f"{room['roomId']} | {room['title']} | {room.get('memberCount', len(room['members']))} | {','.join([str(name) for name in room['members']])}")
     else:
       print("(없음)")
+    next_cursor = message.get('nextCursor', 0)
   else:
     rooms = message.rooms
     if rooms:
       for room in rooms:
-        print(f"{room.roomId} | {room.title} | {','.join([str(name) for name in room.members])}")
+        print(f"{room.roomId} | {room.title} | {room.memberCount if room.HasField('memberCount') else len(room.members)} | {','.join([str(name) for name in room.members])}")
     else:
       print("(없음)")
+    next_cursor = message.nextCursor
+  if next_cursor:
+    print(f'(다음 페이지: /rooms {next_cursor})')
   print('---')
 
 
@@ -368,32 +489,59 @@ def on_sc_system_message(message):
     print('[시스템 메시지]', message.text)
 
 
+def on_sc_ping(message):
+  '''
+  서버가 연결이 살아 있는지 확인하려고 보낸 SCPing 에 CSPong 으로 응답한다.
+
+  :param message: JSON 이거나 SCPing 의 객체
+  '''
+  nonce = message['nonce'] if FLAGS.format == 'json' else message.nonce
+  send_messages_to_server(server_sock, make_ping_messages('CSPong', nonce))
+
+
+def on_sc_pong(message):
+  '''
+  /ping 에 대한 응답을 받아서 왕복 시간을 출력한다.
+
+  :param message: JSON 이거나 SCPong 의 객체
+  '''
+  nonce = message['nonce'] if FLAGS.format == 'json' else message.nonce
+  print(f'[pong] {(time.monotonic_ns() - nonce) / 1e6:.2f}ms')
+
+
 command_handlers = {
   '/help': (on_help, '사용 가능 명령어를 나열한다.'),
   '/name': (on_cs_name, '채팅 이름을 지정한다.'),
-  '/rooms': (on_cs_rooms, '채팅 방 목록을 출력한다.'),
+  '/rooms': (on_cs_rooms, '채팅 방 목록을 출력한다. /rooms [cursor] [summary]'),
   '/create': (on_cs_create_room, '채팅 방을 만든다.'),
   '/join': (on_cs_join_room, '채팅 방에 들어간다.'),
   '/leave': (on_cs_leave_room, '채팅 방을 나간다.'),
   '/shutdown': (on_cs_shutdown, '채팅 서버를 종료한다.'),
+  '/ping': (on_cs_ping, '서버와의 왕복 시간을 잰다.'),
 }
 
 json_message_handlers = {
   'SCRoomsResult': on_sc_rooms_result,
   'SCChat': on_sc_chat,
   'SCSystemMessage': on_sc_system_message,
+  'SCPing': on_sc_ping,
+  'SCPong': on_sc_pong,
 }
 
 protobuf_message_handlers = {
   pb.Type.MessageType.SC_ROOMS_RESULT: on_sc_rooms_result,
   pb.Type.MessageType.SC_CHAT: on_sc_chat,
   pb.Type.MessageType.SC_SYSTEM_MESSAGE: on_sc_system_message,
+  pb.Type.MessageType.SC_PING: on_sc_ping,
+  pb.Type.MessageType.SC_PONG: on_sc_pong,
 }
 
 protobuf_message_parsers = {
   pb.Type.MessageType.SC_ROOMS_RESULT: pb.SCRoomsResult.FromString,
   pb.Type.MessageType.SC_CHAT: pb.SCChat.FromString,
   pb.Type.MessageType.SC_SYSTEM_MESSAGE: pb.SCSystemMessage.FromString,
+  pb.Type.MessageType.SC_PING: pb.SCPing.FromString,
+  pb.Type.MessageType.SC_PONG: pb.SCPong.FromString,
 }
 
 
@@ -433,10 +581,13 @@ def process_stdin(sock):
 
 
 # TCP socket 으로부터 현재 읽고 있는 메시지의 크기
-# 각 메시지 앞에 newtork byte 로 encoding 한 2byte 정수 크기를 저장해 두는데 그 값에 해당된다.
+# 각 메시지 앞에 wire_framing 방식으로 encoding 한 정수 크기를 저장해 두는데 그 값에 해당된다.
 # 아직 그 정보를 얻지 못했다면 None 을 저장한다.
 current_message_len = None
 
+# 현재 읽고 있는 메시지의 길이 부분 크기
+current_header_len = None
+
 
 # 메시지 디코딩할 수 있는 만큼의 data 가 없는 경우 임시 저장하는 공간
 socket_buffer = None
@@ -454,6 +605,7 @@ def process_socket(sock):
   :param sock: 서버와의 TCP 연결 소켓
   '''
   global current_message_len
+  global current_header_len
   global socket_buffer
   global current_protobuf_type
 
@@ -478,12 +630,13 @@ def process_socket(sock):
   while True:
     # 아직 읽어야될 길이 정보를 모른다면 이번 라운드는 스킵한다.
     if current_message_len is None:
-      if len(socket_buffer) < 2:
+      header = framing.parse_header(socket_buffer, 0, len(socket_buffer), wire_framing)
+      if not header:
         return
 
       # 읽어야 될 길이를 확인했다.
-      current_message_len = int.from_bytes(socket_buffer[0:2], byteorder='big')
-      socket_buffer = socket_buffer[2:]
+      current_header_len, current_message_len = header
+      socket_buffer = socket_buffer[current_header_len:]
 
     # 현재 가지고 있는 데이터가 메시지를 decoding 하기에 충분하지 않다면 다음을 기약한다.
     if len(socket_buffer) < current_message_len:
@@ -497,7 +650,7 @@ def process_socket(sock):
     # JSON 은 그 자체로 바로 처리 가능하다.
     if FLAGS.format == 'json':
       if FLAGS.verbosity >= 1:
-        print(f'[S->C:총길이={len(serialized) + 2}바이트] 0x{len(serialized):04x}(메시지크기) + {serialized.decode("utf-8")}')
+        print(f'[S->C:총길이={len(serialized) + current_header_len}바이트] 0x{len(serialized):04x}(메시지크기) + {serialized.decode("utf-8")}')
 
       msg = json.loads(serialized)
       # 'type' 이라는 field 가 있어야 한다.
@@ -510,13 +663,29 @@ def process_socket(sock):
         json_message_handlers[msg_type](msg)
       else:
         raise UnknownTypeInMessage(msg_type)
+    elif use_envelope:
+      # Envelope 에는 type 과 본문이 함께 들어 있다.
+      msg = pb.Envelope.FromString(serialized)
+      if FLAGS.verbosity >= 1:
+        str_msg = str(msg).strip()
+        print(f'[S->C:총길이={len(serialized) + current_header_len}바이트] 0x{len(serialized):04x}(메시지크기) + {str_msg}')
+
+      body_name = msg.WhichOneof('body')
+      if not body_name:
+        raise NoTypeFieldInMessage()
+
+      message_type = pb.Type.MessageType.Value(body_name.upper())
+      if message_type in protobuf_message_handlers:
+        protobuf_message_handlers[message_type](getattr(msg, body_name))
+      else:
+        raise UnknownTypeInMessage(message_type)
     else:
       # 현재 type 을 모르는 상태다. 먼저 TypeMessage 를 복구한다.
       if current_protobuf_type is None:
         msg = pb.Type.FromString(serialized)
         if FLAGS.verbosity >= 1:
           str_msg = str(msg).strip()
-          print(f'[S->C:총길이={len(serialized) + 2}바이트] 0x{len(serialized):04x}(메시지크기) + {str_msg}')
+          print(f'[S->C:총길이={len(serialized) + current_header_len}바이트] 0x{len(serialized):04x}(메시지크기) + {str_msg}')
         if msg.type in protobuf_message_parsers and msg.type in protobuf_message_handlers:
           current_protobuf_type = msg.type
         else:
@@ -526,7 +695,7 @@ def process_socket(sock):
         msg = protobuf_message_parsers[current_protobuf_type](serialized)
         if FLAGS.verbosity >= 1:
           str_msg = str(msg).strip()
-          print(f'[S->C:총길이={len(serialized) + 2}바이트] 0x{len(serialized):04x}(메시지크기) {"+ " + str_msg if str_msg else ""}')
+          print(f'[S->C:총길이={len(serialized) + current_header_len}바이트] 0x{len(serialized):04x}(메시지크기) {"+ " + str_msg if str_msg else ""}')
 
         # type 에 따른 message handler 를 찾아서 호출한다.
         try:
@@ -553,7 +722,13 @@ def main(argv):
     # 에러 케이스에 따라 서로 다른 에러코드를 사용할 수도 있다.
     sys.exit(2)
 
-  sock = make_connection_to_server(FLAGS.ip, FLAGS.port)
+  global server_sock
+  server_sock = sock = make_connection_to_server(FLAGS.ip, FLAGS.port)
+  hello_flags = framing.HELLO_FLAG_ENVELOPE if FLAGS.envelope and FLAGS.format == 'protobuf' else 0
+  if FLAGS.heartbeat:
+    hello_flags |= framing.HELLO_FLAG_HEARTBEAT
+  if FLAGS.framing != 'legacy' or hello_flags:
+    negotiate_framing(sock, framing.Framing[FLAGS.framing.upper()], hello_flags)
 
   # 종료에 관련된 입력이 들어올 때까지 반복한다.
   while True:
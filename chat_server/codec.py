@@ -0,0 +1,194 @@
+'''
+클라이언트 메시지의 decode/encode.
+
+JSON 메시지는 받는 순간 타입별 스키마로 검사해서, 필드를 속성으로 읽을 수 있는 객체로 만든다.
+그래서 handler 는 JSON 과 protobuf 를 구별하지 않고 message.text 처럼 읽을 수 있다.
+
+JSON 구현은 설치된 것 중에서 고른다.
+  - msgspec: 타입별 Struct 로 decode 와 검사를 한 번에 한다.
+  - orjson: dict 로 decode 한 뒤 스키마를 검사한다.
+  - json: 표준 라이브러리. 항상 사용할 수 있다.
+'''
+import collections
+import json
+from typing import Union
+
+from google.protobuf.message import DecodeError
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class InvalidMessage(RuntimeError):
+    pass
+
+
+class NoTypeFieldInMessage(InvalidMessage):
+    pass
+
+
+class UnknownTypeInMessage(InvalidMessage):
+    def __init__(self, _type):
+        self.type = _type
+
+    def __str__(self):
+        return str(self.type)
+
+
+# 클라이언트가 보내는 JSON 메시지의 타입별 필드와 값의 타입
+CLIENT_MESSAGE_FIELDS = {
+    'CSName': {'name': str},
+    'CSRooms': {'cursor': int, 'limit': int, 'summary': bool},
+    'CSCreateRoom': {'title': str},
+    'CSJoinRoom': {'roomId': int},
+    'CSLeaveRoom': {},
+    'CSChat': {'text': str},
+    'CSShutdown': {},
+    'CSPing': {'nonce': int},
+    'CSPong': {'nonce': int},
+}
+
+# 생략할 수 있는 필드의 기본값. 필드가 늘어난 메시지를 예전 클라이언트가 보내도 받을 수 있게 한다.
+# 기본값이 있는 필드는 CLIENT_MESSAGE_FIELDS 에서 필수 필드들 뒤에 둔다.
+CLIENT_MESSAGE_DEFAULTS = {
+    'CSRooms': {'cursor': 0, 'limit': 0, 'summary': False},
+}
+
+
+class JsonCodec:
+    '''
+    decode() 는 (메시지 타입, 검사가 끝난 메시지 객체) 를 반환하고, 잘못된 메시지면
+    InvalidMessage 를 던진다. encode() 는 dict 를 UTF-8 bytes 로 만든다.
+    '''
+    name = 'json'
+
+    def __init__(self):
+        self.message_classes = {
+            type_name: collections.namedtuple(type_name, fields, defaults=CLIENT_MESSAGE_DEFAULTS.get(type_name, {}).values())
+            for type_name, fields in CLIENT_MESSAGE_FIELDS.items()
+        }
+
+    def loads(self, data):
+        # json.loads() 는 memoryview 를 받지 않으므로 bytes 로 복사하지 않고 바로 문자열로 decode 한다.
+        try:
+            return json.loads(str(data, encoding='utf-8'))
+        except ValueError as err:
+            raise InvalidMessage(f'JSON 이 아님: {err}')
+
+    def encode(self, msg) -> bytes:
+        return json.dumps(msg).encode('utf-8')
+
+    def decode(self, data):
+        msg = self.loads(data)
+        if not isinstance(msg, dict):
+            raise InvalidMessage('JSON object 가 아님')
+
+        type_name = msg.get('type', None)
+        if not type_name:
+            raise NoTypeFieldInMessage()
+        if not isinstance(type_name, str):
+            raise InvalidMessage(f'type 은 str 이어야 함: {type_name!r}')
+        fields = CLIENT_MESSAGE_FIELDS.get(type_name)
+        if fields is None:
+            raise UnknownTypeInMessage(type_name)
+
+        values = []
+        defaults = CLIENT_MESSAGE_DEFAULTS.get(type_name, {})
+        for field, field_type in fields.items():
+            if field not in msg and field in defaults:
+                values.append(defaults[field])
+                continue
+            value = msg.get(field)
+            # bool 은 int 의 하위 타입이지만 숫자 필드에 허용하지 않는다.
+            if not isinstance(value, field_type) or (isinstance(value, bool) and field_type is not bool):
+                raise InvalidMessage(f'{type_name}.{field} 는 {field_type.__name__} 이어야 함: {value!r}')
+            values.append(value)
+        return type_name, self.message_classes[type_name](*values)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def loads(self, data):
+        # orjson 은 memoryview 를 그대로 받는다.
+        try:
+            return orjson.loads(data)
+        except ValueError as err:
+            raise InvalidMessage(f'JSON 이 아님: {err}')
+
+    def encode(self, msg) -> bytes:
+        return orjson.dumps(msg)
+
+
+class MsgspecCodec(JsonCodec):
+    '''
+    타입 필드를 tag 로 쓰는 Struct 들의 union 으로 decode 하므로 dict 를 만들지 않는다.
+    '''
+    name = 'msgspec'
+
+    def __init__(self):
+        self.message_classes = {
+            type_name: msgspec.defstruct(type_name, self.struct_fields(type_name, fields), tag=type_name, tag_field='type')
+            for type_name, fields in CLIENT_MESSAGE_FIELDS.items()
+        }
+        self.decoder = msgspec.json.Decoder(Union[tuple(self.message_classes.values())])
+        self.any_decoder = msgspec.json.Decoder()
+        self.encoder = msgspec.json.Encoder()
+
+    @staticmethod
+    def struct_fields(type_name, fields):
+        defaults = CLIENT_MESSAGE_DEFAULTS.get(type_name, {})
+        return [(field, field_type, defaults[field]) if field in defaults else (field, field_type)
+                for field, field_type in fields.items()]
+
+    def loads(self, data):
+        try:
+            return self.any_decoder.decode(data)
+        except (msgspec.DecodeError, ValueError) as err:
+            raise InvalidMessage(f'JSON 이 아님: {err}')
+
+    def encode(self, msg) -> bytes:
+        return self.encoder.encode(msg)
+
+    def decode(self, data):
+        try:
+            msg = self.decoder.decode(data)
+        except (msgspec.DecodeError, ValueError):
+            # 어떤 검사에 실패했는지는 dict 로 다시 decode 해서 알려준다. 오류일 때만 거치는 경로다.
+            return super().decode(data)
+        return type(msg).__name__, msg
+
+
+json_codecs = {
+    'msgspec': MsgspecCodec if msgspec else None,
+    'orjson': OrjsonCodec if orjson else None,
+    'json': JsonCodec,
+}
+
+
+def make_json_codec(name: str = 'auto') -> JsonCodec:
+    '''
+    name 에 해당하는 JSON codec 을 만든다. auto 면 설치된 것 중 가장 빠른 것을 쓴다.
+    설치되지 않은 구현을 지정하면 ValueError 를 던진다.
+    '''
+    if name == 'auto':
+        name = next(codec_name for codec_name, codec_class in json_codecs.items() if codec_class)
+    codec_class = json_codecs.get(name)
+    if not codec_class:
+        raise ValueError(f'{name} 를 사용할 수 없습니다.')
+    return codec_class()
+
+
+def parse_protobuf(parser, serialized):
+    '''protobuf 의 DecodeError 를 InvalidMessage 로 바꿔서 작업 쓰레드가 접속만 끊게 한다.'''
+    try:
+        return parser(serialized)
+    except DecodeError as err:
+        raise InvalidMessage(f'protobuf 메시지가 아님: {err}')
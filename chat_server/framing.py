@@ -0,0 +1,267 @@
+'''
+TCP 스트림 위의 길이 prefix 메시지 framing.
+
+기본(LEGACY)은 각 메시지 앞에 network byte order 로 encoding 한 2byte 길이가 붙는다.
+64KiB 보다 큰 메시지를 주고받으려면 클라이언트가 접속 직후 hello 를 보내서 다른 방식을 고른다.
+
+  hello:     HELLO_MAGIC + framing(1byte) + flags(1byte, HELLO_FLAG_* 의 조합)
+  hello ack: HELLO_MAGIC + framing(1byte) + flags(1byte) + 서버의 최대 메시지 크기(4byte)
+
+HELLO_MAGIC 은 빈 메시지의 길이(0x0000) 뒤에 0xff 로 시작하는 길이가 이어지는 모양이다.
+legacy 클라이언트가 보낸 빈 메시지 다음에는 0xff?? 길이의 메시지가 올 수 있지만, 그 본문은
+'CHAT' 의 나머지인 'HAT' 으로 시작하는 JSON 이나 protobuf 가 될 수 없으므로 구별된다.
+'''
+import enum
+import socket
+import struct
+
+
+class FramingError(RuntimeError):
+    pass
+
+
+class FrameTooLarge(FramingError):
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+
+    def __str__(self):
+        return f'메시지 크기 {self.size}바이트가 최대 크기 {self.limit}바이트를 넘음'
+
+
+class InvalidHello(FramingError):
+    pass
+
+
+class Framing(enum.IntEnum):
+    # 2byte big endian 길이
+    LEGACY = 0
+    # 4byte big endian 길이
+    U32 = 1
+    # LEB128 varint 길이. 작은 메시지는 1byte 로 충분하다.
+    VARINT = 2
+
+
+HELLO_MAGIC = b'\x00\x00\xffCHAT'
+HELLO_SIZE = len(HELLO_MAGIC) + 2
+HELLO_ACK_SIZE = HELLO_SIZE + 4
+
+# protobuf 메시지를 Type + 본문 두 frame 대신 pb.Envelope 한 frame 으로 주고받는다.
+HELLO_FLAG_ENVELOPE = 0x01
+# 클라이언트가 서버의 SCPing 에 CSPong 으로 응답한다.
+HELLO_FLAG_HEARTBEAT = 0x02
+
+LEGACY_MAX_FRAME_SIZE = 0xFFFF
+
+# varint 길이는 최대 5byte (35bit) 까지만 허용한다.
+MAX_VARINT_SIZE = 5
+
+
+def make_hello(framing: Framing, flags: int = 0) -> bytes:
+    return HELLO_MAGIC + bytes([framing, flags])
+
+
+def make_hello_ack(framing: Framing, flags: int, max_frame_size: int) -> bytes:
+    return HELLO_MAGIC + bytes([framing, flags]) + struct.pack('>I', max_frame_size)
+
+
+def parse_hello_ack(data: bytes) -> tuple[Framing, int, int]:
+    '''hello ack 를 (framing, flags, 서버의 최대 메시지 크기) 로 돌려준다.'''
+    if len(data) != HELLO_ACK_SIZE or not data.startswith(HELLO_MAGIC):
+        raise InvalidHello('hello ack 가 아님')
+    framing, flags = data[len(HELLO_MAGIC)], data[len(HELLO_MAGIC) + 1]
+    max_frame_size = struct.unpack_from('>I', data, HELLO_SIZE)[0]
+    try:
+        return Framing(framing), flags, max_frame_size
+    except ValueError:
+        raise InvalidHello(f'알 수 없는 framing: {framing}')
+
+
+def frame_limit(framing: Framing, max_frame_size: int) -> int:
+    '''framing 과 설정된 최대 크기를 함께 고려한 메시지 최대 크기'''
+    if framing == Framing.LEGACY:
+        return min(max_frame_size, LEGACY_MAX_FRAME_SIZE)
+    return max_frame_size
+
+
+def encode_varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_header(framing: Framing, size: int) -> bytes:
+    if framing == Framing.LEGACY:
+        return struct.pack('>H', size)
+    if framing == Framing.U32:
+        return struct.pack('>I', size)
+    return encode_varint(size)
+
+
+def frame_bodies(bodies: list[bytes], framing: Framing, max_frame_size: int) -> bytes:
+    '''
+    직렬화된 메시지들 앞에 길이를 붙여서 하나의 bytes 로 만든다.
+    하나라도 최대 크기를 넘으면 FrameTooLarge 를 던진다.
+    '''
+    limit = frame_limit(framing, max_frame_size)
+    frames = []
+    for body in bodies:
+        if len(body) > limit:
+            raise FrameTooLarge(len(body), limit)
+        frames.append(encode_header(framing, len(body)))
+        frames.append(body)
+    return b''.join(frames)
+
+
+def parse_header(buffer, offset: int, end: int, framing: Framing) -> tuple[int, int] | None:
+    '''
+    buffer[offset:end] 의 맨 앞에 있는 길이를 읽어서 (길이 부분의 크기, 메시지 크기) 를 돌려준다.
+    길이를 다 받지 못했으면 None
+    '''
+    if framing == Framing.LEGACY:
+        if end - offset < 2:
+            return None
+        return 2, struct.unpack_from('>H', buffer, offset)[0]
+
+    if framing == Framing.U32:
+        if end - offset < 4:
+            return None
+        return 4, struct.unpack_from('>I', buffer, offset)[0]
+
+    size = 0
+    for i in range(min(end - offset, MAX_VARINT_SIZE)):
+        byte = buffer[offset + i]
+        size |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return i + 1, size
+    if end - offset >= MAX_VARINT_SIZE:
+        raise FramingError('varint 길이가 너무 김')
+    return None
+
+
+def split_frames(data: bytes, framing: Framing) -> list[memoryview]:
+    '''frame_bodies() 의 반대. 완성된 메시지만 들어 있는 bytes 를 메시지들로 나눈다.'''
+    view = memoryview(data)
+    frames = []
+    offset = 0
+    while offset < len(data):
+        header_size, message_len = parse_header(data, offset, len(data), framing)
+        offset += header_size
+        frames.append(view[offset:offset + message_len])
+        offset += message_len
+    return frames
+
+
+class ReceiveBuffer:
+    '''
+    recv_into() 로 직접 채우는 수신 버퍼.
+
+    받은 데이터를 bytes 로 이어 붙이거나 잘라내지 않고, 하나의 bytearray 안에서
+    읽을 위치(start)와 받은 데이터의 끝(end)만 옮긴다.
+
+    메시지는 연속된 메모리여야 하므로 끝을 감아 도는 ring 대신, 뒤쪽 여유 공간이 부족할
+    때만 남은 데이터를 앞으로 당겨온다(compaction).
+    '''
+    def __init__(self, capacity: int = 65536, max_frame_size: int = LEGACY_MAX_FRAME_SIZE):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # 받는 메시지의 길이 encoding 방식. read_hello() 로 바뀔 수 있다.
+        self.framing = Framing.LEGACY
+        # 이보다 큰 메시지의 길이를 받으면 본문을 기다리지 않고 FrameTooLarge 를 던진다.
+        self.max_frame_size = max_frame_size
+        # compaction/확장과 next_frames() 때문에 복사한 누적 바이트 수
+        self.bytes_copied = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def recv_into(self, sock: socket.socket, max_bytes: int = 65536) -> int:
+        self.reserve(max_bytes)
+        num_received = sock.recv_into(self.view[self.end:self.end + max_bytes])
+        self.end += num_received
+        return num_received
+
+    def feed(self, data: bytes):
+        '''소켓 대신 다른 곳(asyncio stream 등)에서 받은 데이터를 추가한다.'''
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def read_hello(self) -> tuple[Framing, int] | bool | None:
+        '''
+        접속 직후 받은 데이터에서 hello 를 찾는다.
+        판단할 만큼 받지 못했으면 None, hello 가 없는 legacy 클라이언트면 False,
+        hello 가 있으면 그 부분을 소비하고 framing 을 바꾼 뒤 (framing, flags) 를 돌려준다.
+        '''
+        pending = self.view[self.start:self.end]
+        compared = min(len(pending), len(HELLO_MAGIC))
+        if pending[:compared] != HELLO_MAGIC[:compared]:
+            return False
+        if len(pending) < HELLO_SIZE:
+            return None
+
+        framing, flags = pending[len(HELLO_MAGIC)], pending[len(HELLO_MAGIC) + 1]
+        try:
+            self.framing = Framing(framing)
+        except ValueError:
+            raise InvalidHello(f'알 수 없는 framing: {framing}')
+        self.start += HELLO_SIZE
+        return self.framing, flags
+
+    def reserve(self, size: int):
+        if len(self.buffer) - self.end >= size:
+            return
+
+        pending = self.end - self.start
+        if pending + size > len(self.buffer):
+            # 남은 데이터와 새로 받을 데이터를 담을 수 없다면 버퍼를 키운다.
+            buffer = bytearray(max(len(self.buffer) * 2, pending + size))
+            buffer[0:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[0:pending] = self.view[self.start:self.end]
+
+        self.bytes_copied += pending
+        self.start = 0
+        self.end = pending
+
+    def next_frames(self) -> list[memoryview]:
+        '''
+        완성된 메시지들을 모두 잘라내서 본문의 memoryview 들로 돌려준다.
+
+        길이 prefix 는 버퍼 안에서 바로 읽는다. 메시지들이 차지하는 구간은 bytes 로 한 번만
+        복사하고 각 메시지는 그 bytes 를 가리키므로, 돌려준 값은 이후 recv_into() 와
+        상관없이 다른 쓰레드에서 써도 된다.
+        '''
+        limit = frame_limit(self.framing, self.max_frame_size)
+        frames = []
+        offset = self.start
+        while True:
+            header = parse_header(self.buffer, offset, self.end, self.framing)
+            if not header:
+                break
+            header_size, message_len = header
+            if message_len > limit:
+                raise FrameTooLarge(message_len, limit)
+            if self.end - offset - header_size < message_len:
+                break
+            frames.append((offset + header_size - self.start, message_len))
+            offset += header_size + message_len
+
+        if not frames:
+            return []
+
+        batch = memoryview(bytes(self.view[self.start:offset]))
+        self.bytes_copied += offset - self.start
+        self.start = offset
+        if self.start == self.end:
+            # 남은 데이터가 없다면 복사 없이 맨 앞부터 다시 쓴다.
+            self.start = self.end = 0
+
+        return [batch[frame_start:frame_start + message_len] for frame_start, message_len in frames]
@@ -0,0 +1,107 @@
+'''
+무중단 재시작을 위해 listen 중인 소켓을 새 서버 프로세스에 넘긴다.
+
+  - --handoff_path 로 시작한 서버는 그 경로의 Unix domain socket 에서 다음 서버를 기다린다.
+  - 같은 경로로 새 서버를 시작하면 먼저 그 socket 에 접속해서 listen 소켓의 fd 를 SCM_RIGHTS 로
+    넘겨받는다. 두 프로세스가 커널의 같은 accept 큐를 쓰므로 넘기는 동안 새 접속이 거절되지 않는다.
+  - 넘겨준 서버는 더 이상 accept 하지 않고 기존 연결들을 drain 한 뒤 종료한다. handoff 연결은
+    종료할 때 닫히므로, 새 서버는 한 프로세스만 써야 하는 자원(chat log 등)을 그때까지 기다릴 수 있다.
+'''
+import os
+import socket
+import threading
+
+from log import logger
+
+
+HANDOFF_MESSAGE = b'LISTEN'
+
+
+def take_over(path: str) -> tuple[socket.socket, socket.socket] | None:
+    '''
+    path 에서 기다리는 이전 서버가 있으면 listen 소켓을 넘겨받아 (listen 소켓, 이전 서버와의 연결) 을
+    반환한다. 이전 서버가 없으면 None
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+
+    message, fds, _, _ = socket.recv_fds(conn, len(HANDOFF_MESSAGE), 1)
+    if message != HANDOFF_MESSAGE or not fds:
+        conn.close()
+        raise RuntimeError(f'{path} 의 서버에게서 listen 소켓을 받지 못함')
+    logger.info('Handoff: 이전 서버에게서 listen 소켓을 넘겨받음')
+    return socket.socket(fileno=fds[0]), conn
+
+
+def wait_for_exit(conn: socket.socket):
+    '''이전 서버가 종료해서 handoff 연결이 닫힐 때까지 기다린다.'''
+    while conn.recv(1):
+        pass
+    conn.close()
+
+
+class HandoffListener:
+    '''
+    다음 서버를 기다렸다가 server_sock 을 넘기고 on_handoff() 를 부른다. 한 번만 넘긴다.
+    on_handoff() 는 전용 쓰레드에서 호출된다.
+    '''
+    def __init__(self, path: str, server_sock: socket.socket, on_handoff):
+        self.path = path
+        self.server_sock = server_sock
+        self.on_handoff = on_handoff
+        self.listener: socket.socket = None
+        # 다음 서버와의 연결. 이 프로세스가 끝날 때 닫아서 종료를 알린다.
+        self.conn: socket.socket = None
+        self.handed_off = False
+
+    def start(self):
+        # 살아 있는 서버의 socket 이었다면 take_over() 가 이미 넘겨받았으므로 남은 파일은 지워도 된다.
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(1)
+        threading.Thread(target=self.accept_loop, name='handoff', daemon=True).start()
+        logger.info('Handoff: %s 에서 다음 서버를 기다리는 중', self.path)
+
+    def accept_loop(self):
+        try:
+            conn, _ = self.listener.accept()
+        except OSError:
+            # close() 로 listener 가 닫혔다.
+            return
+
+        try:
+            socket.send_fds(conn, [HANDOFF_MESSAGE], [self.server_sock.fileno()])
+        except OSError as err:
+            logger.warning('Handoff: listen 소켓을 넘기지 못함: %s', err)
+            conn.close()
+            return
+
+        # path 는 이제 다음 서버의 것이므로 close() 에서 지우지 않는다.
+        self.conn = conn
+        self.handed_off = True
+        self.listener.close()
+        logger.info('Handoff: 다음 서버에게 listen 소켓을 넘김')
+        self.on_handoff()
+
+    def close(self):
+        if not self.handed_off and self.listener:
+            try:
+                # accept() 에서 기다리는 쓰레드를 깨운다.
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        if self.conn:
+            self.conn.close()
@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+'''
+chat_server 부하 생성기.
+
+여러 연결을 열어서 방을 만들고 들어간 뒤, 모든 연결이 정해진 속도로 CSChat 을 보낸다.
+각 채팅 본문 앞에 보낸 시각을 넣어 두고, 같은 방의 다른 멤버가 SCChat 을 받은 시각과의 차이로
+전달 지연 시간을 잰다. 서버 주소와 메시지 포맷, framing 관련 flag 는 client.py 의 것을 그대로 쓴다.
+
+사용 예:
+  python3 loadgen.py --port=9000 --connections=1000 --rooms=50 --rate=5000 --duration=30
+  python3 loadgen.py --port=9000 --format=protobuf --envelope --framing=varint --processes=4
+
+지연 시간은 time.time_ns() 로 재므로 서버와 같은 호스트이거나 시계가 맞춰진 호스트에서 실행해야 된다.
+'''
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import random
+import time
+
+from absl import app, flags
+
+import client
+import framing
+from framing import Framing, ReceiveBuffer
+import message_pb2 as pb
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('connections', 100, help='열 연결 수')
+flags.DEFINE_integer('rooms', 10, help='만들 방 수. 연결들은 방마다 고르게 나눠서 들어간다')
+flags.DEFINE_float('rate', 1000, help='모든 연결이 합쳐서 1초에 보낼 CSChat 수')
+flags.DEFINE_float('duration', 10, help='채팅을 보내는 시간(초)')
+flags.DEFINE_float('warmup', 1, help='통계에서 제외할 처음 구간(초)')
+flags.DEFINE_float('grace', 2, help='보내기를 멈춘 뒤 아직 도착하지 않은 메시지를 기다리는 시간(초)')
+flags.DEFINE_integer('message_size', 100, help='채팅 본문 크기(바이트)')
+flags.DEFINE_float('connect_rate', 500, help='1초에 새로 여는 연결 수')
+flags.DEFINE_integer('processes', 1, help='부하 생성 프로세스 수. 연결과 방을 나눠서 맡는다')
+
+
+class LoadConnection:
+  '''
+  부하 생성용 연결 하나. 받은 SCChat 은 지연 시간 통계에 넣고, 나머지 응답은 replies 큐에 넣는다.
+  '''
+  def __init__(self, index, stats):
+    self.index = index
+    self.stats = stats
+    self.reader: asyncio.StreamReader = None
+    self.writer: asyncio.StreamWriter = None
+    self.framing = Framing.LEGACY
+    self.envelope = False
+    self.max_frame_size = framing.LEGACY_MAX_FRAME_SIZE
+    self.socket_buffer = ReceiveBuffer()
+    self.current_protobuf_type = None
+    self.replies: asyncio.Queue = asyncio.Queue()
+    self.read_task: asyncio.Task = None
+
+  async def connect(self):
+    '''
+    서버에 접속하고, legacy 가 아닌 framing 이나 envelope 를 쓰면 hello 를 주고받는다.
+    '''
+    self.reader, self.writer = await asyncio.open_connection(FLAGS.ip, FLAGS.port)
+
+    hello_flags = framing.HELLO_FLAG_ENVELOPE if FLAGS.envelope and FLAGS.format == 'protobuf' else 0
+    if FLAGS.framing != 'legacy' or hello_flags:
+      self.writer.write(framing.make_hello(Framing[FLAGS.framing.upper()], hello_flags))
+      ack = await self.reader.readexactly(framing.HELLO_ACK_SIZE)
+      self.framing, accepted_flags, self.max_frame_size = framing.parse_hello_ack(ack)
+      self.envelope = bool(accepted_flags & framing.HELLO_FLAG_ENVELOPE)
+
+    self.socket_buffer.framing = self.framing
+    self.socket_buffer.max_frame_size = self.max_frame_size
+    self.read_task = asyncio.create_task(self.read_loop())
+
+  def send(self, message_type, **fields):
+    '''
+    :param message_type: JSON 의 type 값(CSChat 등). protobuf 면 같은 이름의 메시지를 만든다.
+    :param fields: 메시지 필드
+    '''
+    if FLAGS.format == 'json':
+      bodies = [json.dumps(dict(type=message_type, **fields)).encode('utf-8')]
+    else:
+      body = getattr(pb, message_type)(**fields)
+      messages = [pb.Type(type=protobuf_message_types[message_type]), body]
+      if self.envelope:
+        messages = client.wrap_envelopes(messages)
+      bodies = [msg.SerializeToString() for msg in messages]
+    self.writer.write(framing.frame_bodies(bodies, self.framing, self.max_frame_size))
+
+  async def request(self, message_type, **fields):
+    '''메시지를 보내고 채팅이 아닌 첫 응답을 기다린다.'''
+    self.send(message_type, **fields)
+    return await self.replies.get()
+
+  async def read_loop(self):
+    try:
+      while True:
+        data = await self.reader.read(65536)
+        if not data:
+          break
+        self.socket_buffer.feed(data)
+        for serialized in self.socket_buffer.next_frames():
+          self.on_frame(serialized)
+    except (ConnectionError, framing.FramingError):
+      pass
+    self.stats.disconnects += 1
+
+  def on_frame(self, serialized):
+    if FLAGS.format == 'json':
+      msg = json.loads(str(serialized, encoding='utf-8'))
+      message_type, message = msg['type'], msg
+      text = msg.get('text')
+    elif self.envelope:
+      msg = pb.Envelope.FromString(serialized)
+      body_name = msg.WhichOneof('body')
+      message = getattr(msg, body_name)
+      message_type = type(message).DESCRIPTOR.name
+      text = getattr(message, 'text', None)
+    elif self.current_protobuf_type is None:
+      self.current_protobuf_type = pb.Type.FromString(serialized).type
+      return
+    else:
+      message = protobuf_message_parsers[self.current_protobuf_type](serialized)
+      message_type = type(message).DESCRIPTOR.name
+      text = getattr(message, 'text', None)
+      self.current_protobuf_type = None
+
+    if message_type == 'SCChat':
+      self.stats.on_chat(text)
+    else:
+      self.replies.put_nowait(message)
+
+  def close(self):
+    if self.writer:
+      self.writer.close()
+    if self.read_task:
+      self.read_task.cancel()
+
+
+class LoadStats:
+  '''한 프로세스의 통계. 끝나면 dict 로 부모 프로세스에 넘긴다.'''
+  def __init__(self):
+    self.sent = 0
+    self.received = 0
+    self.expected = 0
+    self.disconnects = 0
+    # 통계 구간에 보낸 메시지의 전달 지연(ns)
+    self.latencies: list[int] = []
+    # 이 시각(time.time_ns()) 이후에 보낸 메시지만 통계에 넣는다.
+    self.measure_from = None
+
+  def on_chat(self, text):
+    self.received += 1
+    sent_ns = int(text.split(' ', 1)[0])
+    if self.measure_from is not None and sent_ns >= self.measure_from:
+      self.latencies.append(time.time_ns() - sent_ns)
+
+  def as_dict(self):
+    return {
+      'sent': self.sent,
+      'received': self.received,
+      'expected': self.expected,
+      'disconnects': self.disconnects,
+      'latencies': self.latencies,
+    }
+
+
+protobuf_message_types = {
+  'CSName': pb.Type.MessageType.CS_NAME,
+  'CSRooms': pb.Type.MessageType.CS_ROOMS,
+  'CSCreateRoom': pb.Type.MessageType.CS_CREATE_ROOM,
+  'CSJoinRoom': pb.Type.MessageType.CS_JOIN_ROOM,
+  'CSChat': pb.Type.MessageType.CS_CHAT,
+}
+
+protobuf_message_parsers = {
+  pb.Type.MessageType.SC_ROOMS_RESULT: pb.SCRoomsResult.FromString,
+  pb.Type.MessageType.SC_CHAT: pb.SCChat.FromString,
+  pb.Type.MessageType.SC_SYSTEM_MESSAGE: pb.SCSystemMessage.FromString,
+}
+
+
+def share(total, parts, index):
+  '''total 을 parts 개로 고르게 나눴을 때 index 번째 몫'''
+  return total // parts + (1 if index < total % parts else 0)
+
+
+async def run_load(process_index, start_barrier) -> LoadStats:
+  '''
+  이 프로세스가 맡은 연결과 방으로 부하를 만든다.
+  방 제목에 실행마다 다른 값을 넣어서 같은 서버에서 여러 번 실행해도 섞이지 않게 한다.
+  '''
+  stats = LoadStats()
+  num_connections = share(FLAGS.connections, FLAGS.processes, process_index)
+  num_rooms = share(FLAGS.rooms, FLAGS.processes, process_index)
+  connect_interval = FLAGS.processes / FLAGS.connect_rate
+
+  connections = []
+  for i in range(num_connections):
+    connection = LoadConnection(i, stats)
+    await connection.connect()
+    connection.send('CSName', name=f'load-{process_index}-{i}')
+    connections.append(connection)
+    await asyncio.sleep(connect_interval)
+  await asyncio.gather(*[connection.replies.get() for connection in connections])
+
+  # 앞쪽 연결들이 방을 하나씩 만든다.
+  run_id = f'{os.getpid()}-{time.time_ns()}'
+  titles = [f'load-{run_id}-{room}' for room in range(num_rooms)]
+  await asyncio.gather(*[connections[room].request('CSCreateRoom', title=titles[room]) for room in range(num_rooms)])
+
+  # 서버는 방 목록을 페이지로 나눠 보내므로 마지막 페이지까지 요청한다.
+  room_ids = {}
+  cursor = 0
+  while True:
+    rooms_result = await connections[0].request('CSRooms', cursor=cursor, summary=True)
+    if FLAGS.format == 'json':
+      room_ids.update((room_info['title'], room_info['roomId']) for room_info in rooms_result['rooms'])
+      cursor = rooms_result.get('nextCursor', 0)
+    else:
+      room_ids.update((room_info.title, room_info.roomId) for room_info in rooms_result.rooms)
+      cursor = rooms_result.nextCursor
+    if not cursor:
+      break
+
+  # 나머지 연결들은 차례대로 방에 들어간다.
+  room_sizes = [1] * num_rooms
+  for i in range(num_rooms, num_connections):
+    room = i % num_rooms
+    await connections[i].request('CSJoinRoom', roomId=room_ids[titles[room]])
+    room_sizes[room] += 1
+  room_of = [i % num_rooms for i in range(num_connections)]
+
+  # 입장 알림 등 준비 과정의 응답은 버린다.
+  for connection in connections:
+    while not connection.replies.empty():
+      connection.replies.get_nowait()
+
+  # 모든 프로세스의 준비가 끝나면 함께 시작한다.
+  loop = asyncio.get_running_loop()
+  await loop.run_in_executor(None, start_barrier.wait)
+  print(f'#{process_index}: 연결 {num_connections}개, 방 {num_rooms}개 준비 완료. 부하 시작', flush=True)
+
+  started = time.time_ns()
+  stats.measure_from = started + int(FLAGS.warmup * 1e9)
+  deadline = time.monotonic() + FLAGS.duration
+  send_interval = FLAGS.connections / FLAGS.rate
+  padding = 'x' * FLAGS.message_size
+
+  async def send_chats(connection, room):
+    # 연결들이 한꺼번에 보내지 않도록 시작 시점을 흩어 놓는다.
+    next_send = time.monotonic() + random.random() * send_interval
+    while next_send < deadline:
+      await asyncio.sleep(max(0, next_send - time.monotonic()))
+      text = f'{time.time_ns()} '
+      connection.send('CSChat', text=text + padding[len(text):])
+      stats.sent += 1
+      stats.expected += room_sizes[room] - 1
+      next_send += send_interval
+      if connection.writer.transport.get_write_buffer_size() > 65536:
+        await connection.writer.drain()
+
+  await asyncio.gather(*[send_chats(connection, room_of[i]) for i, connection in enumerate(connections)])
+  await asyncio.sleep(FLAGS.grace)
+
+  for connection in connections:
+    connection.close()
+  return stats
+
+
+def run_process(process_index, start_barrier, results):
+  stats = asyncio.run(run_load(process_index, start_barrier))
+  results.put(stats.as_dict())
+
+
+def percentile(sorted_values, ratio):
+  if not sorted_values:
+    return float('nan')
+  return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * ratio))]
+
+
+def report(results):
+  sent = sum(result['sent'] for result in results)
+  received = sum(result['received'] for result in results)
+  expected = sum(result['expected'] for result in results)
+  disconnects = sum(result['disconnects'] for result in results)
+  latencies = sorted(latency for result in results for latency in result['latencies'])
+
+  print(f'포맷 {FLAGS.format}, framing {FLAGS.framing}{", envelope" if FLAGS.envelope else ""}, '
+        f'연결 {FLAGS.connections}개, 방 {FLAGS.rooms}개, 목표 {FLAGS.rate:.0f} msg/s, {FLAGS.duration:.0f}초')
+  print(f'보낸 채팅   {sent:10d} ({sent / FLAGS.duration:10.0f} msg/s)')
+  print(f'받은 채팅   {received:10d} ({received / FLAGS.duration:10.0f} msg/s), '
+        f'전달률 {received / expected * 100 if expected else 0:.2f}%')
+  if disconnects:
+    print(f'끊긴 연결   {disconnects:10d}')
+  print(f'전달 지연 (측정 {len(latencies)}개): ' + ', '.join(
+    f'{name} {percentile(latencies, ratio) / 1e6:.2f}ms' for name, ratio in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]))
+
+
+def main(argv):
+  if FLAGS.rooms < FLAGS.processes or FLAGS.connections < FLAGS.rooms:
+    print('--processes <= --rooms <= --connections 이어야 됩니다.')
+    return 2
+
+  context = multiprocessing.get_context('fork')
+  start_barrier = context.Barrier(FLAGS.processes)
+  results = context.Queue()
+  processes = [context.Process(target=run_process, args=[i, start_barrier, results]) for i in range(FLAGS.processes)]
+  for process in processes:
+    process.start()
+
+  # 프로세스가 끝나기 전에 결과를 꺼내야 큐에 쌓인 데이터 때문에 join() 이 멈추지 않는다.
+  collected = []
+  while len(collected) < len(processes):
+    try:
+      collected.append(results.get(timeout=1))
+    except queue.Empty:
+      if not any(process.is_alive() for process in processes):
+        break
+  for process in processes:
+    process.join()
+
+  if len(collected) < len(processes):
+    print(f'부하 생성 프로세스 {len(processes) - len(collected)}개가 비정상 종료됨')
+    return 1
+  report(collected)
+
+
+if __name__ == '__main__':
+  app.run(main)
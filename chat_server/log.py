@@ -0,0 +1,105 @@
+'''
+chat 서버의 로그.
+
+로그는 호출한 쓰레드에서 bounded queue 에 넣기만 하고, 문자열로 만들어서 stdout 에 쓰는 일은 전용 쓰레드가 한다.
+그래서 작업 쓰레드나 main 쓰레드가 터미널 출력 때문에 멈추지 않는다.
+
+  - 메시지는 logger.info('클라이언트 [%s]: ...', client) 처럼 % 형식과 인자로 넘긴다.
+    해당 level 이 꺼져 있으면 문자열을 만들지 않는다.
+  - level 은 absl 의 --verbosity 를 따른다. 0 이면 INFO, 1 이면 DEBUG(메시지 내용),
+    2 이면 TRACE(recv/send 단위)까지 출력한다.
+  - queue 가 가득 차면 로그를 버리고 개수만 센다. 로그 때문에 메시지 전달이 느려지지 않게 하기 위해서다.
+'''
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+LOG_FORMAT = '%(asctime)s %(levelname).1s %(process)d %(threadName)s] %(message)s'
+
+logger = logging.getLogger('chat_server')
+# absl 이 root logger 에 붙이는 handler 로 중복 출력하지 않는다.
+logger.propagate = False
+logger.setLevel(logging.INFO)
+
+# start() 전(benchmark 등)에는 바로 stdout 에 쓴다.
+direct_handler = logging.StreamHandler(sys.stdout)
+direct_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(direct_handler)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''queue 가 가득 차면 기다리지 않고 로그를 버린다.'''
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler.prepare() 는 호출한 쓰레드에서 메시지와 traceback 을 문자열로 만든다. 같은 프로세스의
+        # queue 라서 pickle 할 필요가 없으므로 record 를 그대로 넘기고, 형식화는 출력 쓰레드의 handler 가 한다.
+        # 그래서 로그 인자는 로그를 남긴 뒤에 바뀌지 않는 값이어야 한다.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+queue_handler: DroppingQueueHandler = None
+listener: logging.handlers.QueueListener = None
+listener_pid: int = None
+
+
+def verbosity_level(verbosity: int) -> int:
+    if verbosity >= 2:
+        return TRACE
+    if verbosity >= 1:
+        return logging.DEBUG
+    return logging.INFO
+
+
+def start(verbosity: int, max_queue_size: int = 100000):
+    '''
+    queue 와 출력 쓰레드를 만들어서 logger 가 그쪽으로 보내게 한다.
+    fork 할 때는 출력 쓰레드가 stdout 을 쓰는 중이지 않도록 stop() 한 뒤, 각 프로세스에서 다시 start() 한다.
+    '''
+    global queue_handler, listener, listener_pid
+
+    logger.setLevel(verbosity_level(verbosity))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    handler = DroppingQueueHandler(queue.Queue(max_queue_size))
+    listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+    listener_pid = os.getpid()
+    listener.start()
+
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    queue_handler = handler
+
+
+def stop():
+    '''남은 로그를 모두 출력하고 출력 쓰레드를 끝낸다.'''
+    global listener
+    if not listener or listener_pid != os.getpid():
+        return
+    listener.stop()
+    listener = None
+
+    if queue_handler.dropped:
+        print(f'queue 가 가득 차서 버린 로그: {queue_handler.dropped}개', file=sys.stderr)
+    logger.removeHandler(queue_handler)
+    logger.addHandler(direct_handler)
+
+
+atexit.register(stop)
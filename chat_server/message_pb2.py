@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rmessage.proto\x12\x03mju\"\xe6\x01\n\x04Type\x12#\n\x04type\x18\x01 \x02(\x0e\x32\x15.mju.Type.MessageType\"\xb8\x01\n\x0bMessageType\x12\x0b\n\x07\x43S_NAME\x10\x00\x12\x0c\n\x08\x43S_ROOMS\x10\x01\x12\x12\n\x0e\x43S_CREATE_ROOM\x10\x02\x12\x10\n\x0c\x43S_JOIN_ROOM\x10\x03\x12\x11\n\rCS_LEAVE_ROOM\x10\x04\x12\x0b\n\x07\x43S_CHAT\x10\x05\x12\x0f\n\x0b\x43S_SHUTDOWN\x10\x06\x12\x13\n\x0fSC_ROOMS_RESULT\x10\x07\x12\x0b\n\x07SC_CHAT\x10\x08\x12\x15\n\x11SC_SYSTEM_MESSAGE\x10\t\"\x16\n\x06\x43SName\x12\x0c\n\x04name\x18\x01 \x02(\t\"\t\n\x07\x43SRooms\"\x1d\n\x0c\x43SCreateRoom\x12\r\n\x05title\x18\x01 \x01(\t\"\x1c\n\nCSJoinRoom\x12\x0e\n\x06roomId\x18\x01 \x02(\x05\"\r\n\x0b\x43SLeaveRoom\"\x16\n\x06\x43SChat\x12\x0c\n\x04text\x18\x01 \x02(\t\"\x0c\n\nCSShutdown\"\x1d\n\x0cSCNameResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"w\n\rSCRoomsResult\x12*\n\x05rooms\x18\x01 \x03(\x0b\x32\x1b.mju.SCRoomsResult.RoomInfo\x1a:\n\x08RoomInfo\x12\x0e\n\x06roomId\x18\x01 \x02(\x05\x12\r\n\x05title\x18\x02 \x01(\t\x12\x0f\n\x07members\x18\x03 \x03(\t\"#\n\x12SCCreateRoomResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"!\n\x10SCJoinRoomResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"\"\n\x11SCLeaveRoomResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"&\n\x06SCChat\x12\x0e\n\x06member\x18\x01 \x02(\t\x12\x0c\n\x04text\x18\x02 \x02(\t\"\x1f\n\x0fSCSystemMessage\x12\x0c\n\x04text\x18\x01 \x02(\t')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rmessage.proto\x12\x03mju\"\x9a\x02\n\x04Type\x12#\n\x04type\x18\x01 \x02(\x0e\x32\x15.mju.Type.MessageType\"\xec\x01\n\x0bMessageType\x12\x0b\n\x07\x43S_NAME\x10\x00\x12\x0c\n\x08\x43S_ROOMS\x10\x01\x12\x12\n\x0e\x43S_CREATE_ROOM\x10\x02\x12\x10\n\x0c\x43S_JOIN_ROOM\x10\x03\x12\x11\n\rCS_LEAVE_ROOM\x10\x04\x12\x0b\n\x07\x43S_CHAT\x10\x05\x12\x0f\n\x0b\x43S_SHUTDOWN\x10\x06\x12\x13\n\x0fSC_ROOMS_RESULT\x10\x07\x12\x0b\n\x07SC_CHAT\x10\x08\x12\x15\n\x11SC_SYSTEM_MESSAGE\x10\t\x12\x0b\n\x07\x43S_PING\x10\n\x12\x0b\n\x07\x43S_PONG\x10\x0b\x12\x0b\n\x07SC_PING\x10\x0c\x12\x0b\n\x07SC_PONG\x10\r\"\x16\n\x06\x43SName\x12\x0c\n\x04name\x18\x01 \x02(\t\"F\n\x07\x43SRooms\x12\x11\n\x06\x63ursor\x18\x01 \x01(\x05:\x01\x30\x12\x10\n\x05limit\x18\x02 \x01(\x05:\x01\x30\x12\x16\n\x07summary\x18\x03 \x01(\x08:\x05\x66\x61lse\"\x1d\n\x0c\x43SCreateRoom\x12\r\n\x05title\x18\x01 \x01(\t\"\x1c\n\nCSJoinRoom\x12\x0e\n\x06roomId\x18\x01 \x02(\x05\"\r\n\x0b\x43SLeaveRoom\"\x16\n\x06\x43SChat\x12\x0c\n\x04text\x18\x01 \x02(\t\"\x0c\n\nCSShutdown\"\x17\n\x06\x43SPing\x12\r\n\x05nonce\x18\x01 \x01(\x04\"\x17\n\x06\x43SPong\x12\r\n\x05nonce\x18\x01 \x01(\x04\"\x1d\n\x0cSCNameResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"\xa3\x01\n\rSCRoomsResult\x12*\n\x05rooms\x18\x01 \x03(\x0b\x32\x1b.mju.SCRoomsResult.RoomInfo\x12\x15\n\nnextCursor\x18\x02 \x01(\x05:\x01\x30\x1aO\n\x08RoomInfo\x12\x0e\n\x06roomId\x18\x01 \x02(\x05\x12\r\n\x05title\x18\x02 \x01(\t\x12\x0f\n\x07members\x18\x03 \x03(\t\x12\x13\n\x0bmemberCount\x18\x04 \x01(\x05\"#\n\x12SCCreateRoomResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"!\n\x10SCJoinRoomResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"\"\n\x11SCLeaveRoomResult\x12\r\n\x05\x65rror\x18\x01 \x01(\t\"&\n\x06SCChat\x12\x0e\n\x06member\x18\x01 \x02(\t\x12\x0c\n\x04text\x18\x02 \x02(\t\"\x1f\n\x0fSCSystemMessage\x12\x0c\n\x04text\x18\x01 \x02(\t\"\x17\n\x06SCPing\x12\r\n\x05nonce\x18\x01 \x01(\x04\"\x17\n\x06SCPong\x12\r\n\x05nonce\x18\x01 \x01(\x04\"\x9f\x04\n\x08\x45nvelope\x12\x1e\n\x07\x63s_name\x18\x01 \x01(\x0b\x32\x0b.mju.CSNameH\x00\x12 \n\x08\x63s_rooms\x18\x02 \x01(\x0b\x32\x0c.mju.CSRoomsH\x00\x12+\n\x0e\x63s_create_room\x18\x03 \x01(\x0b\x32\x11.mju.CSCreateRoomH\x00\x12\'\n\x0c\x63s_join_room\x18\x04 \x01(\x0b\x32\x0f.mju.CSJoinRoomH\x00\x12)\n\rcs_leave_room\x18\x05 \x01(\x0b\x32\x10.mju.CSLeaveRoomH\x00\x12\x1e\n\x07\x63s_chat\x18\x06 \x01(\x0b\x32\x0b.mju.CSChatH\x00\x12&\n\x0b\x63s_shutdown\x18\x07 \x01(\x0b\x32\x0f.mju.CSShutdownH\x00\x12-\n\x0fsc_rooms_result\x18\x08 \x01(\x0b\x32\x12.mju.SCRoomsResultH\x00\x12\x1e\n\x07sc_chat\x18\t \x01(\x0b\x32\x0b.mju.SCChatH\x00\x12\x31\n\x11sc_system_message\x18\n \x01(\x0b\x32\x14.mju.SCSystemMessageH\x00\x12\x1e\n\x07\x63s_ping\x18\x0b \x01(\x0b\x32\x0b.mju.CSPingH\x00\x12\x1e\n\x07\x63s_pong\x18\x0c \x01(\x0b\x32\x0b.mju.CSPongH\x00\x12\x1e\n\x07sc_ping\x18\r \x01(\x0b\x32\x0b.mju.SCPingH\x00\x12\x1e\n\x07sc_pong\x18\x0e \x01(\x0b\x32\x0b.mju.SCPongH\x00\x42\x06\n\x04\x62ody')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'message_pb2', globals())
@@ -21,37 +21,47 @@ if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
   _TYPE._serialized_start=23
-  _TYPE._serialized_end=253
+  _TYPE._serialized_end=305
   _TYPE_MESSAGETYPE._serialized_start=69
-  _TYPE_MESSAGETYPE._serialized_end=253
-  _CSNAME._serialized_start=255
-  _CSNAME._serialized_end=277
-  _CSROOMS._serialized_start=279
-  _CSROOMS._serialized_end=288
-  _CSCREATEROOM._serialized_start=290
-  _CSCREATEROOM._serialized_end=319
-  _CSJOINROOM._serialized_start=321
-  _CSJOINROOM._serialized_end=349
-  _CSLEAVEROOM._serialized_start=351
-  _CSLEAVEROOM._serialized_end=364
-  _CSCHAT._serialized_start=366
-  _CSCHAT._serialized_end=388
-  _CSSHUTDOWN._serialized_start=390
-  _CSSHUTDOWN._serialized_end=402
-  _SCNAMERESULT._serialized_start=404
-  _SCNAMERESULT._serialized_end=433
-  _SCROOMSRESULT._serialized_start=435
-  _SCROOMSRESULT._serialized_end=554
-  _SCROOMSRESULT_ROOMINFO._serialized_start=496
-  _SCROOMSRESULT_ROOMINFO._serialized_end=554
-  _SCCREATEROOMRESULT._serialized_start=556
-  _SCCREATEROOMRESULT._serialized_end=591
-  _SCJOINROOMRESULT._serialized_start=593
-  _SCJOINROOMRESULT._serialized_end=626
-  _SCLEAVEROOMRESULT._serialized_start=628
-  _SCLEAVEROOMRESULT._serialized_end=662
-  _SCCHAT._serialized_start=664
-  _SCCHAT._serialized_end=702
-  _SCSYSTEMMESSAGE._serialized_start=704
-  _SCSYSTEMMESSAGE._serialized_end=735
+  _TYPE_MESSAGETYPE._serialized_end=305
+  _CSNAME._serialized_start=307
+  _CSNAME._serialized_end=329
+  _CSROOMS._serialized_start=331
+  _CSROOMS._serialized_end=401
+  _CSCREATEROOM._serialized_start=403
+  _CSCREATEROOM._serialized_end=432
+  _CSJOINROOM._serialized_start=434
+  _CSJOINROOM._serialized_end=462
+  _CSLEAVEROOM._serialized_start=464
+  _CSLEAVEROOM._serialized_end=477
+  _CSCHAT._serialized_start=479
+  _CSCHAT._serialized_end=501
+  _CSSHUTDOWN._serialized_start=503
+  _CSSHUTDOWN._serialized_end=515
+  _CSPING._serialized_start=517
+  _CSPING._serialized_end=540
+  _CSPONG._serialized_start=542
+  _CSPONG._serialized_end=565
+  _SCNAMERESULT._serialized_start=567
+  _SCNAMERESULT._serialized_end=596
+  _SCROOMSRESULT._serialized_start=599
+  _SCROOMSRESULT._serialized_end=762
+  _SCROOMSRESULT_ROOMINFO._serialized_start=683
+  _SCROOMSRESULT_ROOMINFO._serialized_end=762
+  _SCCREATEROOMRESULT._serialized_start=764
+  _SCCREATEROOMRESULT._serialized_end=799
+  _SCJOINROOMRESULT._serialized_start=801
+  _SCJOINROOMRESULT._serialized_end=834
+  _SCLEAVEROOMRESULT._serialized_start=836
+  _SCLEAVEROOMRESULT._serialized_end=870
+  _SCCHAT._serialized_start=872
+  _SCCHAT._serialized_end=910
+  _SCSYSTEMMESSAGE._serialized_start=912
+  _SCSYSTEMMESSAGE._serialized_end=943
+  _SCPING._serialized_start=945
+  _SCPING._serialized_end=968
+  _SCPONG._serialized_start=970
+  _SCPONG._serialized_end=993
+  _ENVELOPE._serialized_start=996
+  _ENVELOPE._serialized_end=1539
 # @@protoc_insertion_point(module_scope)
@@ -0,0 +1,199 @@
+'''
+chat 서버의 모니터링 수치를 Prometheus text 형식으로 내보낸다.
+
+  - Counter, Histogram 은 메시지를 처리하는 쪽에서 직접 올린다. 수치마다 lock 하나만 잡는다.
+  - 접속 수, 방 크기, 큐 깊이처럼 이미 서버가 갖고 있는 값은 scrape 할 때 callback 으로 읽어서
+    메시지 처리 경로에 비용이 없다.
+  - serve() 를 부르면 별도 port 의 HTTP 서버가 GET /metrics 에 응답한다. 기본으로는 localhost 에서만 받는다.
+'''
+import bisect
+import http.server
+import threading
+
+from log import logger
+
+
+def format_labels(label_names, label_values) -> str:
+    if not label_names:
+        return ''
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.mutex = threading.Lock()
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    '''label 값들의 tuple 별로 누적되는 값. inc('CSChat') 나 inc(amount=num_bytes) 처럼 쓴다.'''
+    type_name = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        super().__init__(name, help, label_names)
+        self.values: dict[tuple, int | float] = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.mutex:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def samples(self):
+        with self.mutex:
+            values = list(self.values.items())
+        return [f'{self.name}{format_labels(self.label_names, labels)} {format_value(value)}' for labels, value in values]
+
+
+class Gauge(Metric):
+    '''
+    scrape 할 때 callback 을 불러서 값을 읽는다.
+    callback 은 label 이 없으면 값 하나를, 있으면 (label 값들의 tuple, 값) 의 list 를 돌려준다.
+    '''
+    type_name = 'gauge'
+
+    def __init__(self, name, help, callback, label_names=()):
+        super().__init__(name, help, label_names)
+        self.callback = callback
+
+    def samples(self):
+        if not self.label_names:
+            return [f'{self.name} {format_value(self.callback())}']
+        return [f'{self.name}{format_labels(self.label_names, labels)} {format_value(value)}'
+                for labels, value in self.callback()]
+
+
+class CallbackCounter(Gauge):
+    '''다른 객체가 이미 세고 있는 누적 값을 scrape 할 때 읽는다.'''
+    type_name = 'counter'
+
+
+class HistogramData:
+    def __init__(self, num_buckets: int):
+        # 마지막 칸은 +Inf
+        self.counts = [0] * (num_buckets + 1)
+        self.sum = 0
+
+    def observe(self, buckets, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, label_names, labels, buckets) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            le = bound if isinstance(bound, str) else format_value(float(bound))
+            lines.append(f'{name}_bucket{format_labels(label_names + ("le",), labels + (le,))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(label_names, labels)} {format_value(self.sum)}')
+        lines.append(f'{name}_count{format_labels(label_names, labels)} {cumulative}')
+        return lines
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help, buckets, label_names=()):
+        super().__init__(name, help, label_names)
+        self.buckets = sorted(buckets)
+        self.data: dict[tuple, HistogramData] = {}
+
+    def observe(self, value, *label_values):
+        with self.mutex:
+            data = self.data.get(label_values)
+            if data is None:
+                data = self.data[label_values] = HistogramData(len(self.buckets))
+            data.observe(self.buckets, value)
+
+    def samples(self):
+        lines = []
+        with self.mutex:
+            for labels, data in self.data.items():
+                lines.extend(data.render(self.name, self.label_names, labels, self.buckets))
+        return lines
+
+
+class SnapshotHistogram(Histogram):
+    '''
+    누적하지 않고 scrape 할 때마다 callback 이 돌려준 값들의 분포를 만든다.
+    방 인원처럼 현재 상태의 분포를 보여줄 때 쓴다.
+    '''
+    def __init__(self, name, help, buckets, callback):
+        super().__init__(name, help, buckets)
+        self.callback = callback
+
+    def samples(self):
+        data = HistogramData(len(self.buckets))
+        for value in self.callback():
+            data.observe(self.buckets, value)
+        return data.render(self.name, (), (), self.buckets)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+registry = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('metrics: ' + format, *args)
+
+
+def serve(port: int, address: str = '127.0.0.1') -> http.server.ThreadingHTTPServer:
+    '''address:port 에서 /metrics 요청을 받는 HTTP 서버를 daemon 쓰레드로 실행한다.'''
+    httpd = http.server.ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info('%s:%d 에서 metrics 제공 중', *httpd.server_address[:2])
+    return httpd
@@ -0,0 +1,236 @@
+'''
+여러 서버 프로세스가 대화방을 공유하기 위한 local bus.
+
+부모 프로세스가 RoomBusHub 를 실행하고, 각 서버 프로세스는 backplane 으로 RoomBusClient 를
+써서 Unix domain socket 으로 연결한다. Hub 는 RoomDirectory 로 방 정보를 관리하고, 한
+프로세스에서 publish 한 메시지를 그 방의 멤버가 있는 다른 프로세스들에게 전달한다.
+
+Hub 로 오가는 값은 multiprocessing.connection 이 pickle 로 직렬화한다.
+같은 서버의 프로세스끼리만 authkey 로 접속하므로 신뢰할 수 있는 입력이다.
+'''
+import concurrent.futures
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import queue
+import threading
+import time
+
+from backplane import Backplane, BackplaneError, RoomDirectory
+from log import logger
+
+
+# accept_nodes() 가 아직 연결하지 않은 서버 프로세스들이 살아 있는지 확인하는 간격(초)
+ACCEPT_POLL_INTERVAL = 0.1
+
+
+class RoomBusHub:
+    '''
+    부모 프로세스에서 도는 bus. 한 쓰레드에서 요청을 순서대로 처리하므로 lock 이 필요 없다.
+    '''
+    def __init__(self, address: str, authkey: bytes):
+        self.listener = multiprocessing.connection.Listener(address, family='AF_UNIX', authkey=authkey)
+        self.nodes: dict[int, multiprocessing.connection.Connection] = {}
+        self.node_ids: dict[multiprocessing.connection.Connection, int] = {}
+        self.directory = RoomDirectory()
+        self.shutdown_requested = False
+
+    def accept_nodes(self, num_nodes: int, processes=(), timeout: float = None):
+        '''
+        node num_nodes 개가 연결할 때까지 기다린다. 그 전에 processes 중 하나가 종료하거나
+        timeout 초가 지나면 BackplaneError 를 던진다.
+        '''
+        # Listener.accept() 는 기다리는 시간을 정할 수 없으므로 전용 쓰레드에서 받는다.
+        accepted = queue.Queue()
+
+        def accept_loop():
+            for _ in range(num_nodes):
+                try:
+                    conn = self.listener.accept()
+                    accepted.put((conn.recv(), conn))
+                except (OSError, EOFError, multiprocessing.AuthenticationError) as err:
+                    accepted.put(err)
+                    return
+
+        threading.Thread(target=accept_loop, name='room-bus-accept', daemon=True).start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self.nodes) < num_nodes:
+            try:
+                result = accepted.get(timeout=ACCEPT_POLL_INTERVAL)
+            except queue.Empty:
+                for process in processes:
+                    if not process.is_alive():
+                        raise BackplaneError(f'서버 프로세스(pid {process.pid})가 room bus 에 연결하기 전에 종료됨. exit code: {process.exitcode}')
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise BackplaneError(f'{timeout}초 안에 서버 프로세스 {num_nodes - len(self.nodes)}개가 room bus 에 연결하지 않음')
+                continue
+
+            if isinstance(result, Exception):
+                raise BackplaneError(f'room bus 연결을 받지 못함: {result}') from result
+            node_id, conn = result
+            self.nodes[node_id] = conn
+            self.node_ids[conn] = node_id
+
+    def serve(self):
+        '''모든 node 가 연결을 끊을 때까지 요청을 처리한다.'''
+        while self.nodes:
+            for conn in multiprocessing.connection.wait(list(self.nodes.values())):
+                node_id = self.node_ids[conn]
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    self.drop_node(node_id)
+                    continue
+                self.handle_request(node_id, conn, request)
+
+        self.listener.close()
+
+    def drop_node(self, node_id):
+        '''연결이 끊긴 node 의 멤버들을 모든 방에서 뺀다.'''
+        del self.node_ids[self.nodes.pop(node_id)]
+        self.directory.drop_node(node_id, '프로세스 종료로 인한 방폭')
+
+    def handle_request(self, node_id, conn, request):
+        kind = request[0]
+        if kind == 'call':
+            _, request_id, method, args = request
+            result = getattr(self.directory, method)(node_id, *args)
+            conn.send(('reply', request_id, result))
+
+        elif kind == 'cast':
+            _, method, args = request
+            getattr(self.directory, method)(node_id, *args)
+
+        elif kind == 'publish':
+            _, room_id, messages = request
+            for target_id in self.directory.nodes_of(room_id):
+                if target_id != node_id:
+                    self.send_to_node(target_id, ('deliver', room_id, messages))
+
+        elif kind == 'shutdown':
+            if not self.shutdown_requested:
+                logger.info('Room bus: 서버 중지가 요청됨')
+                self.shutdown_requested = True
+                for target_id in list(self.nodes):
+                    self.send_to_node(target_id, ('shutdown',))
+
+    def send_to_node(self, node_id, message):
+        try:
+            self.nodes[node_id].send(message)
+        except (OSError, KeyError):
+            pass
+
+
+class RoomBusClient(Backplane):
+    '''
+    서버 프로세스 쪽의 bus 연결.
+
+    call() 은 hub 의 응답을 기다리고, cast() 와 publish() 는 보내기만 한다. 한 연결로
+    순서대로 보내므로 hub 는 같은 프로세스의 요청을 보낸 순서대로 처리한다.
+    다른 프로세스에서 publish 된 메시지는 on_deliver(room_id, messages) 로,
+    종료 요청은 on_shutdown() 으로 전달되며 둘 다 bus 전용 쓰레드에서 호출된다.
+
+    hub 와의 연결이 끊어지면 응답을 기다리던 call() 들은 BackplaneError 로 깨어나고, 방을 공유할 수
+    없으므로 on_shutdown() 으로 이 서버의 종료를 요청한다. 그 뒤의 요청도 BackplaneError 가 된다.
+    '''
+    blocking = True
+
+    def __init__(self, address: str, authkey: bytes, node_id: int):
+        self.conn = multiprocessing.connection.Client(address, family='AF_UNIX', authkey=authkey)
+        self.conn.send(node_id)
+        self.node_id = node_id
+        self.send_mutex = threading.Lock()
+        self.request_ids = itertools.count()
+        self.replies: dict[int, concurrent.futures.Future] = {}
+        # replies 와 closed 를 보호한다. 연결이 끊어진 뒤에 등록된 응답을 영영 기다리지 않도록 함께 바꾼다.
+        self.replies_mutex = threading.Lock()
+        # hub 와의 연결이 끊어졌거나 close() 했으면 True
+        self.closed = False
+
+    def start(self, on_deliver, on_shutdown):
+        super().start(on_deliver, on_shutdown)
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def send(self, message):
+        if self.closed:
+            raise BackplaneError('room bus 연결이 끊어졌음')
+        try:
+            with self.send_mutex:
+                self.conn.send(message)
+        except OSError as err:
+            raise BackplaneError(f'room bus 에 보내지 못함: {err}') from err
+
+    def call(self, method, *args):
+        request_id = next(self.request_ids)
+        reply = concurrent.futures.Future()
+        with self.replies_mutex:
+            if self.closed:
+                raise BackplaneError('room bus 연결이 끊어졌음')
+            self.replies[request_id] = reply
+        try:
+            self.send(('call', request_id, method, args))
+        except BackplaneError:
+            with self.replies_mutex:
+                self.replies.pop(request_id, None)
+            raise
+        return reply.result()
+
+    def cast(self, method, *args):
+        self.send(('cast', method, args))
+
+    def create_room(self, title, conn_id, name):
+        return self.call('create_room', title, conn_id, name)
+
+    def join_room(self, room_id, conn_id, name):
+        return self.call('join_room', room_id, conn_id, name)
+
+    def leave_room(self, room_id, conn_id, reason):
+        self.cast('leave_room', room_id, conn_id, reason)
+
+    def rename_member(self, room_id, conn_id, name):
+        self.cast('rename_member', room_id, conn_id, name)
+
+    def list_rooms(self, cursor=0, limit=0, with_members=True):
+        return self.call('list_rooms', cursor, limit, with_members)
+
+    def publish(self, room_id, messages):
+        self.send(('publish', room_id, messages))
+
+    def request_shutdown(self):
+        self.send(('shutdown',))
+
+    def read_loop(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError) as err:
+                self.on_disconnected(err)
+                break
+
+            kind = message[0]
+            if kind == 'reply':
+                _, request_id, result = message
+                self.replies.pop(request_id).set_result(result)
+            elif kind == 'deliver':
+                _, room_id, messages = message
+                self.on_deliver(room_id, messages)
+            elif kind == 'shutdown':
+                self.on_shutdown()
+
+    def on_disconnected(self, err):
+        with self.replies_mutex:
+            closing = self.closed
+            self.closed = True
+            replies, self.replies = self.replies, {}
+        for reply in replies.values():
+            reply.set_exception(BackplaneError(f'room bus 연결이 끊어졌음: {err!r}'))
+        # close() 로 닫은 것이 아니면 hub 가 종료된 것이다.
+        if not closing:
+            logger.error('Room bus: hub 와의 연결이 끊어져서 서버를 종료함: %r', err)
+            self.on_shutdown()
+
+    def close(self):
+        with self.replies_mutex:
+            self.closed = True
+        self.conn.close()
@@ -1,53 +1,317 @@
 #!/usr/bin/python3
+import asyncio
+import collections
+import itertools
+import os
 import socket
 import sys
 import threading
 import enum
 import errno
 import json
-import select
+import logging
+import multiprocessing
+import selectors
+import shutil
+import signal
+import tempfile
+import time
 
 from absl import app, flags
 
+import admission
+import backplane
+import chatlog
+import codec
 import message_pb2 as pb
+import roombus
+import timerwheel
+import framing
+import handoff
+import log
+import metrics
+from codec import InvalidMessage, NoTypeFieldInMessage, UnknownTypeInMessage
+from framing import Framing, ReceiveBuffer
+from log import TRACE, logger
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # 명령줄 인자 설정
 FLAGS = flags.FLAGS
 flags.DEFINE_integer('port', None, required=True, help='port 번호')
 flags.DEFINE_enum('format', 'json', ['json', 'protobuf'], help='메시지 포맷')
-flags.DEFINE_integer('workers', 2, help='작업 쓰레드 숫자')
+flags.DEFINE_integer('workers', 2, help='작업 쓰레드 숫자. 각 연결은 항상 같은 작업 쓰레드에서 처리되므로 CPU 코어 수까지 늘려도 메시지 순서가 유지된다')
+flags.DEFINE_integer('max_queue_depth', 10000, help='작업 쓰레드마다 큐에 쌓일 수 있는 최대 메시지 수. 가득 차면 해당 연결들의 소켓 읽기를 멈춘다')
+flags.DEFINE_enum('json_codec', 'auto', ['auto', 'msgspec', 'orjson', 'json'], help='JSON 메시지 decode/encode 구현. auto 는 설치된 것 중 가장 빠른 것을 쓴다')
+flags.DEFINE_integer('send_high_watermark', 4 * 1024 * 1024, help='연결마다 보내지 못하고 쌓아 둘 수 있는 최대 바이트 수. 넘으면 --slow_consumer_policy 를 적용한다. 0 이면 제한하지 않는다')
+flags.DEFINE_integer('send_low_watermark', 1024 * 1024, help='drop_oldest/coalesce 정책이 방 메시지를 버려서 줄이는 목표 바이트 수')
+flags.DEFINE_enum('slow_consumer_policy', 'drop_oldest', ['drop_oldest', 'coalesce', 'disconnect'],
+                  help='보내지 못한 데이터가 --send_high_watermark 를 넘은 연결의 처리 방법. drop_oldest 는 오래된 방 메시지를 버리고, '
+                       'coalesce 는 버린 메시지들을 건너뛰었다는 시스템 메시지 하나로 합치고, disconnect 는 접속을 끊는다')
+flags.DEFINE_integer('history_depth', 20, help='방마다 보관해서 새로 입장한 멤버에게 보내는 최근 채팅 수. 0 이면 보관하지 않는다. '
+                     '기록은 서버마다 따로 두므로 --processes 나 --backplane=redis 에서는 그 서버에 방의 멤버가 있는 동안 오간 채팅만 보낸다. '
+                     '그 방의 멤버가 없던 서버에 입장하면 다른 서버에서 오간 채팅은 받지 못한다')
+flags.DEFINE_integer('rooms_page_size', 100, help='CSRooms 한 번에 보내는 최대 방 수')
+flags.DEFINE_float('heartbeat_interval', 30, help='hello 로 heartbeat 를 합의한 클라이언트에게서 이 시간(초) 동안 아무것도 받지 못하면 SCPing 을 보낸다. 0 이면 보내지 않는다')
+flags.DEFINE_float('heartbeat_timeout', 10, help='SCPing 을 보낸 뒤 이 시간(초) 안에 아무것도 받지 못하면 접속을 끊는다')
+flags.DEFINE_float('idle_timeout', 0, help='heartbeat 를 합의하지 않은 클라이언트에게서 이 시간(초) 동안 아무것도 받지 못하면 접속을 끊는다. 0 이면 끊지 않는다')
+flags.DEFINE_integer('tcp_keepalive_idle', 60, help='TCP keepalive 를 보내기 시작할 때까지의 유휴 시간(초). 0 이면 keepalive 를 켜지 않는다')
+flags.DEFINE_integer('tcp_keepalive_interval', 10, help='TCP keepalive 간격(초)')
+flags.DEFINE_integer('tcp_keepalive_count', 5, help='응답이 없을 때 커널이 접속을 끊기까지 보낼 TCP keepalive 수')
+flags.DEFINE_integer('max_frame_size', 1024 * 1024, help='주고받을 수 있는 메시지 하나의 최대 크기(바이트). hello 없이 접속한 legacy 클라이언트는 64KiB 를 넘을 수 없다')
+flags.DEFINE_integer('processes', 1, help='서버 프로세스 수. 2 이상이면 각 프로세스가 SO_REUSEPORT 로 같은 port 에서 접속을 받고, 대화방은 --backplane 으로 공유한다')
+flags.DEFINE_float('bus_accept_timeout', 30, help='--processes 로 시작한 서버 프로세스들이 room bus 에 연결하기를 기다리는 최대 시간(초). 넘거나 그 전에 프로세스가 종료하면 서버를 종료한다')
+flags.DEFINE_enum('backplane', 'local', ['local', 'redis'], help='대화방을 공유하는 방법. local 은 한 서버(--processes 면 그 프로세스들) 안에서만 공유하고, redis 는 같은 Redis 를 쓰는 모든 서버가 공유한다')
+flags.DEFINE_string('redis_address', 'localhost:6379', help='--backplane=redis 일 때 Redis 서버 주소')
+flags.DEFINE_string('redis_prefix', 'chat', help='--backplane=redis 일 때 Redis key 와 channel 의 prefix')
+flags.DEFINE_integer('metrics_port', 0, help='Prometheus 형식의 모니터링 수치를 제공할 HTTP port. 0 이면 열지 않는다. --processes 면 프로세스마다 port 번호에 node 번호를 더한다')
+flags.DEFINE_string('metrics_address', '127.0.0.1', help='모니터링 HTTP 서버가 bind 할 주소. 다른 host 에서 scrape 하려면 0.0.0.0 등으로 지정한다')
+flags.DEFINE_integer('log_queue_size', 100000, help='출력 쓰레드로 넘기기 전에 쌓아 둘 수 있는 최대 로그 수. 넘치면 로그를 버린다')
+flags.DEFINE_string('chatlog_dir', '', help='방 생성/삭제와 채팅을 기록하는 chat log 의 directory. 다시 시작하면 방과 최근 채팅을 복구한다. 비어 있으면 기록하지 않는다. --processes 와 --backplane=redis 에서는 쓸 수 없다')
+flags.DEFINE_integer('chatlog_segment_size', 64 * 1024 * 1024, help='chat log segment 파일의 최대 크기(바이트). 넘으면 다음 파일에 쓴다')
+flags.DEFINE_integer('chatlog_max_pending', 65536, help='chat log 에 아직 쓰지 못한 기록의 최대 개수. 가득 차면 작업 쓰레드가 디스크 쓰기를 기다린다')
+flags.DEFINE_float('chatlog_commit_interval', 0.005, help='chat log 를 fsync 한 뒤 다음 기록들을 모으는 시간(초). 길수록 fsync 가 줄고 기록이 늦어진다')
+flags.DEFINE_float('drain_timeout', 10, help='종료할 때 새 접속을 받지 않고 기존 연결들에 남은 데이터를 보내며 기다리는 최대 시간(초). 0 이면 기다리지 않는다')
+flags.DEFINE_string('handoff_path', '', help='무중단 재시작에 쓰는 Unix domain socket 경로. 같은 경로로 새 서버를 시작하면 listen 소켓을 넘겨받고, 이전 서버는 drain 한 뒤 종료한다. --processes 에서는 쓸 수 없다')
+flags.DEFINE_integer('listen_backlog', 4096, help='accept 를 기다리는 접속을 커널이 쌓아 둘 수 있는 수. 커널 설정(net.core.somaxconn)보다 클 수 없다')
+flags.DEFINE_integer('accept_batch', 64, help='select engine 이 한 번 깨어날 때 받는 최대 접속 수. 재접속이 몰려도 기존 연결의 처리가 밀리지 않게 한다')
+flags.DEFINE_float('accept_rate', 0, help='서버 전체에서 1초에 받는 최대 접속 수. 넘으면 select engine 은 accept 를 잠시 멈추고, asyncio engine 은 접속을 바로 닫는다. 0 이면 제한하지 않는다')
+flags.DEFINE_integer('accept_burst', 1000, help='--accept_rate 를 넘어서 한꺼번에 받을 수 있는 접속 수')
+flags.DEFINE_float('per_ip_accept_rate', 0, help='IP 하나에서 1초에 받는 최대 접속 수. 넘는 접속은 받자마자 닫는다. 0 이면 제한하지 않는다')
+flags.DEFINE_integer('per_ip_accept_burst', 20, help='--per_ip_accept_rate 를 넘어서 IP 하나에서 한꺼번에 받을 수 있는 접속 수')
+flags.DEFINE_enum('engine', 'select', ['select', 'asyncio'], help='I/O 엔진. asyncio 는 작업 쓰레드 없이 event loop 에서 메시지를 처리한다')
 
 # 전역 변수 및 동기화 객체
 shutdown_requested = False
+# SIGTERM, CSShutdown, handoff 로 drain 이 요청됨. main 쓰레드가 drain 을 마치면 shutdown_requested 를 올린다.
+drain_requested = False
+
+# 연결마다 붙는 고유 번호
+connection_ids = itertools.count(1)
+
+# sendmsg() 한 번에 넘길 수 있는 최대 버퍼 수
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
 
 class Receiver(enum.Enum):
     ALL = 0
     ONLY_ME = 1
     EXCEPT_ME = 2
 
-class SocketClosed(RuntimeError):
-    pass
+class PendingKind(enum.Enum):
+    # 요청에 대한 응답 등. slow consumer 정책으로도 버리지 않는다.
+    RESPONSE = 0
+    # 방 broadcast. 보내지 못한 데이터가 쌓이면 오래된 것부터 버릴 수 있다.
+    BROADCAST = 1
+    # coalesce 정책이 버린 메시지 수를 알리는 시스템 메시지
+    SKIPPED_NOTICE = 2
 
-class NoTypeFieldInMessage(RuntimeError):
+class SocketClosed(RuntimeError):
     pass
 
-class UnknownTypeInMessage(RuntimeError):
-    def __init__(self, _type):
-        self.type = _type
-
-    def __str__(self):
-        return str(self.type)
+# idle 연결을 확인하는 timer wheel 의 한 칸 크기(초)
+IDLE_TIMER_TICK = 1.0
+
+# drain 을 시작할 때 클라이언트들에게 보내는 시스템 메시지
+DRAIN_NOTICE = '서버가 곧 종료됩니다. 잠시 후 다시 접속해 주세요.'
+# asyncio engine 이 drain 중에 남은 데이터를 확인하는 간격(초)
+DRAIN_POLL_INTERVAL = 0.05
+
+# JSON 메시지 decode/encode 구현. main() 에서 --json_codec 에 따라 바뀐다.
+json_codec = codec.make_json_codec()
+
+def serialize_messages(messages) -> list[bytes]:
+    assert isinstance(messages, list)
+
+    if FLAGS.format == 'json':
+        return [json_codec.encode(msg) for msg in messages]
+    return [msg.SerializeToString() for msg in messages]
+
+def wrap_envelopes(messages, bodies: list[bytes]) -> list[bytes]:
+    '''
+    Type 과 본문이 짝지어진 직렬화 결과를 pb.Envelope 하나씩으로 바꾼다.
+    Envelope 의 oneof 필드 번호는 MessageType 값 + 1 이므로, 본문 앞에 field tag 와 길이만
+    붙이면 pb.Envelope 를 만들어서 직렬화한 것과 같은 bytes 가 되고 본문을 다시 직렬화하지 않아도 된다.
+    '''
+    envelopes = []
+    for type_msg, body in zip(messages[0::2], bodies[1::2]):
+        # wire type 2: length-delimited
+        field_tag = (type_msg.type + 1) << 3 | 2
+        envelopes.append(framing.encode_varint(field_tag) + framing.encode_varint(len(body)) + body)
+    return envelopes
+
+def encode_messages(messages, wire_framing: Framing = Framing.LEGACY, envelope: bool = False, bodies: list[bytes] = None) -> bytes:
+    '''
+    메시지들을 직렬화하고 각각 wire_framing 방식의 길이를 붙여서 하나의 bytes 로 만든다.
+    envelope 이면 protobuf 의 Type + 본문 두 메시지를 Envelope 한 메시지로 보낸다.
+    이미 serialize_messages() 한 결과가 있다면 bodies 로 넘겨서 다시 직렬화하지 않는다.
+    만들어진 bytes 는 변경되지 않으므로 여러 클라이언트의 큐에 그대로 넣을 수 있다.
+    최대 크기를 넘는 메시지가 있으면 framing.FrameTooLarge 를 던진다.
+    '''
+    if bodies is None:
+        bodies = serialize_messages(messages)
+    if envelope:
+        bodies = wrap_envelopes(messages, bodies)
+    return framing.frame_bodies(bodies, wire_framing, FLAGS.max_frame_size)
+
+def message_type_names(messages) -> list[str]:
+    '''모니터링용. 메시지들의 타입 이름(CSChat 등)'''
+    if FLAGS.format == 'json':
+        return [msg['type'] for msg in messages]
+    return [message_names[type_msg.type] for type_msg in messages[0::2]]
+
+def ping_messages(message_type, nonce) -> list:
+    '''SCPing 이나 SCPong'''
+    if FLAGS.format == 'json':
+        return [{'type': message_type, 'nonce': nonce}]
+    return [pb.Type(type=pb.Type.MessageType.Value(envelope_field_names[message_type].upper())), getattr(pb, message_type)(nonce=nonce)]
+
+def system_messages(text) -> list:
+    if FLAGS.format == 'json':
+        return [{'type': 'SCSystemMessage', 'text': text}]
+    return [pb.Type(type=pb.Type.MessageType.SC_SYSTEM_MESSAGE), pb.SCSystemMessage(text=text)]
+
+def describe_messages(messages) -> list[tuple[int, str]]:
+    '''로그 출력용으로 각 메시지의 (메시지크기, 문자열 표현) 을 만든다.'''
+    descriptions = []
+    for msg in messages:
+        if FLAGS.format == 'json':
+            msg_as_str = json.dumps(msg)
+            descriptions.append((len(msg_as_str.encode('utf-8')), msg_as_str))
+        else:
+            descriptions.append((msg.ByteSize(), str(msg).strip()))
+    return descriptions
+
+def broadcast_messages(members, messages, sender: 'UserConnection' = None, bodies: list[bytes] = None):
+    '''
+    messages 를 한 번만 직렬화해서 members 모두에게 같은 버퍼를 보낸다.
+    길이 encoding 과 envelope 사용 여부는 멤버마다 다를 수 있으므로 그 조합별로 한 번씩만 만든다.
+    sender 가 주어지면 sender 에게는 보내지 않는다.
+    '''
+    if bodies is None:
+        bodies = serialize_messages(messages)
+    encoded_by_profile: dict[tuple[Framing, bool], bytes] = {}
+    descriptions = describe_messages(messages) if logger.isEnabledFor(logging.DEBUG) else None
+    num_sent = 0
+
+    for member in members:
+        if member is sender:
+            continue
+
+        profile = (member.framing, member.envelope)
+        encoded = encoded_by_profile.get(profile)
+        if encoded is None:
+            try:
+                encoded = encode_messages(messages, member.framing, member.envelope, bodies=bodies)
+            except framing.FrameTooLarge as err:
+                # 이 framing 을 쓰는 멤버들은 받을 수 없는 메시지다. 보내는 쪽 처리는 계속한다.
+                logger.warning('%s 클라이언트들에게 보내지 않음: %s', member.framing.name, err)
+                encoded = b''
+            encoded_by_profile[profile] = encoded
+
+        if encoded:
+            member.send_encoded(encoded, descriptions, PendingKind.BROADCAST)
+            num_sent += 1
+
+    if num_sent:
+        for type_name in message_type_names(messages):
+            messages_sent.inc(type_name, amount=num_sent)
+
+# Envelope 로 바꿀 때 필요한 대화 기록 메시지의 Type. 대화 기록에는 SCChat 만 들어 있다.
+HISTORY_TYPE_MESSAGES = [pb.Type(type=pb.Type.MessageType.SC_CHAT), None]
+
+def is_history_message(messages) -> bool:
+    '''방의 대화 기록에 남길 메시지인지. 채팅만 남기고 입장/퇴장 같은 시스템 메시지는 남기지 않는다.'''
+    return message_type_names(messages) == ['SCChat']
+
+def encode_history(entries: list[list[bytes]], wire_framing: Framing, envelope: bool) -> bytes:
+    '''
+    serialize_messages() 해 둔 SCChat 들을 다시 직렬화하지 않고 길이만 붙여서 한 번에 보낼 bytes 로 만든다.
+    이 연결의 최대 크기를 넘는 채팅은 빼고 보낸다.
+    '''
+    try:
+        bodies = [body for entry in entries for body in entry]
+        if envelope:
+            bodies = wrap_envelopes(HISTORY_TYPE_MESSAGES * len(entries), bodies)
+        return framing.frame_bodies(bodies, wire_framing, FLAGS.max_frame_size)
+    except framing.FrameTooLarge:
+        if len(entries) <= 1:
+            return b''
+        half = len(entries) // 2
+        return encode_history(entries[:half], wire_framing, envelope) + encode_history(entries[half:], wire_framing, envelope)
+
+def encode_backplane_messages(messages) -> bytes:
+    # 서버끼리는 클라이언트의 최대 크기와 상관없이 4byte 길이로 주고받는다.
+    return framing.frame_bodies(serialize_messages(messages), Framing.U32, 0xFFFFFFFF)
+
+def decode_messages(data: bytes) -> list:
+    '''encode_backplane_messages() 의 반대. backplane 으로 받은 메시지들을 되살린다.'''
+    messages = []
+    message_type = None
+    for serialized in framing.split_frames(data, Framing.U32):
+        if FLAGS.format == 'json':
+            messages.append(json_codec.loads(serialized))
+        elif message_type is None:
+            msg = pb.Type.FromString(serialized)
+            message_type = msg.type
+            messages.append(msg)
+        else:
+            messages.append(protobuf_server_message_parsers[message_type](serialized))
+            message_type = None
+    return messages
 
 class UserConnection:
     def __init__(self, sock: socket.socket, addr):
+        self.conn_id = next(connection_ids)
         self.sock = sock
         self.addr = addr
-        self.pending_data: list[bytes] = []
-        self.socket_buffer: bytes = None
-        self.current_message_len: int = None
+        # 보낼 메시지들. 앞쪽 버퍼가 일부만 전송됐다면 남은 부분의 memoryview 로 바뀐다.
+        self.pending_data: collections.deque[bytes | memoryview] = collections.deque()
+        # pending_data 의 각 버퍼가 어떤 데이터인지. pending_data 와 같은 순서로 함께 넣고 뺀다.
+        self.pending_kinds: collections.deque[PendingKind] = collections.deque()
+        # pending_data 에 남은 바이트 수. pending_data_mutex 로 보호한다.
+        self.pending_bytes = 0
+        # main 쓰레드가 sendmsg() 에 넘기고 아직 결과를 반영하지 않은 pending_data 앞쪽 버퍼 수.
+        # shed_pending_data() 는 이 범위를 버리지 않는다. pending_data_mutex 로 보호한다.
+        self.in_flight = 0
+        # 큐에 있는 SKIPPED_NOTICE 가 알리는 버린 메시지 수
+        self.skipped_notice_count = 0
+        # 보내지 못한 데이터의 한도와 한도를 넘었을 때의 처리 방법. 매번 FLAGS 를 읽지 않도록 복사해 둔다.
+        self.send_high_watermark = FLAGS.send_high_watermark
+        self.send_low_watermark = min(FLAGS.send_low_watermark, FLAGS.send_high_watermark)
+        self.slow_consumer_policy = FLAGS.slow_consumer_policy
+        self.socket_buffer = ReceiveBuffer(max_frame_size=FLAGS.max_frame_size)
+        # 메시지 길이 encoding 방식. 접속 직후 hello 를 받으면 바뀐다.
+        self.framing = Framing.LEGACY
+        # protobuf 메시지를 Type + 본문 대신 pb.Envelope 한 frame 으로 주고받는지 여부. hello 로 정해진다.
+        self.envelope = False
+        # 접속 직후의 hello 확인이 끝났는지 여부
+        self.hello_checked = False
+        # 서버가 보내는 SCPing 에 응답하는지 여부. hello 로 정해진다.
+        self.heartbeat = False
+        # 마지막으로 데이터를 받은 시각(time.monotonic()). main 쓰레드(asyncio 면 event loop)만 바꾼다.
+        self.last_received = time.monotonic()
+        # 마지막으로 SCPing 을 보낸 시각. 보낸 적이 없으면 None
+        self.ping_sent_at: float = None
+        self.ping_nonces = itertools.count(1)
         self.current_protobuf_type: pb.Type.MessageType = None
+        self.pending_data_mutex = threading.Lock()
         self._name: str = None
         self.current_room: 'ChatRoom' = None
+        # main 쓰레드의 selector 에 현재 등록된 이벤트. 0 이면 등록되지 않은 상태
+        self.watched_events: int = 0
+        # 이 연결의 메시지를 처리하는 작업 쓰레드의 큐. 한 연결의 메시지는 항상 같은 쓰레드가 순서대로 처리한다.
+        self.mailbox: 'WorkQueue' = None
+        # 작업 큐가 가득 차서 이 클라이언트의 소켓 읽기를 멈춘 상태
+        self.read_paused = False
+        # 처리 중 오류가 나서 접속을 끊기로 한 상태. 이후 도착한 메시지는 처리하지 않는다.
+        self.closing = False
+        active_connections[self.conn_id] = self
 
     def __str__(self):
         return f'{self.addr}:{self._name}'
@@ -56,162 +320,309 @@ class UserConnection:
     def name(self):
         return self._name or str(self.addr)
 
-    def receive_data(self):
-        received_buff = self.sock.recv(65536)
-        if not received_buff:
-            raise SocketClosed()
-
-        if FLAGS.verbosity >= 2:
-            print(f'  - 클라이언트 [{self}]: recv(): {len(received_buff)}바이트 읽음')
-
-        if not self.socket_buffer:
-            self.socket_buffer = received_buff
-        else:
-            self.socket_buffer += received_buff
-
-        if self.current_message_len is None:
-            if len(self.socket_buffer) < 2:
-                return False
-
-            self.current_message_len = int.from_bytes(self.socket_buffer[0:2], byteorder='big')
-            if FLAGS.verbosity >= 2:
-                print(f'  - 클라이언트 [{self}] 다음 메시지 길이: {self.current_message_len}')
-            self.socket_buffer = self.socket_buffer[2:]
-
-        if len(self.socket_buffer) < self.current_message_len:
-            print(f'Wait more: {len(self.socket_buffer)} < {self.current_message_len}')
-            return False
+    def frame_size(self, message_len):
+        '''길이 부분을 포함한 전송 크기. 로그 출력용'''
+        return len(framing.encode_header(self.framing, message_len)) + message_len
 
-        return True
+    def receive_data(self) -> list[memoryview]:
+        '''
+        소켓에서 읽고, 완성된 메시지들을 받은 순서대로 반환한다.
+        한 번의 recv() 에 여러 메시지가 들어 있을 수 있으므로 완성된 메시지를 모두 잘라낸다.
+        '''
+        try:
+            num_received = self.socket_buffer.recv_into(self.sock)
+        except BlockingIOError:
+            return []
+        if not num_received:
+            raise SocketClosed()
+        self.last_received = time.monotonic()
+        bytes_received.inc(amount=num_received)
+
+        logger.log(TRACE, '  - 클라이언트 [%s]: recv(): %d바이트 읽음', self, num_received)
+
+        return self.take_frames()
+
+    def take_frames(self) -> list[memoryview]:
+        '''socket_buffer 에 받아 둔 데이터에서 완성된 메시지들을 잘라낸다.'''
+        if not self.hello_checked:
+            hello = self.socket_buffer.read_hello()
+            if hello is None:
+                return []
+            self.hello_checked = True
+            if hello:
+                # 이후 주고받는 메시지는 클라이언트가 고른 framing 을 쓴다.
+                self.framing, hello_flags = hello
+                accepted_flags = 0
+                if hello_flags & framing.HELLO_FLAG_ENVELOPE and FLAGS.format == 'protobuf':
+                    self.envelope = True
+                    accepted_flags |= framing.HELLO_FLAG_ENVELOPE
+                if hello_flags & framing.HELLO_FLAG_HEARTBEAT and FLAGS.heartbeat_interval:
+                    self.heartbeat = True
+                    accepted_flags |= framing.HELLO_FLAG_HEARTBEAT
+                self.send_encoded(framing.make_hello_ack(self.framing, accepted_flags, FLAGS.max_frame_size))
+                logger.info('클라이언트 [%s]: framing %s%s%s 사용', self, self.framing.name,
+                            ', envelope' if self.envelope else '', ', heartbeat' if self.heartbeat else '')
+
+        messages = self.socket_buffer.next_frames()
+        if logger.isEnabledFor(TRACE):
+            for serialized in messages:
+                logger.log(TRACE, '  - 클라이언트 [%s] 메시지 길이: %d', self, len(serialized))
+
+            if self.socket_buffer:
+                logger.log(TRACE, 'Wait more: %d 바이트 남음', len(self.socket_buffer))
+
+        return messages
 
     def send_system_message(self, text, receiver=Receiver.ALL):
-        messages = []
-        if FLAGS.format == 'json':
-            msg = {
-                'type': 'SCSystemMessage',
-                'text': text,
-            }
-            messages.append(msg)
-        else:
-            msg = pb.Type()
-            msg.type = pb.Type.MessageType.SC_SYSTEM_MESSAGE
-            messages.append(msg)
-
-            msg = pb.SCSystemMessage()
-            msg.text = text
-            messages.append(msg)
-
+        messages = system_messages(text)
         if receiver == Receiver.ONLY_ME:
             self.send_messages(messages)
         else:
             assert self.current_room
-            with rooms_mutex:
-                for user in self.current_room.members:
-                    if user != self or receiver == Receiver.ALL:
-                        user.send_messages(messages)
+            sender = self if receiver == Receiver.EXCEPT_ME else None
+            broadcast_to_room(self.current_room, messages, sender=sender)
+
+    def send_history(self, entries: list[list[bytes]]):
+        '''입장한 방의 최근 채팅들을 한 번에 보낸다. 느린 클라이언트면 방 메시지처럼 버려질 수 있다.'''
+        encoded = encode_history(entries, self.framing, self.envelope)
+        if encoded:
+            logger.debug('클라이언트 [%s]: 지난 채팅 %d개 전송', self, len(entries))
+            self.send_encoded(encoded, kind=PendingKind.BROADCAST)
+            messages_sent.inc('SCChat', amount=len(entries))
 
     def send_messages(self, messages):
-        assert isinstance(messages, list)
+        descriptions = describe_messages(messages) if logger.isEnabledFor(logging.DEBUG) else None
+        self.send_encoded(encode_messages(messages, self.framing, self.envelope), descriptions)
+        for type_name in message_type_names(messages):
+            messages_sent.inc(type_name)
+
+    def send_encoded(self, encoded: bytes, descriptions: list[tuple[int, str]] = None, kind: PendingKind = PendingKind.RESPONSE):
+        '''
+        encode_messages() 로 직렬화된 데이터를 큐에 넣는다.
+        descriptions 는 DEBUG 로그가 켜져 있을 때 로그 출력에만 사용된다.
+        큐에 쌓인 데이터가 send_high_watermark 를 넘으면 slow_consumer_policy 를 적용한다.
+        '''
+        with self.pending_data_mutex:
+            if self.closing:
+                return
+            self.pending_data.append(encoded)
+            self.pending_kinds.append(kind)
+            self.pending_bytes += len(encoded)
+            overflowed = self.send_high_watermark and self.pending_bytes > self.send_high_watermark and not self.shed_pending_data()
+
+        if overflowed:
+            logger.warning('클라이언트 [%s]: 보내지 못한 데이터 %d바이트가 한도를 넘어서 접속을 끊음', self, self.pending_bytes)
+            slow_consumer_disconnects.inc()
+            self.request_close()
+            return
 
-        for msg in messages:
-            msg_as_str = None
-            if FLAGS.format == 'json':
-                serialized = bytes(json.dumps(msg), encoding='utf-8')
-                msg_as_str = json.dumps(msg)
-            else:
-                serialized = msg.SerializeToString()
-                msg_as_str = str(msg).strip()
+        if descriptions:
+            for to_send, msg_as_str in descriptions:
+                logger.debug('클라이언트 [%s]: [S->C:총길이=%d바이트] 0x%04x(메시지크기) + %s', self, self.frame_size(to_send), to_send, msg_as_str)
 
-            to_send = len(serialized)
+        self.request_send()
 
-            serialized = int.to_bytes(to_send, byteorder='big', length=2) + serialized
-            self.pending_data.append(serialized)
-            if FLAGS.verbosity >= 1:
-                print(f'클라이언트 [{self}]: [S->C:총길이={len(serialized)}바이트] 0x{to_send:04x}(메시지크기) + {msg_as_str}')
+    def shed_pending_data(self) -> bool:
+        '''
+        pending_data_mutex 를 잡은 채로 부른다. 정책에 따라 오래된 방 메시지를 버려서
+        send_low_watermark 까지 줄인다. 한도 아래로 줄였으면 True, 접속을 끊어야 하면 False
+        '''
+        if self.slow_consumer_policy == 'disconnect':
+            return False
+
+        kept_data = collections.deque()
+        kept_kinds = collections.deque()
+        dropped_messages = dropped_bytes = skipped_messages = 0
+        # 맨 앞 버퍼는 일부만 보냈을 수 있고, 전송 중인 버퍼들은 main 쓰레드가 보낸 만큼 잘라내야 하므로 버리지 않는다.
+        first_droppable = max(1, self.in_flight)
+        for i, (buffer, kind) in enumerate(zip(self.pending_data, self.pending_kinds)):
+            if i >= first_droppable and kind != PendingKind.RESPONSE and self.pending_bytes > self.send_low_watermark:
+                self.pending_bytes -= len(buffer)
+                if kind == PendingKind.SKIPPED_NOTICE:
+                    # 이전 알림은 새 알림에 합친다.
+                    skipped_messages += self.skipped_notice_count
+                else:
+                    dropped_messages += 1
+                    dropped_bytes += len(buffer)
+                continue
+            kept_data.append(buffer)
+            kept_kinds.append(kind)
+
+        self.pending_data = kept_data
+        self.pending_kinds = kept_kinds
+        if dropped_messages:
+            slow_consumer_dropped_messages.inc(self.slow_consumer_policy, amount=dropped_messages)
+            slow_consumer_dropped_bytes.inc(self.slow_consumer_policy, amount=dropped_bytes)
+
+        skipped_messages += dropped_messages
+        if self.slow_consumer_policy == 'coalesce' and skipped_messages:
+            notice = encode_messages(system_messages(f'메시지를 받는 속도가 느려서 {skipped_messages}개의 메시지를 건너뛰었습니다.'),
+                                     self.framing, self.envelope)
+            self.pending_data.append(notice)
+            self.pending_kinds.append(PendingKind.SKIPPED_NOTICE)
+            self.pending_bytes += len(notice)
+            self.skipped_notice_count = skipped_messages
+            slow_consumer_notices.inc()
+
+        return self.pending_bytes <= self.send_high_watermark
+
+    def request_close(self):
+        '''다른 쓰레드에서 접속 종료를 요청한다. 소켓은 main 쓰레드가 감시하고 있으므로 거기서 닫는다.'''
+        self.closing = True
+        with clients_to_close_mutex:
+            clients_to_close.add(self)
+        wakeup_main_thread()
+
+    def request_send(self):
+        # main 쓰레드가 이 클라이언트에 대해 EVENT_WRITE 를 감시하도록 요청한다.
+        with clients_with_output_mutex:
+            clients_with_output.add(self)
+        wakeup_main_thread()
 
     def send_pending_data(self):
-        for serialized in self.pending_data:
-            offset = 0
-            count = 0
-            while offset < len(serialized):
-                count += 1
-                num_sent = self.sock.send(serialized[offset:])
-                if num_sent <= 0:
-                    raise RuntimeError('Send failed')
-                if FLAGS.verbosity >= 2:
-                    print(f'  - 클라이언트 [{self}] send() 시도 #{count}: {num_sent}바이트 전송 완료')
-                offset += num_sent
-        self.pending_data.clear()
+        '''
+        쌓인 메시지들을 sendmsg() 한 번으로 모아서 보낸다.
+        다 보내지 못한 부분은 다음 EVENT_WRITE 때 이어서 보낸다.
+        '''
+        with self.pending_data_mutex:
+            buffers = list(itertools.islice(self.pending_data, IOV_MAX))
+            self.in_flight = len(buffers)
+        if not buffers:
+            return
+
+        try:
+            num_sent = self.sock.sendmsg(buffers)
+        except OSError as err:
+            with self.pending_data_mutex:
+                self.in_flight = 0
+            if isinstance(err, BlockingIOError):
+                return
+            raise
+        if num_sent <= 0:
+            with self.pending_data_mutex:
+                self.in_flight = 0
+            raise RuntimeError('Send failed')
+        bytes_sent.inc(amount=num_sent)
+        logger.log(TRACE, '  - 클라이언트 [%s] sendmsg(): 버퍼 %d개 중 %d바이트 전송 완료', self, len(buffers), num_sent)
+
+        # 전송이 성공한 뒤에만 큐를 줄인다. 작업 쓰레드는 그동안 뒤쪽에 추가하거나, shed_pending_data() 로
+        # 전송 중인 범위 뒤쪽만 버리므로 앞쪽 in_flight 개의 버퍼는 그대로다.
+        with self.pending_data_mutex:
+            self.in_flight = 0
+            self.pending_bytes -= num_sent
+            while num_sent:
+                head = self.pending_data[0]
+                if len(head) <= num_sent:
+                    self.pending_data.popleft()
+                    self.pending_kinds.popleft()
+                    num_sent -= len(head)
+                else:
+                    self.pending_data[0] = memoryview(head)[num_sent:]
+                    num_sent = 0
+
+    def leave_current_room(self, reason):
+        room = self.current_room
+        self.current_room = None
+
+        # 이 서버의 마지막 멤버였다면 방을 지운다. 방폭은 모든 서버의 멤버를 보고 backplane 이 정한다.
+        # chat log 의 방 삭제 기록은 backplane 이 방을 지울 때 on_room_destroyed() 에서 남긴다.
+        if room.remove_member(self):
+            remove_room(room)
+        chat_backplane.leave_room(room.room_id, self.conn_id, reason)
 
     def disconnect(self):
+        active_connections.pop(self.conn_id, None)
         if self.current_room:
-            with rooms_mutex:
-                self.current_room.members.remove(self)
-                if not self.current_room.members:
-                    print(f'방[{self.current_room.room_id}]: 접속 종료로 인한 방폭')
-                    del rooms[self.current_room.room_id]
-        self.current_room = None
+            try:
+                self.leave_current_room('접속 종료로 인한 방폭')
+            except backplane.BackplaneError as err:
+                # 이 서버에서는 이미 방에서 빠졌다. backplane 에 남은 멤버 정보는 backplane 이 정리한다.
+                logger.warning('클라이언트 [%s]: backplane 에서 방을 나가지 못함: %s', self, err)
 
         if self.sock:
             self.sock.close()
         self.sock = None
 ############
 
-    def handle_message(self):
-        assert self.current_message_len <= len(self.socket_buffer)
-        serialized = self.socket_buffer[:self.current_message_len]
-        self.socket_buffer = self.socket_buffer[self.current_message_len:]
-        self.current_message_len = None
+    def handle_messages(self, messages: list[memoryview]):
+        for serialized in messages:
+            self.process_message(serialized)
 
+    def process_message(self, serialized):
         if FLAGS.format == 'json':
             if not serialized:
-                print("빈 데이터 수신")
+                logger.info('빈 데이터 수신')
                 return
 
-            if FLAGS.verbosity >= 1:
-                print(f'클라이언트 [{self}]: [C->S:총길이={len(serialized) + 2}바이트] 0x{len(serialized):04x}(메시지크기) + {serialized.decode("utf-8")}')
-            msg = json.loads(serialized)
-            msg_type = msg.get('type', None)
-            if not msg_type:
-                raise NoTypeFieldInMessage()
+            if logger.isEnabledFor(logging.DEBUG):
+                msg_as_str = str(serialized, encoding='utf-8', errors='replace')
+                logger.debug('클라이언트 [%s]: [C->S:총길이=%d바이트] 0x%04x(메시지크기) + %s', self, self.frame_size(len(serialized)), len(serialized), msg_as_str)
 
-            if msg_type in json_message_handlers:
-                if msg_type != 'CSShutdown':
-                    json_message_handlers[msg_type](self, msg)
-                else:
-                    json_message_handlers[msg_type]()
-            else:
-                raise UnknownTypeInMessage(msg_type)
+            # 스키마 검사까지 끝난 메시지가 나오므로 handler 는 필드를 속성으로 바로 읽는다.
+            msg_type, msg = json_codec.decode(serialized)
+            self.dispatch(msg_type, json_message_handlers[msg_type], msg)
+
+        elif self.envelope:
+            self.process_envelope(serialized)
 
         else:
             if self.current_protobuf_type is None:
-                msg = pb.Type.FromString(serialized)
-                if FLAGS.verbosity >= 1:
+                msg = codec.parse_protobuf(pb.Type.FromString, serialized)
+                if logger.isEnabledFor(logging.DEBUG):
                     str_msg = str(msg).strip()
-                    print(f'클라이언트 [{self}] [C->S:총길이={len(serialized) + 2}바이트] 0x{len(serialized):04x}(메시지크기) + {str_msg}')
+                    logger.debug('클라이언트 [%s] [C->S:총길이=%d바이트] 0x%04x(메시지크기) + %s', self, self.frame_size(len(serialized)), len(serialized), str_msg)
                 if msg.type in protobuf_message_parsers and msg.type in protobuf_message_handlers:
                     self.current_protobuf_type = msg.type
                 else:
                     raise UnknownTypeInMessage(msg.type)
             else:
-                msg = protobuf_message_parsers[self.current_protobuf_type](serialized)
-                if FLAGS.verbosity >= 1:
+                msg = codec.parse_protobuf(protobuf_message_parsers[self.current_protobuf_type], serialized)
+                if logger.isEnabledFor(logging.DEBUG):
                     str_msg = str(msg).strip()
-                    print(f'클라이언트 [{self}] [C->S:총길이={len(serialized) + 2}바이트] 0x{len(serialized):04x}(메시지크기) {"+ " + str_msg if str_msg else ""}')
+                    logger.debug('클라이언트 [%s] [C->S:총길이=%d바이트] 0x%04x(메시지크기) %s', self, self.frame_size(len(serialized)), len(serialized), '+ ' + str_msg if str_msg else '')
 
                 try:
-                    if self.current_protobuf_type != pb.Type.MessageType.CS_SHUTDOWN:
-                        protobuf_message_handlers[self.current_protobuf_type](self, msg)
-                    else:
-                        protobuf_message_handlers[self.current_protobuf_type]()
+                    self.dispatch(message_names[self.current_protobuf_type], protobuf_message_handlers[self.current_protobuf_type], msg)
                 finally:
                     self.current_protobuf_type = None
 
+    def process_envelope(self, serialized):
+        '''Type 과 본문이 한 frame 에 들어 있으므로 메시지 사이에 상태를 둘 필요가 없다.'''
+        msg = codec.parse_protobuf(pb.Envelope.FromString, serialized)
+        body_name = msg.WhichOneof('body')
+        if not body_name:
+            raise NoTypeFieldInMessage()
+
+        message_type = envelope_message_types[body_name]
+        if message_type not in protobuf_message_handlers:
+            raise UnknownTypeInMessage(message_type)
+
+        body = getattr(msg, body_name)
+        if logger.isEnabledFor(logging.DEBUG):
+            str_msg = str(msg).strip().replace('\n', ' ')
+            logger.debug('클라이언트 [%s] [C->S:총길이=%d바이트] 0x%04x(메시지크기) + %s', self, self.frame_size(len(serialized)), len(serialized), str_msg)
+
+        self.dispatch(message_names[message_type], protobuf_message_handlers[message_type], body)
+
+    def dispatch(self, type_name, handler, message):
+        '''handler 를 부르고 메시지 타입별 처리 수와 처리 시간을 기록한다.'''
+        messages_received.inc(type_name)
+        started = time.perf_counter()
+        try:
+            if type_name != 'CSShutdown':
+                handler(self, message)
+            else:
+                handler()
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, type_name)
+
     def on_cs_name(self, message):
         previous_name = self.name
 
         # 사용자 이름 업데이트
-        self._name = message['name'] if FLAGS.format == 'json' else message.name
+        self._name = message.name
+        if self.current_room:
+            chat_backplane.rename_member(self.current_room.room_id, self.conn_id, self._name)
 
         # 시스템 메시지 생성 및 전송
         if self.current_room:
@@ -225,28 +636,39 @@ class UserConnection:
 
 
     def on_cs_rooms(self, message):
+        # 다른 서버에 있는 방들도 보이도록 backplane 에서 목록을 가져온다.
+        # 한 번에 한 페이지만 가져오므로 방이 많아도 요청한 방 수만큼만 비용이 든다.
+        limit = min(message.limit, FLAGS.rooms_page_size) if message.limit > 0 else FLAGS.rooms_page_size
+        rooms, next_cursor = chat_backplane.list_rooms(message.cursor, limit, with_members=not message.summary)
+
         rooms_info = []
-        with rooms_mutex:
-            for room in rooms.values():
-                if FLAGS.format == 'json':
-                    room_info = {
-                        'roomId': room.room_id,
-                        'title': room.title,
-                        'members': [m.name for m in room.members],
-                    }
-                    rooms_info.append(room_info)
-                else:
-                    room_info = pb.SCRoomsResult.RoomInfo()
-                    room_info.roomId = room.room_id
-                    room_info.title = room.title
-                    room_info.members.extend([m.name for m in room.members])
-                    rooms_info.append(room_info)
+        for room_id, title, member_count, member_names in rooms:
+
+            if FLAGS.format == 'json':
+                room_info = {
+                    'roomId': room_id,
+                    'title': title,
+                    'members': member_names,
+                    'memberCount': member_count,
+                }
+                rooms_info.append(room_info)
+            else:
+                room_info = pb.SCRoomsResult.RoomInfo()
+                room_info.roomId = room_id
+                room_info.title = title
+                room_info.members.extend(member_names)
+                room_info.memberCount = member_count
+                rooms_info.append(room_info)
 
+        self.send_rooms_result(rooms_info, next_cursor)
+
+    def send_rooms_result(self, rooms_info, next_cursor):
         messages = []
         if FLAGS.format == 'json':
             msg = {
                 'type': 'SCRoomsResult',
                 'rooms': rooms_info,
+                'nextCursor': next_cursor,
             }
             messages.append(msg)
         else:
@@ -256,8 +678,19 @@ class UserConnection:
 
             msg = pb.SCRoomsResult()
             msg.rooms.extend(rooms_info)
+            msg.nextCursor = next_cursor
             messages.append(msg)
-        self.send_messages(messages)
+
+        try:
+            self.send_messages(messages)
+        except framing.FrameTooLarge:
+            # 방 목록이 이 클라이언트의 최대 메시지 크기를 넘으면 나눠서 보낸다.
+            # 다음 페이지의 cursor 는 마지막 조각에만 넣는다.
+            if len(rooms_info) <= 1:
+                raise
+            half = len(rooms_info) // 2
+            self.send_rooms_result(rooms_info[:half], 0)
+            self.send_rooms_result(rooms_info[half:], next_cursor)
 
     def on_cs_create_room(self, message):
         if self.current_room:
@@ -265,17 +698,13 @@ class UserConnection:
             self.send_system_message(text, receiver=Receiver.ONLY_ME)
             return
 
-        title = message['title'] if FLAGS.format == 'json' else message.title
+        title = message.title
 
-        with rooms_mutex:
-            global next_room_id
-            next_room_id = next_room_id + 1 if next_room_id else 1
-            new_room = ChatRoom(next_room_id, title)
-            new_room.members.append(self)
-            rooms[new_room.room_id] = new_room
-            self.current_room = new_room
-
-            print(f'방[{new_room.room_id}]: 생성됨. 방제: {new_room.title}')
+        room_id = chat_backplane.create_room(title, self.conn_id, self.name)
+        if chat_log:
+            chat_log.room_created(room_id, title)
+        # 방 번호를 받은 직후 다른 멤버가 먼저 입장해서 이 서버에 방을 만들었을 수도 있다.
+        self.current_room = join_local_room(room_id, title, self)
 
         text2 = f'방제[{title}] 방에 입장했습니다.'
         self.send_system_message(text2, receiver=Receiver.ONLY_ME)
@@ -286,20 +715,18 @@ class UserConnection:
             self.send_system_message(text, receiver=Receiver.ONLY_ME)
             return
 
-        room_id = int(message['roomId']) if FLAGS.format == 'json' else int(message.roomId)
+        room_id = int(message.roomId)
 
-        with rooms_mutex:
-            room = rooms.get(room_id)
-            if room:
-                # 방에 참가자 추가 및 현재 방 설정
-                room.members.append(self)
-                self.current_room = room
-                room_title = room.title
-            else:
-                # 방을 찾을 수 없는 경우
-                error_message = '대화방이 존재하지 않습니다.'
-                self.send_system_message(error_message, receiver=Receiver.ONLY_ME)
-                return
+        # 방이 다른 서버에만 있을 수도 있으므로 backplane 에 먼저 입장한다.
+        room_title = chat_backplane.join_room(room_id, self.conn_id, self.name)
+        if room_title is not None:
+            # 현재 방 설정
+            self.current_room = join_local_room(room_id, room_title, self)
+        else:
+            # 방을 찾을 수 없는 경우
+            error_message = '대화방이 존재하지 않습니다.'
+            self.send_system_message(error_message, receiver=Receiver.ONLY_ME)
+            return
 
         # 클라이언트에게 방 입장 알림
         success_message = f'방제 [{room_title}] 방에 입장했습니다.'
@@ -318,17 +745,9 @@ class UserConnection:
         leave_message = f'[{self.name}] 님이 퇴장했습니다.'
         self.send_system_message(leave_message, receiver=Receiver.EXCEPT_ME)
 
-        # room_title = None
-        with rooms_mutex:
-            room_title = self.current_room.title
-            # 현재 사용자 제거
-            self.current_room.members.remove(self)
-            # 방에 남은 멤버가 없으면 방 삭제
-            if not self.current_room.members:
-                print(f'방[{self.current_room.room_id}]: 명시적 /leave 명령으로 인한 방폭')
-                del rooms[self.current_room.room_id]
-            # 현재 방 정보 초기화
-            self.current_room = None
+        room_title = self.current_room.title
+        # 현재 사용자 제거. 방에 남은 멤버가 없으면 방 삭제
+        self.leave_current_room('명시적 /leave 명령으로 인한 방폭')
 
         # 클라이언트에게 방 퇴장 알림
         success_message = f'방제 [{room_title}] 대화 방에서 퇴장했습니다.'
@@ -344,7 +763,7 @@ class UserConnection:
             msg = {
                 'type': 'SCChat',
                 'member': self.name,
-                'text': message['text']
+                'text': message.text
             }
             messages = [msg]
         else:
@@ -352,35 +771,441 @@ class UserConnection:
             chat_msg = pb.SCChat(member=self.name, text=message.text)
             messages = [type_msg, chat_msg]
 
-        # 같은 방의 다른 멤버들에게 메시지 전송
-        with rooms_mutex:
-            for member in self.current_room.members:
-                if member != self:
-                    member.send_messages(messages)
+        # 같은 방의 다른 멤버들에게 메시지 전송. 직렬화와 큐 삽입은 lock 밖에서 한다.
+        broadcast_to_room(self.current_room, messages, sender=self)
+
+    def on_cs_ping(self, message):
+        self.send_messages(ping_messages('SCPong', message.nonce))
+
+    def on_cs_pong(self, message):
+        # 받은 시각은 이미 last_received 에 기록됐다.
+        if self.ping_sent_at is not None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug('클라이언트 [%s]: pong 수신. %.1fms', self, (time.monotonic() - self.ping_sent_at) * 1000)
+
+    def check_idle(self, now) -> float | None:
+        '''
+        idle timer 가 만료됐을 때 부른다. 필요하면 SCPing 을 보내거나 접속 종료를 요청하고,
+        다시 확인할 때까지의 시간을 돌려준다. 더 확인할 필요가 없으면 None
+        '''
+        if self.closing:
+            return None
+
+        if self.heartbeat:
+            if self.ping_sent_at is not None and self.last_received < self.ping_sent_at:
+                waited = now - self.ping_sent_at
+                if waited < FLAGS.heartbeat_timeout:
+                    return FLAGS.heartbeat_timeout - waited
+                logger.info('클라이언트 [%s]: %.0f초 동안 ping 에 응답이 없어서 접속을 끊음', self, waited)
+                idle_connections_closed.inc('heartbeat')
+                self.request_close()
+                return None
+
+            idle = now - self.last_received
+            if idle < FLAGS.heartbeat_interval:
+                return FLAGS.heartbeat_interval - idle
+            self.ping_sent_at = now
+            self.send_messages(ping_messages('SCPing', next(self.ping_nonces)))
+            heartbeat_pings_sent.inc()
+            return FLAGS.heartbeat_timeout
+
+        if not FLAGS.idle_timeout:
+            return None
+        idle = now - self.last_received
+        if idle < FLAGS.idle_timeout:
+            return FLAGS.idle_timeout - idle
+        logger.info('클라이언트 [%s]: %.0f초 동안 받은 데이터가 없어서 접속을 끊음', self, idle)
+        idle_connections_closed.inc('idle')
+        self.request_close()
+        return None
+
+class AsyncioUserConnection(UserConnection):
+    '''
+    asyncio engine 에서 사용하는 연결. 메시지 처리는 event loop 쓰레드에서 바로 이루어지고,
+    큐에 쌓인 데이터는 loop 의 다음 차례에 한 번에 transport 로 넘긴다.
+    '''
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        super().__init__(None, writer.get_extra_info('peername'))
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.flush_scheduled = False
+        # transport 버퍼가 비워지기를 기다리는 중이면 True
+        self.drain_waiting = False
+
+    def request_send(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            # backplane 쓰레드가 다른 서버의 메시지를 전달할 때는 event loop 밖에서 불린다.
+            if threading.get_ident() == self.loop_thread_id:
+                self.loop.call_soon(self.flush_pending_data)
+            else:
+                self.loop.call_soon_threadsafe(self.flush_pending_data)
+
+    def flush_pending_data(self):
+        self.flush_scheduled = False
+        if not self.writer:
+            return
+
+        # transport 버퍼가 차 있으면 pending_data 에 남겨 둬서 slow consumer 정책이 적용되게 한다.
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() >= transport.get_write_buffer_limits()[1]:
+            if not self.drain_waiting:
+                self.drain_waiting = True
+                self.loop.create_task(self.flush_after_drain())
+            return
+
+        with self.pending_data_mutex:
+            pending_data = self.pending_data
+            num_bytes = self.pending_bytes
+            self.pending_data = collections.deque()
+            self.pending_kinds = collections.deque()
+            self.pending_bytes = 0
+
+        if pending_data:
+            self.writer.writelines(pending_data)
+            bytes_sent.inc(amount=num_bytes)
+
+    async def flush_after_drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.drain_waiting = False
+        self.flush_pending_data()
+
+    def process_received(self):
+        '''socket_buffer 에 받아 둔 frame 들을 처리한다.'''
+        for serialized in self.take_frames():
+            self.process_message(serialized)
+
+    def request_close(self):
+        self.closing = True
+        if threading.get_ident() == self.loop_thread_id:
+            self.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.abort)
+
+    def abort(self):
+        # 보내지 못한 데이터를 기다리지 않고 끊는다. 읽고 있던 coroutine 이 EOF 를 받아서 정리한다.
+        if self.writer:
+            self.writer.transport.abort()
+
+    def disconnect(self):
+        super().disconnect()
+        if self.writer:
+            self.writer.close()
+        self.writer = None
 
 class ChatRoom:
     def __init__(self, room_id, title):
         self.room_id = room_id
         self.title = title
-        self.members: list[UserConnection] = []
-
-clients_after_processing: list[UserConnection] = []
-clients_after_processing_mutex = threading.Lock()
-
-clients_for_processing: list[UserConnection] = []
-clients_for_processing_mutex = threading.Lock()
-clients_for_processing_cv = threading.Condition(clients_for_processing_mutex)
-
-next_room_id: int = None
+        # 연결 번호를 key 로 하는 멤버들. dict 는 입장 순서를 유지하므로 broadcast 순서도 그대로다.
+        self.members: dict[int, UserConnection] = {}
+        # 이 방의 멤버 목록을 보호한다. rooms 자체의 변경은 rooms_mutex 가 보호한다.
+        self.members_mutex = threading.Lock()
+        # 마지막 멤버가 나가서 rooms 에서 제거될 방이면 True. 이후에는 입장할 수 없다.
+        self.closed = False
+        # 최근 채팅들을 serialize_messages() 한 결과. 가득 차면 오래된 것부터 밀려난다.
+        # 이 서버에 방이 있는 동안 전달한 채팅만 남으므로, 다른 서버에서만 오간 채팅은 없다.
+        self.history: collections.deque[list[bytes]] = collections.deque(maxlen=FLAGS.history_depth)
+
+    def add_member(self, member: UserConnection) -> bool:
+        '''
+        멤버를 추가하고 지난 채팅들을 보낸다. 멤버 목록과 같은 lock 안에서 보내므로
+        입장 직후의 broadcast 가 지난 채팅보다 먼저 가거나 두 번 가지 않는다.
+        '''
+        with self.members_mutex:
+            if self.closed:
+                return False
+            self.members[member.conn_id] = member
+            if self.history:
+                member.send_history(list(self.history))
+            return True
+
+    def remove_member(self, member: UserConnection) -> bool:
+        '''멤버를 제거한다. 마지막 멤버였다면 방을 닫고 True 를 반환한다.'''
+        with self.members_mutex:
+            del self.members[member.conn_id]
+            if not self.members:
+                self.closed = True
+            return self.closed
+
+    def members_snapshot(self) -> list[UserConnection]:
+        with self.members_mutex:
+            return list(self.members.values())
+
+    def record_and_snapshot(self, bodies: list[bytes]) -> list[UserConnection]:
+        '''채팅을 기록에 남기고, 그 채팅을 받아야 할 멤버들을 반환한다.'''
+        with self.members_mutex:
+            if self.history.maxlen:
+                self.history.append(bodies)
+            # chat log 에도 같은 순서로 남는다. 큐에 넣기만 하므로 lock 을 오래 잡지 않는다.
+            if chat_log:
+                chat_log.chat(self.room_id, bodies)
+            return list(self.members.values())
+
+# 작업 쓰레드가 처리 중 오류를 만나서 main 쓰레드에게 접속 종료를 요청한 클라이언트들
+clients_to_close: set[UserConnection] = set()
+clients_to_close_mutex = threading.Lock()
+
+class WorkQueue:
+    '''
+    main 쓰레드가 작업 쓰레드에 넘기는 FIFO 큐.
+
+    깊이는 큐에 들어 있는 메시지 수로 재고, max_depth 에 이르면 full 이 된다.
+    main 쓰레드는 full 인 동안 소켓 읽기를 멈추고(backpressure), 작업 쓰레드가 큐를
+    절반까지 비우면 on_resume 을 호출해서 다시 읽게 한다.
+    '''
+    def __init__(self, max_depth: int, on_resume=None):
+        self.items: collections.deque[tuple[object, int]] = collections.deque()
+        self.max_depth = max_depth
+        self.on_resume = on_resume
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.closed = False
+        self.full = False
+        # 작업 쓰레드가 꺼내 간 항목을 아직 처리하고 있으면 True. 다음 get() 에서 내린다.
+        self.busy = False
+
+        # 모니터링용 수치
+        self.depth = 0
+        self.peak_depth = 0
+        self.backpressure_count = 0
+
+    def put(self, item, size: int = 1):
+        with self.mutex:
+            self.items.append((item, size))
+            self.depth += size
+            self.peak_depth = max(self.peak_depth, self.depth)
+            if not self.full and self.depth >= self.max_depth:
+                self.full = True
+                self.backpressure_count += 1
+            self.not_empty.notify()
+
+    def get(self):
+        '''
+        항목 하나를 꺼낸다. 비어 있으면 기다리고, close() 된 뒤에는 None 을 반환한다.
+        '''
+        with self.mutex:
+            self.busy = False
+            while not self.items and not self.closed:
+                self.not_empty.wait()
+            if self.closed:
+                return None
+
+            item, size = self.items.popleft()
+            self.busy = True
+            self.depth -= size
+            resumed = self.full and self.depth <= self.max_depth // 2
+            if resumed:
+                self.full = False
+
+        if resumed and self.on_resume:
+            self.on_resume()
+        return item
+
+    def idle(self) -> bool:
+        '''큐가 비어 있고 작업 쓰레드가 처리 중인 항목도 없으면 True'''
+        with self.mutex:
+            return not self.items and not self.busy
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+
+# 작업 쓰레드마다 하나씩 있는 큐. 연결 번호로 어느 큐를 쓸지 정한다.
+mailboxes: list[WorkQueue] = []
+
+# 보낼 데이터가 생겨서 EVENT_WRITE 감시가 필요한 클라이언트들
+clients_with_output: set[UserConnection] = set()
+clients_with_output_mutex = threading.Lock()
+
+# 다른 쓰레드가 select() 에서 대기 중인 main 쓰레드를 깨우기 위한 socketpair.
+# fork 된 프로세스끼리 공유하지 않도록 서버 프로세스마다 init_wakeup() 으로 만든다.
+wakeup_receiver: socket.socket = None
+wakeup_sender: socket.socket = None
+wakeup_pending = False
+wakeup_mutex = threading.Lock()
+
+# 이 서버에 멤버가 있는 방들. 방 번호 발급과 전체 방 목록은 backplane 이 관리한다.
 rooms: dict[int, ChatRoom] = {}
 rooms_mutex = threading.Lock()
 
+# 다른 서버(프로세스)들과 방을 공유하기 위한 backplane. run_server() 에서 정한다.
+chat_backplane: backplane.Backplane = None
+
+# 방과 채팅을 디스크에 남기는 로그. --chatlog_dir 이 없으면 None
+chat_log: chatlog.ChatLog = None
+
+# 접속 중인 연결들. 연결 번호가 key 이며 모니터링 수치를 만들 때만 읽는다.
+active_connections: dict[int, UserConnection] = {}
+
+def local_room_sizes() -> list[int]:
+    with rooms_mutex:
+        local_rooms = list(rooms.values())
+    return [len(room.members) for room in local_rooms]
+
+# 모니터링 수치. 메시지 처리 중에는 counter/histogram 만 올리고, 나머지는 scrape 할 때 읽는다.
+connections_accepted = metrics.registry.register(metrics.Counter(
+    'chat_connections_accepted_total', '받은 접속 수'))
+messages_received = metrics.registry.register(metrics.Counter(
+    'chat_messages_received_total', '타입별로 처리한 클라이언트 메시지 수', ('type',)))
+messages_sent = metrics.registry.register(metrics.Counter(
+    'chat_messages_sent_total', '타입별로 클라이언트 큐에 넣은 메시지 수. broadcast 는 받는 멤버마다 센다', ('type',)))
+bytes_received = metrics.registry.register(metrics.Counter(
+    'chat_bytes_received_total', '클라이언트 소켓에서 읽은 바이트 수'))
+bytes_sent = metrics.registry.register(metrics.Counter(
+    'chat_bytes_sent_total', '클라이언트 소켓에 쓴 바이트 수'))
+handler_seconds = metrics.registry.register(metrics.Histogram(
+    'chat_handler_seconds', '타입별 메시지 handler 처리 시간(초)',
+    [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0], ('type',)))
+metrics.registry.register(metrics.Gauge(
+    'chat_connections_active', '접속 중인 연결 수', lambda: len(active_connections)))
+metrics.registry.register(metrics.Gauge(
+    'chat_rooms_active', '이 서버에 멤버가 있는 방 수', lambda: len(rooms)))
+metrics.registry.register(metrics.SnapshotHistogram(
+    'chat_room_members', '이 서버에 있는 방별 멤버 수의 분포',
+    [1, 2, 5, 10, 50, 100, 500, 1000, 5000], local_room_sizes))
+metrics.registry.register(metrics.Gauge(
+    'chat_worker_queue_depth', '작업 쓰레드 큐에 쌓인 메시지 수',
+    lambda: [((str(i),), mailbox.depth) for i, mailbox in enumerate(mailboxes)], ('worker',)))
+metrics.registry.register(metrics.CallbackCounter(
+    'chat_worker_backpressure_total', '작업 큐가 가득 차서 소켓 읽기를 멈춘 횟수',
+    lambda: [((str(i),), mailbox.backpressure_count) for i, mailbox in enumerate(mailboxes)], ('worker',)))
+metrics.registry.register(metrics.CallbackCounter(
+    'chat_log_records_total', 'chat log 에 쓴 기록 수', lambda: chat_log.records_written if chat_log else 0))
+metrics.registry.register(metrics.CallbackCounter(
+    'chat_log_commits_total', 'chat log 를 fsync 한 횟수. 한 번에 여러 기록을 모아서 쓴다', lambda: chat_log.commits if chat_log else 0))
+metrics.registry.register(metrics.CallbackCounter(
+    'chat_log_append_waits_total', 'chat log 큐가 가득 차서 기록을 넣기 전에 기다린 횟수', lambda: chat_log.append_waits if chat_log else 0))
+heartbeat_pings_sent = metrics.registry.register(metrics.Counter(
+    'chat_heartbeat_pings_total', '조용한 클라이언트에게 보낸 SCPing 수'))
+idle_connections_closed = metrics.registry.register(metrics.Counter(
+    'chat_idle_connections_closed_total', 'ping 에 응답이 없거나(heartbeat) 오래 조용해서(idle) 끊은 접속 수', ('reason',)))
+connections_rejected = metrics.registry.register(metrics.Counter(
+    'chat_connections_rejected_total', '접속 수 제한에 걸려서 받자마자 닫은 접속 수. per_ip 는 IP 별 제한, rate 는 서버 전체 제한', ('reason',)))
+accept_throttled = metrics.registry.register(metrics.Counter(
+    'chat_accept_throttled_total', '--accept_rate 에 걸려서 accept 를 잠시 멈춘 횟수'))
+drained_connections = metrics.registry.register(metrics.Counter(
+    'chat_drained_connections_total', '종료할 때 drain 한 접속 수. flushed 는 남은 데이터를 모두 보낸 것, timed_out 은 --drain_timeout 이 지나서 닫은 것', ('result',)))
+slow_consumer_dropped_messages = metrics.registry.register(metrics.Counter(
+    'chat_slow_consumer_dropped_messages_total', '보내지 못한 데이터가 한도를 넘어서 버린 방 메시지 수', ('policy',)))
+slow_consumer_dropped_bytes = metrics.registry.register(metrics.Counter(
+    'chat_slow_consumer_dropped_bytes_total', '보내지 못한 데이터가 한도를 넘어서 버린 바이트 수', ('policy',)))
+slow_consumer_notices = metrics.registry.register(metrics.Counter(
+    'chat_slow_consumer_notices_total', 'coalesce 정책이 보낸, 메시지를 건너뛰었다는 알림 수'))
+slow_consumer_disconnects = metrics.registry.register(metrics.Counter(
+    'chat_slow_consumer_disconnects_total', '보내지 못한 데이터가 한도를 넘어서 끊은 접속 수'))
+metrics.registry.register(metrics.SnapshotHistogram(
+    'chat_send_backlog_bytes', '연결별로 아직 보내지 못한 바이트 수의 분포',
+    [0, 1024, 16384, 65536, 262144, 1048576, 4194304, 16777216],
+    lambda: [connection.pending_bytes for connection in list(active_connections.values())]))
+
+def remove_room(room: ChatRoom):
+    with rooms_mutex:
+        if rooms.get(room.room_id) is room:
+            del rooms[room.room_id]
+
+def join_local_room(room_id, title, member: UserConnection) -> ChatRoom:
+    '''
+    backplane 에 있는 방의, 이 서버 쪽 ChatRoom 에 멤버를 추가한다.
+    이 서버에 그 방의 멤버가 없어서 ChatRoom 이 없거나 닫혔다면 새로 만든다.
+    '''
+    while True:
+        with rooms_mutex:
+            room = rooms.get(room_id)
+            if not room or room.closed:
+                room = ChatRoom(room_id, title)
+                # 서버를 다시 시작한 뒤라면 chat log 에 남은 최근 채팅을 읽어 온다.
+                if chat_log:
+                    room.history.extend(chat_log.recent_chats(room_id))
+                rooms[room_id] = room
+
+        if room.add_member(member):
+            return room
+
+def broadcast_to_room(room: ChatRoom, messages, sender: UserConnection = None):
+    '''
+    이 서버에 있는 방 멤버들에게 보내고, 다른 서버의 멤버들에게는 backplane 으로 전달한다.
+    '''
+    deliver_to_local_members(room, messages, sender=sender)
+    chat_backplane.publish(room.room_id, messages)
+
+def deliver_to_local_members(room: ChatRoom, messages, sender: UserConnection = None):
+    # 채팅이면 직렬화한 결과를 그대로 방의 대화 기록에 남긴다.
+    if is_history_message(messages):
+        bodies = serialize_messages(messages)
+        broadcast_messages(room.record_and_snapshot(bodies), messages, sender=sender, bodies=bodies)
+    else:
+        broadcast_messages(room.members_snapshot(), messages, sender=sender)
+
+def on_backplane_deliver(room_id, messages):
+    with rooms_mutex:
+        room = rooms.get(room_id)
+    if room:
+        deliver_to_local_members(room, messages)
+
+def init_wakeup():
+    global wakeup_receiver, wakeup_sender
+    wakeup_receiver, wakeup_sender = socket.socketpair()
+    wakeup_receiver.setblocking(False)
+    wakeup_sender.setblocking(False)
+
+def wakeup_main_thread():
+    global wakeup_pending
+    with wakeup_mutex:
+        # 아직 main 쓰레드가 처리하지 않은 깨우기 요청이 있다면 syscall 을 생략한다.
+        if wakeup_pending:
+            return
+        wakeup_pending = True
+
+    try:
+        wakeup_sender.send(b'\x00')
+    except BlockingIOError:
+        pass
+
+def drain_wakeup():
+    global wakeup_pending
+    try:
+        while wakeup_receiver.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+    # socket 을 비운 뒤에 flag 를 내려야 한다. 반대 순서라면 그 사이에 다른 쓰레드가 보낸 바이트까지
+    # 읽어버려서, flag 는 올라가 있는데 깨울 바이트는 없는 상태로 select() 에서 잠들 수 있다.
+    with wakeup_mutex:
+        wakeup_pending = False
+
 def on_cs_shutdown():
-    print('서버 중지가 요청됨')
+    # backplane 을 공유하는 모든 서버에 종료를 알린다.
+    chat_backplane.request_shutdown()
+
+def request_drain():
+    '''
+    새 접속을 받지 않고, 기존 연결들에 남은 데이터를 --drain_timeout 까지 보낸 뒤 종료하도록
+    main 쓰레드에 알린다. 어느 쓰레드에서든 부를 수 있다.
+    '''
+    global drain_requested
+    drain_requested = True
+    wakeup_main_thread()
+
+def on_sigterm(signum, frame):
+    # signal handler 에서는 lock 을 잡지 않는다. main 쓰레드는 signal wakeup fd 로 깨어난다.
+    global drain_requested
+    drain_requested = True
+
+def request_shutdown():
+    logger.info('서버 중지가 요청됨')
     global shutdown_requested
     shutdown_requested = True
-    with clients_for_processing_mutex:
-        clients_for_processing_cv.notify_all()
+    for mailbox in mailboxes:
+        mailbox.close()
+    wakeup_main_thread()
 
 json_message_handlers = {
     'CSName': UserConnection.on_cs_name,
@@ -390,6 +1215,8 @@ json_message_handlers = {
     'CSLeaveRoom': UserConnection.on_cs_leave_room,
     'CSChat': UserConnection.on_cs_chat,
     'CSShutdown': on_cs_shutdown,
+    'CSPing': UserConnection.on_cs_ping,
+    'CSPong': UserConnection.on_cs_pong,
 }
 
 protobuf_message_handlers = {
@@ -400,6 +1227,8 @@ protobuf_message_handlers = {
     pb.Type.MessageType.CS_LEAVE_ROOM: UserConnection.on_cs_leave_room,
     pb.Type.MessageType.CS_CHAT: UserConnection.on_cs_chat,
     pb.Type.MessageType.CS_SHUTDOWN: on_cs_shutdown,
+    pb.Type.MessageType.CS_PING: UserConnection.on_cs_ping,
+    pb.Type.MessageType.CS_PONG: UserConnection.on_cs_pong,
 }
 
 protobuf_message_parsers = {
@@ -410,128 +1239,688 @@ protobuf_message_parsers = {
     pb.Type.MessageType.CS_LEAVE_ROOM: pb.CSLeaveRoom.FromString,
     pb.Type.MessageType.CS_CHAT: pb.CSChat.FromString,
     pb.Type.MessageType.CS_SHUTDOWN: pb.CSShutdown.FromString,
+    pb.Type.MessageType.CS_PING: pb.CSPing.FromString,
+    pb.Type.MessageType.CS_PONG: pb.CSPong.FromString,
 }
 
-def message_worker(thread_id):
-    print(f'메시지 작업 쓰레드 #{thread_id} 생성')
+# pb.Envelope 의 oneof 필드 이름 -> 메시지 타입
+envelope_message_types = {name.lower(): message_type for name, message_type in pb.Type.MessageType.items()}
 
-    while not shutdown_requested:
-        with clients_for_processing_mutex:
-            while not shutdown_requested and not clients_for_processing:
-                clients_for_processing_cv.wait()
+# 메시지 타입 -> 로그와 모니터링에 쓰는 이름(CSChat 등). JSON 의 type 필드 값과 같다.
+message_names = {message_type: pb.Envelope.DESCRIPTOR.fields_by_name[name].message_type.name
+                 for name, message_type in envelope_message_types.items()}
 
-            if shutdown_requested:
-                break
-            client = clients_for_processing.pop(0)
+# 메시지 이름 -> pb.Envelope 의 oneof 필드 이름
+envelope_field_names = {message_names[message_type]: name for name, message_type in envelope_message_types.items()}
 
-        try:
-            client.handle_message()
+# backplane 으로 받은 서버 메시지를 되살릴 때 사용한다.
+protobuf_server_message_parsers = {
+    pb.Type.MessageType.SC_ROOMS_RESULT: pb.SCRoomsResult.FromString,
+    pb.Type.MessageType.SC_CHAT: pb.SCChat.FromString,
+    pb.Type.MessageType.SC_SYSTEM_MESSAGE: pb.SCSystemMessage.FromString,
+    pb.Type.MessageType.SC_PING: pb.SCPing.FromString,
+    pb.Type.MessageType.SC_PONG: pb.SCPong.FromString,
+}
 
-            with clients_after_processing_mutex:
-                clients_after_processing.append(client)
+def set_keepalive(sock):
+    '''
+    응답 없이 사라진 상대(half-open 연결)를 커널이 찾아내서 끊도록 TCP keepalive 를 켠다.
+    '''
+    if not FLAGS.tcp_keepalive_idle:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, FLAGS.tcp_keepalive_idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, FLAGS.tcp_keepalive_interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, FLAGS.tcp_keepalive_count)
+
+def make_admission_control() -> admission.AdmissionControl:
+    return admission.AdmissionControl(FLAGS.accept_rate, FLAGS.accept_burst,
+                                      FLAGS.per_ip_accept_rate, FLAGS.per_ip_accept_burst, time.monotonic())
+
+def admit_client(admission_control: admission.AdmissionControl, addr) -> bool:
+    '''접속 수 제한에 걸리면 거절 이유를 기록하고 False 를 반환한다.'''
+    rejected = admission_control.admit(addr[0], time.monotonic())
+    if rejected:
+        connections_rejected.inc(rejected)
+        logger.debug('접속 수 제한(%s)으로 %s 의 접속을 닫음', rejected, addr)
+        return False
+    return True
+
+def make_idle_timers() -> timerwheel.TimerWheel | None:
+    '''heartbeat 나 idle timeout 이 켜져 있으면 연결들을 확인할 timer wheel 을 만든다.'''
+    delays = [delay for delay in [FLAGS.heartbeat_interval, FLAGS.idle_timeout] if delay > 0]
+    if not delays:
+        return None
+    max_delay = max(delays + [FLAGS.heartbeat_timeout])
+    return timerwheel.TimerWheel(IDLE_TIMER_TICK, max_delay, time.monotonic())
+
+def first_idle_check_delay() -> float:
+    # hello 를 받기 전이므로 heartbeat 여부를 모른다. 켜진 것 중 짧은 쪽에 맞춰 확인한다.
+    return min(delay for delay in [FLAGS.heartbeat_interval, FLAGS.idle_timeout] if delay > 0)
+
+def check_idle_clients(idle_timers: timerwheel.TimerWheel, clients: set[UserConnection]):
+    '''만료된 timer 의 연결들만 확인한다. 이미 닫힌 연결의 timer 는 여기서 버려진다.'''
+    now = time.monotonic()
+    for client in idle_timers.advance(now):
+        if client not in clients:
+            continue
+        delay = client.check_idle(now)
+        if delay is not None:
+            idle_timers.schedule(client, delay, now)
+
+def message_worker(thread_id, mailbox: WorkQueue):
+    '''
+    자기 큐에 배정된 연결들의 메시지를 처리한다.
+    main 쓰레드는 (클라이언트, 메시지들) 을 넣고, 접속이 끊기면 (클라이언트, None) 을 넣는다.
+    방 정리도 이 쓰레드에서 하므로 아직 처리되지 않은 메시지와 순서가 뒤바뀌지 않는다.
+    '''
+    logger.info('메시지 작업 쓰레드 #%d 생성', thread_id)
 
-        except RuntimeError as err:
-            print('Exception', err)
+    while not shutdown_requested:
+        item = mailbox.get()
+        if item is None:
+            break
+
+        client, messages = item
+        if messages is None:
             client.disconnect()
+            continue
 
-    print(f'메시지 작업 쓰레드 #{thread_id} 종료')
+        if client.closing:
+            continue
 
-def main(args):
-    global shutdown_requested
-
-    if not FLAGS.port:
-        print('서버의 Port 번호를 지정해야 됩니다.')
-        sys.exit(2)
-
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_sock.bind(('0.0.0.0', FLAGS.port))
-    server_sock.listen()
+        try:
+            client.handle_messages(messages)
+            continue
+
+        except NoTypeFieldInMessage:
+            logger.warning('클라이언트 [%s]: 메시지에 타입 필드가 없음', client)
+
+        except UnknownTypeInMessage as err:
+            logger.warning('클라이언트 [%s]: 핸들러에 등록되지 않은 메시지 타입: %s', client, err)
+
+        except InvalidMessage as err:
+            logger.warning('클라이언트 [%s]: 잘못된 메시지: %s', client, err)
+
+        except Exception as err:
+            # 예상하지 못한 예외도 그 연결만 끊는다. 작업 쓰레드가 죽으면 같은 큐의 연결들이 모두 멈춘다.
+            logger.exception('클라이언트 [%s]: 메시지 처리 중 예외: %s', client, err)
+
+        client.request_close()
+
+    logger.info('메시지 작업 쓰레드 #%d 종료', thread_id)
+
+def watch_client(selector: selectors.BaseSelector, client: UserConnection):
+    '''
+    클라이언트 소켓을 selector 에 등록한다.
+    EVENT_WRITE 는 보낼 데이터가 있을 때만 감시해서 쓸 데이터가 없는 소켓 때문에 깨어나지 않게 한다.
+    '''
+    events = 0 if client.read_paused else selectors.EVENT_READ
+    if client.pending_data:
+        events |= selectors.EVENT_WRITE
+
+    if events == client.watched_events:
+        return
+
+    if not events:
+        unwatch_client(selector, client)
+    elif client.watched_events:
+        selector.modify(client.sock, events, client)
+    else:
+        selector.register(client.sock, events, client)
+    client.watched_events = events
+
+def unwatch_client(selector: selectors.BaseSelector, client: UserConnection):
+    if client.watched_events:
+        selector.unregister(client.sock)
+        client.watched_events = 0
+
+def close_client(selector: selectors.BaseSelector, clients: set[UserConnection], client: UserConnection):
+    '''
+    main 쓰레드에서 소켓 감시를 끝내고, 방 정리와 소켓 닫기는 그 연결의 작업 쓰레드에 맡긴다.
+    '''
+    unwatch_client(selector, client)
+    clients.discard(client)
+    client.mailbox.put((client, None))
+
+def notify_drain(clients):
+    '''hello 처리를 마친 클라이언트들에게 서버가 곧 종료된다고 알린다.'''
+    for client in clients:
+        if client.hello_checked:
+            client.send_system_message(DRAIN_NOTICE, receiver=Receiver.ONLY_ME)
+
+def finish_drain(clients, has_pending_data):
+    '''drain 결과를 기록한다. has_pending_data(client) 가 True 인 연결은 다 보내지 못한 것이다.'''
+    timed_out = sum(1 for client in clients if has_pending_data(client))
+    drained_connections.inc('flushed', amount=len(clients) - timed_out)
+    drained_connections.inc('timed_out', amount=timed_out)
+    if timed_out:
+        logger.warning('Drain: 접속 %d개 중 %d개는 --drain_timeout 안에 다 보내지 못해서 닫음', len(clients), timed_out)
+    else:
+        logger.info('Drain: 접속 %d개에 남은 데이터를 모두 보냄', len(clients))
+
+def run_select_server(server_sock: socket.socket):
+    # SIGTERM 은 drain 을 요청한다. handler 가 끝나면 signal wakeup fd 로 select() 가 깨어난다.
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, on_sigterm)
+        signal.set_wakeup_fd(wakeup_sender.fileno(), warn_on_full_buffer=False)
+
+    # handoff 한 이전 서버와 accept 큐를 공유할 수 있으므로 먼저 받아 가도 멈추지 않게 한다.
+    server_sock.setblocking(False)
 
     worker_threads: list[threading.Thread] = []
     for i in range(FLAGS.workers):
-        thread = threading.Thread(target=message_worker, args=[i])
+        mailbox = WorkQueue(FLAGS.max_queue_depth, on_resume=wakeup_main_thread)
+        mailboxes.append(mailbox)
+        thread = threading.Thread(target=message_worker, args=[i, mailbox], name=f'worker-{i}')
         thread.start()
         worker_threads.append(thread)
 
-    clients: list[UserConnection] = []
+    # Linux 에서는 epoll 을 사용한다. 소켓은 한 번만 등록하고 필요할 때만 감시 이벤트를 바꾼다.
+    selector = selectors.DefaultSelector()
+    selector.register(server_sock, selectors.EVENT_READ)
+    selector.register(wakeup_receiver, selectors.EVENT_READ)
 
-    print(f'Port 번호 {FLAGS.port}에서 서버 동작 중')
+    # 접속 중인 클라이언트들. 소켓 I/O 는 모두 main 쓰레드가 한다.
+    clients: set[UserConnection] = set()
 
-    while not shutdown_requested:
-        inputs = [server_sock]
-        outputs = []
+    # 작업 큐가 가득 차서 읽기를 멈춘 클라이언트들
+    paused_clients: list[UserConnection] = []
 
-        with clients_after_processing_mutex:
-            if clients_after_processing:
-                clients.extend(clients_after_processing)
-                clients_after_processing.clear()
+    # 오래 조용한 클라이언트들을 확인할 timer. 닫힌 클라이언트의 timer 는 만료될 때 버린다.
+    idle_timers = make_idle_timers()
 
-        for client in clients:
-            inputs.append(client.sock)
-            outputs.append(client.sock)
+    # 접속 수 제한. 서버 전체 token 이 떨어지면 accept_resume_at 까지 server_sock 을 감시하지 않는다.
+    admission_control = make_admission_control()
+    accept_resume_at: float = None
 
-        try:
-            readable, writable, exceptionable = select.select(inputs, outputs, [], 0.1)
+    # drain 을 끝내야 하는 시각. drain 중이 아니면 None
+    drain_deadline: float = None
 
-            if server_sock in readable:
-                client_sock, addr = server_sock.accept()
-                client = UserConnection(client_sock, addr)
-                clients.append(client)
-                print(f'새로운 클라이언트 접속 [{client}]')
+    logger.info('Port 번호 %d에서 서버 동작 중', FLAGS.port)
 
-            clients_to_remove: list[UserConnection] = []
-            for client in clients:
+    while not shutdown_requested:
+        try:
+            # 다른 쓰레드의 요청은 wakeup socket 으로 전달되므로 다음 idle timer 까지만 대기한다.
+            timeout = idle_timers.next_timeout(time.monotonic()) if idle_timers is not None else None
+            for deadline in [drain_deadline, accept_resume_at]:
+                if deadline is not None:
+                    remaining = max(0, deadline - time.monotonic())
+                    timeout = remaining if timeout is None else min(timeout, remaining)
+            if drain_deadline is not None:
+                # 작업 쓰레드는 큐를 다 비워도 main 쓰레드를 깨우지 않으므로 drain 중에는 자주 확인한다.
+                timeout = min(timeout, DRAIN_POLL_INTERVAL)
+            for key, mask in selector.select(timeout):
+                if key.fileobj is server_sock:
+                    # 재접속이 몰리면 한 번에 여러 접속을 받되, 기존 연결들이 밀리지 않게 --accept_batch 까지만 받는다.
+                    for _ in range(FLAGS.accept_batch):
+                        wait_time = admission_control.wait_time(time.monotonic())
+                        if wait_time:
+                            # 남은 접속은 token 이 생길 때까지 커널의 accept 큐에서 기다린다.
+                            selector.unregister(server_sock)
+                            accept_resume_at = time.monotonic() + wait_time
+                            accept_throttled.inc()
+                            break
+
+                        try:
+                            client_sock, addr = server_sock.accept()
+                        except BlockingIOError:
+                            break
+                        if not admit_client(admission_control, addr):
+                            client_sock.close()
+                            continue
+
+                        client_sock.setblocking(False)
+                        set_keepalive(client_sock)
+                        client = UserConnection(client_sock, addr)
+                        client.mailbox = mailboxes[client.conn_id % len(mailboxes)]
+                        clients.add(client)
+                        connections_accepted.inc()
+                        watch_client(selector, client)
+                        if idle_timers is not None:
+                            idle_timers.schedule(client, first_idle_check_delay(), time.monotonic())
+                        logger.info('새로운 클라이언트 접속 [%s]', client)
+                    continue
+
+                if key.fileobj is wakeup_receiver:
+                    drain_wakeup()
+                    continue
+
+                client = key.data
                 try:
-                    if client.sock in writable and client.pending_data:
+                    if mask & selectors.EVENT_WRITE and client.pending_data:
                         client.send_pending_data()
+                        watch_client(selector, client)
 
-                    if client.sock in readable:
-                        if client.receive_data():
-                            with clients_for_processing_mutex:
-                                clients_for_processing.append(client)
-                                clients_for_processing_cv.notify()
-                            clients_to_remove.append(client)
+                    if mask & selectors.EVENT_READ and client.mailbox.full:
+                        # 작업 큐가 비워질 때까지 이 소켓은 읽지 않는다. 커널 수신 버퍼가 차면 TCP 가 송신 측을 늦춘다.
+                        client.read_paused = True
+                        paused_clients.append(client)
+                        watch_client(selector, client)
 
-                except SocketClosed:
-                    print(f'클라이언트 [{client}]: 상대방이 소켓을 닫았음')
-                    client.disconnect()
-                    clients_to_remove.append(client)
+                    elif mask & selectors.EVENT_READ:
+                        messages = client.receive_data()
+                        if messages:
+                            client.mailbox.put((client, messages), len(messages))
 
-                except NoTypeFieldInMessage:
-                    print(f'클라이언트 [{client}]: 메시지에 타입 필드가 없음')
-                    client.disconnect()
-                    clients_to_remove.append(client)
+                except SocketClosed:
+                    logger.info('클라이언트 [%s]: 상대방이 소켓을 닫았음', client)
+                    close_client(selector, clients, client)
 
-                except UnknownTypeInMessage as err:
-                    print(f'클라이언트 [{client}]: 핸들러에 등록되지 않은 메시지 타입: {err}')
-                    client.disconnect()
-                    clients_to_remove.append(client)
+                except framing.FramingError as err:
+                    logger.warning('클라이언트 [%s]: %s', client, err)
+                    close_client(selector, clients, client)
 
                 except socket.error as err:
                     if err.errno == errno.ECONNRESET:
-                        print(f'클라이언트 [{client}]: 상대방이 소켓을 닫았음')
+                        logger.info('클라이언트 [%s]: 상대방이 소켓을 닫았음', client)
                     else:
-                        print(f'소켓 에러: {err}')
-                    client.disconnect()
-                    clients_to_remove.append(client)
-
-            for client in clients_to_remove:
-                clients.remove(client)
+                        logger.warning('소켓 에러: %s', err)
+                    close_client(selector, clients, client)
+
+            if idle_timers is not None:
+                check_idle_clients(idle_timers, clients)
+
+            # 작업 쓰레드가 접속 종료를 요청한 클라이언트들을 정리한다.
+            with clients_to_close_mutex:
+                closing_clients = list(clients_to_close)
+                clients_to_close.clear()
+
+            for client in closing_clients:
+                if client in clients:
+                    close_client(selector, clients, client)
+
+            # 작업 큐에 여유가 생겼다면 읽기를 멈췄던 클라이언트들을 다시 감시한다.
+            if paused_clients:
+                still_paused = []
+                for client in paused_clients:
+                    if client.mailbox.full:
+                        still_paused.append(client)
+                        continue
+                    client.read_paused = False
+                    if client in clients:
+                        watch_client(selector, client)
+
+                if len(still_paused) < len(paused_clients) and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('작업 큐 깊이 %s: 클라이언트 %d개 읽기 재개', [mailbox.depth for mailbox in mailboxes], len(paused_clients) - len(still_paused))
+                paused_clients = still_paused
+
+            # 보낼 데이터가 생긴 클라이언트들에 대해 EVENT_WRITE 를 감시한다.
+            with clients_with_output_mutex:
+                output_clients = list(clients_with_output)
+                clients_with_output.clear()
+
+            for client in output_clients:
+                if client in clients:
+                    watch_client(selector, client)
+
+            if accept_resume_at is not None and time.monotonic() >= accept_resume_at and drain_deadline is None:
+                selector.register(server_sock, selectors.EVENT_READ)
+                accept_resume_at = None
+
+            if drain_requested and drain_deadline is None:
+                drain_deadline = time.monotonic() + FLAGS.drain_timeout
+                logger.info('Drain 시작: 새 접속을 받지 않고 접속 %d개에 남은 데이터를 보냄', len(clients))
+                if accept_resume_at is None:
+                    selector.unregister(server_sock)
+                accept_resume_at = None
+                server_sock.close()
+                # 새 요청은 읽지 않는다. 이미 큐에 넣은 메시지는 작업 쓰레드가 마저 처리한다.
+                paused_clients = []
+                for client in clients:
+                    client.read_paused = True
+                    watch_client(selector, client)
+                notify_drain(clients)
+
+            # 작업 쓰레드들이 일을 마치고 모든 연결에 남은 데이터를 보냈으면 종료한다.
+            if drain_deadline is not None and (time.monotonic() >= drain_deadline or (
+                    all(mailbox.idle() for mailbox in mailboxes) and not any(client.pending_data for client in clients))):
+                finish_drain(clients, lambda client: client.pending_data)
+                request_shutdown()
 
         except KeyboardInterrupt:
-            print('키보드로 프로그램 강제 종료 요청')
-            on_cs_shutdown()
+            logger.info('키보드로 프로그램 강제 종료 요청')
+            request_shutdown()
 
-    print('Main thread 종료 중')
+    logger.info('Main thread 종료 중')
 
     for thread in worker_threads:
-        print('작업 쓰레드 join() 시작')
+        logger.info('작업 쓰레드 join() 시작')
         thread.join()
-        print('작업 쓰레드 join() 완료')
+        logger.info('작업 쓰레드 join() 완료')
 
     for client in clients:
         client.sock.close()
+    selector.close()
+
+async def serve_asyncio(server_sock: socket.socket):
+    loop = asyncio.get_running_loop()
+    shutdown_future = loop.create_future()
+    clients: set[AsyncioUserConnection] = set()
+
+    drain_task: asyncio.Task = None
+
+    # drain 과 종료 요청은 wakeup socket 으로 전달된다.
+    def on_wakeup():
+        nonlocal drain_task
+        drain_wakeup()
+        if drain_requested and not drain_task:
+            drain_task = asyncio.create_task(drain())
+        if shutdown_requested and not shutdown_future.done():
+            shutdown_future.set_result(None)
+
+    def has_pending_data(client: AsyncioUserConnection) -> bool:
+        return bool(client.pending_data) or bool(client.writer and client.writer.transport.get_write_buffer_size())
+
+    async def drain():
+        logger.info('Drain 시작: 새 접속을 받지 않고 접속 %d개에 남은 데이터를 보냄', len(clients))
+        deadline = loop.time() + FLAGS.drain_timeout
+        server.close()
+        # 새 요청은 읽지 않는다. 메시지는 event loop 에서 바로 처리되므로 처리 중인 것은 없다.
+        for client in clients:
+            if client.writer:
+                client.writer.transport.pause_reading()
+        notify_drain(clients)
+
+        while loop.time() < deadline and any(has_pending_data(client) for client in clients):
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        finish_drain(clients, has_pending_data)
+        request_shutdown()
+
+    idle_timers = make_idle_timers()
+
+    async def check_idle_loop():
+        while True:
+            timeout = idle_timers.next_timeout(time.monotonic())
+            await asyncio.sleep(IDLE_TIMER_TICK if timeout is None else timeout)
+            check_idle_clients(idle_timers, clients)
+
+    # event loop 의 accept 는 멈출 수 없으므로 서버 전체 제한에 걸린 접속도 바로 닫는다.
+    admission_control = make_admission_control()
+
+    async def on_client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not admit_client(admission_control, writer.get_extra_info('peername')):
+            writer.transport.abort()
+            return
+
+        client = AsyncioUserConnection(reader, writer)
+        clients.add(client)
+        connections_accepted.inc()
+        set_keepalive(writer.get_extra_info('socket'))
+        if idle_timers is not None:
+            idle_timers.schedule(client, first_idle_check_delay(), time.monotonic())
+        logger.info('새로운 클라이언트 접속 [%s]', client)
+
+        try:
+            while not shutdown_requested:
+                data = await reader.read(65536)
+                if not data:
+                    logger.info('클라이언트 [%s]: 상대방이 소켓을 닫았음', client)
+                    break
+                client.last_received = time.monotonic()
+                bytes_received.inc(amount=len(data))
+
+                # select engine 과 같은 버퍼에서 hello 와 메시지 경계를 처리한다.
+                client.socket_buffer.feed(data)
+                if chat_backplane.blocking:
+                    # backplane 의 응답을 기다리는 동안 다른 연결들이 멈추지 않도록 event loop 밖에서 처리한다.
+                    # 처리가 끝날 때까지 이 연결은 더 읽지 않으므로 메시지 순서는 그대로다.
+                    await loop.run_in_executor(None, client.process_received)
+                else:
+                    client.process_received()
+
+                # 상대가 읽지 않아서 transport 버퍼가 찼다면 더 읽기 전에 기다린다.
+                await writer.drain()
+
+        except framing.FramingError as err:
+            logger.warning('클라이언트 [%s]: %s', client, err)
+
+        except NoTypeFieldInMessage:
+            logger.warning('클라이언트 [%s]: 메시지에 타입 필드가 없음', client)
+
+        except UnknownTypeInMessage as err:
+            logger.warning('클라이언트 [%s]: 핸들러에 등록되지 않은 메시지 타입: %s', client, err)
+
+        except InvalidMessage as err:
+            logger.warning('클라이언트 [%s]: 잘못된 메시지: %s', client, err)
+
+        except ConnectionResetError:
+            logger.info('클라이언트 [%s]: 상대방이 소켓을 닫았음', client)
+
+        except Exception as err:
+            logger.exception('클라이언트 [%s]: 메시지 처리 중 예외: %s', client, err)
+
+        finally:
+            clients.discard(client)
+            if chat_backplane.blocking:
+                await loop.run_in_executor(None, client.disconnect)
+            else:
+                client.disconnect()
+
+    # backlog 는 listen() 에 다시 넘겨지고, event loop 가 한 번 깨어날 때 받는 최대 접속 수로도 쓰인다.
+    server = await asyncio.start_server(on_client_connected, sock=server_sock, backlog=FLAGS.listen_backlog)
+    loop.add_reader(wakeup_receiver, on_wakeup)
+    if threading.current_thread() is threading.main_thread():
+        loop.add_signal_handler(signal.SIGTERM, request_drain)
+    logger.info('Port 번호 %d에서 서버 동작 중 (asyncio%s)', FLAGS.port, ', uvloop' if uvloop else '')
+
+    idle_task = asyncio.create_task(check_idle_loop()) if idle_timers is not None else None
+    async with server:
+        await shutdown_future
+    if idle_task:
+        idle_task.cancel()
+
+    loop.remove_reader(wakeup_receiver)
+    if threading.current_thread() is threading.main_thread():
+        loop.remove_signal_handler(signal.SIGTERM)
+    logger.info('Main thread 종료 중')
+
+    for client in list(clients):
+        if client.writer:
+            client.writer.close()
+
+def run_asyncio_server(server_sock: socket.socket):
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    try:
+        asyncio.run(serve_asyncio(server_sock))
+    except KeyboardInterrupt:
+        logger.info('키보드로 프로그램 강제 종료 요청')
+
+def make_server_socket(reuse_port: bool) -> socket.socket:
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # 커널이 같은 port 에 bind 한 프로세스들에게 새 접속을 나눠준다.
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_sock.bind(('0.0.0.0', FLAGS.port))
+    server_sock.listen(FLAGS.listen_backlog)
+    return server_sock
+
+def make_backplane() -> backplane.Backplane:
+    if FLAGS.backplane == 'redis':
+        return backplane.RedisBackplane(FLAGS.redis_address, FLAGS.redis_prefix,
+                                        encode=encode_backplane_messages, decode=decode_messages)
+    return backplane.LoopbackBackplane()
+
+def on_room_destroyed(room_id):
+    '''
+    backplane 이 방을 지울 때 그 lock 을 잡은 채로 불린다. 그래서 방을 지우기로 정한 뒤에
+    다른 멤버가 입장해서 방이 되살아나는 일 없이, 기록된 순서가 backplane 에서 일어난 순서와 같다.
+    '''
+    # 서버를 끝내면서(drain 중 포함) 나가는 것이면 다시 시작할 때 복구하도록 남겨 둔다.
+    if not shutdown_requested and not drain_requested:
+        chat_log.room_destroyed(room_id)
+
+def open_chat_log(server_backplane: backplane.LoopbackBackplane):
+    '''chat log 를 읽어서 지난 실행의 방들을 backplane 에 되살리고 기록을 시작한다.'''
+    global chat_log
+    # 디스크에 쓰지 못하게 되면 기록 없이 계속 받지 않고 drain 한다. 다시 시작하면 그때까지 쓴 기록으로 복구한다.
+    chat_log = chatlog.ChatLog(FLAGS.chatlog_dir, FLAGS.format, FLAGS.history_depth,
+                               FLAGS.chatlog_segment_size, FLAGS.chatlog_commit_interval,
+                               FLAGS.chatlog_max_pending, on_failure=request_drain)
+    recovered_rooms, last_room_id = chat_log.recover()
+    server_backplane.restore_rooms(recovered_rooms, last_room_id)
+    server_backplane.on_room_destroyed = on_room_destroyed
+    chat_log.start()
+
+def run_server(server_sock: socket.socket, server_backplane: backplane.Backplane, metrics_port: int = 0):
+    global chat_backplane
+
+    init_wakeup()
+    if metrics_port:
+        metrics.serve(metrics_port, FLAGS.metrics_address)
+    chat_backplane = server_backplane
+    chat_backplane.start(on_deliver=on_backplane_deliver, on_shutdown=request_drain)
+    try:
+        if FLAGS.engine == 'asyncio':
+            run_asyncio_server(server_sock)
+        else:
+            run_select_server(server_sock)
+    finally:
+        chat_backplane.close()
+
+def run_server_process(node_id: int, bus_address: str, bus_authkey: bytes):
+    '''
+    --processes 로 fork 된 서버 프로세스. 각자 접속을 받고 대화방은 backplane 으로 공유한다.
+    --backplane=local 이면 부모 프로세스의 room bus 를 쓴다.
+    '''
+    log.start(FLAGS.verbosity, FLAGS.log_queue_size)
+    server_sock = make_server_socket(reuse_port=True)
+    if bus_address:
+        server_backplane = roombus.RoomBusClient(bus_address, bus_authkey, node_id)
+    else:
+        server_backplane = make_backplane()
+    try:
+        run_server(server_sock, server_backplane, FLAGS.metrics_port + node_id if FLAGS.metrics_port else 0)
+    finally:
+        # multiprocessing 은 atexit 없이 프로세스를 끝내므로 남은 로그를 여기서 출력한다.
+        log.stop()
+
+def run_multiprocess_server():
+    '''
+    서버 프로세스들을 fork 하고, --backplane=local 이면 이 프로세스는 room bus hub 를 실행한다.
+    '''
+    hub = None
+    bus_dir = bus_address = bus_authkey = None
+    if FLAGS.backplane == 'local':
+        bus_dir = tempfile.mkdtemp(prefix='chat_server-')
+        bus_address = os.path.join(bus_dir, 'room_bus.sock')
+        bus_authkey = os.urandom(16)
+        hub = roombus.RoomBusHub(bus_address, bus_authkey)
+
+    # hub 는 쓰레드를 만들지 않으므로 fork 해도 안전하다. 로그 출력 쓰레드는 fork 하는 동안 멈춘다.
+    context = multiprocessing.get_context('fork')
+    processes = []
+    log.stop()
+    for node_id in range(FLAGS.processes):
+        process = context.Process(target=run_server_process, args=[node_id, bus_address, bus_authkey])
+        process.start()
+        processes.append(process)
+    log.start(FLAGS.verbosity, FLAGS.log_queue_size)
+
+    # SIGTERM 을 받으면 서버 프로세스들이 각자 drain 한 뒤 종료한다.
+    def forward_sigterm(signum, frame):
+        for process in processes:
+            process.terminate()
+    signal.signal(signal.SIGTERM, forward_sigterm)
+
+    failed = False
+    try:
+        logger.info('서버 프로세스 %d개 동작 중', len(processes))
+        if hub:
+            hub.accept_nodes(len(processes), processes, FLAGS.bus_accept_timeout)
+            hub.serve()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logger.info('키보드로 프로그램 강제 종료 요청')
+        for process in processes:
+            process.join()
+    except backplane.BackplaneError as err:
+        # room bus 없이는 방을 공유할 수 없으므로 남은 프로세스들도 끝낸다.
+        logger.error('Room bus: %s. 서버 프로세스들을 종료함', err)
+        failed = True
+        hub.listener.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(FLAGS.drain_timeout + 1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    if bus_dir:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+def run_single_process_server():
+    '''
+    --handoff_path 로 이전 서버가 동작 중이면 그 listen 소켓을 넘겨받고, 아니면 새로 만든다.
+    '''
+    server_sock = None
+    predecessor = None
+    if FLAGS.handoff_path:
+        taken_over = handoff.take_over(FLAGS.handoff_path)
+        if taken_over:
+            server_sock, predecessor = taken_over
+    if not server_sock:
+        server_sock = make_server_socket(reuse_port=False)
+
+    server_backplane = make_backplane()
+    if FLAGS.chatlog_dir:
+        if predecessor:
+            # 이전 서버가 chat log 를 닫을 때까지 기다린다. 그동안 새 접속은 accept 큐에서 기다린다.
+            logger.info('Handoff: 이전 서버가 종료하기를 기다리는 중')
+            handoff.wait_for_exit(predecessor)
+        open_chat_log(server_backplane)
+    elif predecessor:
+        predecessor.close()
+
+    handoff_listener = None
+    if FLAGS.handoff_path:
+        handoff_listener = handoff.HandoffListener(FLAGS.handoff_path, server_sock, on_handoff=request_drain)
+        handoff_listener.start()
+    try:
+        run_server(server_sock, server_backplane, FLAGS.metrics_port)
+    finally:
+        if chat_log:
+            chat_log.close()
+        # 다음 서버는 이 연결이 닫히는 것을 보고 이 프로세스가 끝난 것을 안다.
+        if handoff_listener:
+            handoff_listener.close()
+
+def main(args):
+    if not FLAGS.port:
+        print('서버의 Port 번호를 지정해야 됩니다.')
+        sys.exit(2)
+
+    if FLAGS.chatlog_dir and (FLAGS.processes > 1 or FLAGS.backplane != 'local'):
+        print('--chatlog_dir 은 --processes 나 --backplane=redis 와 함께 쓸 수 없습니다.')
+        sys.exit(2)
+
+    if FLAGS.handoff_path and FLAGS.processes > 1:
+        print('--handoff_path 는 --processes 와 함께 쓸 수 없습니다.')
+        sys.exit(2)
+
+    global json_codec
+    try:
+        json_codec = codec.make_json_codec(FLAGS.json_codec)
+    except ValueError as err:
+        print(err)
+        sys.exit(2)
+
+    log.start(FLAGS.verbosity, FLAGS.log_queue_size)
+    if FLAGS.format == 'json':
+        logger.info('JSON codec: %s', json_codec.name)
+
+    if FLAGS.processes > 1:
+        run_multiprocess_server()
+    else:
+        run_single_process_server()
 
 if __name__ == '__main__':
     app.run(main)
@@ -0,0 +1,24 @@
+'''
+chat_server 모듈들은 같은 directory 에서 서로를 import 하므로 그 directory 를 path 에 넣는다.
+server 모듈의 FLAGS 는 명령행 없이 기본값으로 쓴다. 바꿔야 하면 absl.testing.flagsaver 를 쓴다.
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from absl import flags
+
+import server
+
+flags.FLAGS.mark_as_parsed()
+
+
+@pytest.fixture(autouse=True, scope='session')
+def wakeup_socket():
+    # 연결이 보낼 데이터를 알릴 때 main 쓰레드를 깨우는 socket 이 필요하다.
+    server.init_wakeup()
+    yield
+    server.wakeup_receiver.close()
+    server.wakeup_sender.close()
@@ -0,0 +1,22 @@
+'''여러 test 에서 쓰는 가짜 객체들'''
+
+
+class FakeSocket:
+    '''sendmsg() 에 넘어온 버퍼들 중 num_sent 바이트만 보낸 것으로 한다.'''
+    def __init__(self, num_sent=None):
+        self.num_sent = num_sent
+        self.sent = b''
+        self.closed = False
+        # sendmsg() 도중에 부를 함수. 작업 쓰레드가 그 사이에 끼어든 상황을 만든다.
+        self.during_send = None
+
+    def sendmsg(self, buffers):
+        if self.during_send:
+            self.during_send()
+        data = b''.join(bytes(buffer) for buffer in buffers)
+        num_sent = len(data) if self.num_sent is None else self.num_sent
+        self.sent += data[:num_sent]
+        return num_sent
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,63 @@
+import pytest
+
+from admission import PRUNE_INTERVAL, AdmissionControl, TokenBucket
+
+
+def test_token_bucket_refills_up_to_burst():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time(0) == pytest.approx(0.5)
+    assert bucket.take(0.5)
+    assert not bucket.take(0.5)
+    # 오래 쉬어도 burst 개까지만 모인다.
+    assert sum(bucket.take(100) for _ in range(10)) == 3
+
+
+def test_token_bucket_ignores_clock_going_back():
+    bucket = TokenBucket(rate=1, burst=1, now=10)
+    assert bucket.take(10)
+    assert not bucket.take(5)
+    assert bucket.take(11)
+
+
+def test_global_rate():
+    control = AdmissionControl(rate=10, burst=2, per_ip_rate=0, per_ip_burst=0, now=0)
+    assert [control.admit(f'10.0.0.{i}', 0) for i in range(3)] == [None, None, 'rate']
+    assert control.wait_time(0) == pytest.approx(0.1)
+    assert control.admit('10.0.0.9', 0.1) is None
+    assert control.ip_buckets == {}
+
+
+def test_per_ip_rate():
+    control = AdmissionControl(rate=0, burst=0, per_ip_rate=1, per_ip_burst=2, now=0)
+    assert [control.admit('10.0.0.1', 0) for _ in range(3)] == [None, None, 'per_ip']
+    assert control.admit('10.0.0.2', 0) is None
+    assert control.admit('10.0.0.1', 1) is None
+    assert control.wait_time(0) == 0
+
+
+def test_rate_rejection_keeps_per_ip_token():
+    control = AdmissionControl(rate=1, burst=1, per_ip_rate=1, per_ip_burst=1, now=0)
+    assert control.admit('10.0.0.1', 0) is None
+    # 서버 전체 token 이 없어서 거절된 IP 는 자기 token 을 잃지 않는다.
+    assert control.admit('10.0.0.2', 0) == 'rate'
+    assert control.admit('10.0.0.2', 0.5) == 'rate'
+    assert control.admit('10.0.0.2', 1) is None
+
+
+def test_per_ip_rejection_keeps_global_token():
+    control = AdmissionControl(rate=1, burst=1, per_ip_rate=1, per_ip_burst=1, now=0)
+    control.ip_buckets['10.0.0.1'] = TokenBucket(1, 1, 0)
+    control.ip_buckets['10.0.0.1'].take(0)
+    assert control.admit('10.0.0.1', 0) == 'per_ip'
+    assert control.admit('10.0.0.2', 0) is None
+
+
+def test_prune_drops_full_buckets():
+    control = AdmissionControl(rate=0, burst=0, per_ip_rate=1, per_ip_burst=2, now=0)
+    control.admit('10.0.0.1', 0)
+    control.admit('10.0.0.2', PRUNE_INTERVAL - 0.5)
+    control.admit('10.0.0.3', PRUNE_INTERVAL)
+    # 10.0.0.1 은 다 채워졌으므로 지우고, 방금 token 을 쓴 IP 들은 남긴다.
+    assert sorted(control.ip_buckets) == ['10.0.0.2', '10.0.0.3']
+    assert control.next_prune == 2 * PRUNE_INTERVAL
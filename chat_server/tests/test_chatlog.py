@@ -0,0 +1,161 @@
+import errno
+import os
+import threading
+
+import pytest
+
+import backplane
+import chatlog
+
+
+def open_log(directory, **kwargs):
+    chat_log = chatlog.ChatLog(str(directory), 'json', history_depth=3, **kwargs)
+    rooms, last_room_id = chat_log.recover()
+    chat_log.start()
+    return chat_log, rooms, last_room_id
+
+
+def test_rooms_and_recent_chats_survive_restart(tmp_path):
+    chat_log, _, _ = open_log(tmp_path)
+    chat_log.room_created(1, '하나')
+    chat_log.room_created(2, '둘')
+    for i in range(5):
+        chat_log.chat(1, [f'chat{i}'.encode()])
+    chat_log.room_destroyed(2)
+    chat_log.close()
+
+    chat_log, rooms, last_room_id = open_log(tmp_path)
+    assert rooms == {1: '하나'}
+    assert last_room_id == 2
+    assert chat_log.recent_chats(1) == [[b'chat2'], [b'chat3'], [b'chat4']]
+    assert chat_log.recent_chats(2) == []
+    chat_log.close()
+
+
+@pytest.mark.parametrize('torn', [3, chatlog.RECORD_HEADER.size + 2])
+def test_torn_tail_is_truncated(tmp_path, torn):
+    chat_log, _, _ = open_log(tmp_path)
+    chat_log.room_created(1, 'room')
+    chat_log.chat(1, [b'kept'])
+    chat_log.close()
+    path = chat_log.segment_path(chat_log.segment_no)
+    size = os.path.getsize(path)
+    # 쓰다 만 기록처럼 다음 기록의 앞부분만 남긴다.
+    with open(path, 'ab') as f:
+        f.write(chatlog.encode_record(chatlog.RecordKind.CHAT, 1, b'\0\0\0\4lost')[:torn])
+
+    chat_log, rooms, _ = open_log(tmp_path)
+    assert os.path.getsize(path) == size
+    assert rooms == {1: 'room'}
+    assert chat_log.recent_chats(1) == [[b'kept']]
+    chat_log.chat(1, [b'after'])
+    chat_log.close()
+
+    chat_log, _, _ = open_log(tmp_path)
+    assert chat_log.recent_chats(1) == [[b'kept'], [b'after']]
+    chat_log.close()
+
+
+def test_corrupted_record_in_older_segment_is_kept(tmp_path):
+    chat_log, _, _ = open_log(tmp_path)
+    chat_log.room_created(1, 'room')
+    chat_log.close()
+    path = chat_log.segment_path(chat_log.segment_no)
+    # 다음 실행이 새 segment 를 열었으므로 위 segment 는 더 이상 마지막이 아니다.
+    chat_log, _, _ = open_log(tmp_path)
+    chat_log.close()
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'X')
+    size = os.path.getsize(path)
+
+    chat_log, rooms, _ = open_log(tmp_path)
+    chat_log.close()
+    assert rooms == {}
+    assert os.path.getsize(path) == size
+
+
+def test_append_waits_when_pending_is_full(tmp_path):
+    chat_log = chatlog.ChatLog(str(tmp_path), 'json', history_depth=3, max_pending=2)
+    chat_log.recover()
+    chat_log.open_next_segment()
+    chat_log.room_created(1, 'room')
+    chat_log.chat(1, [b'one'])
+
+    # writer 쓰레드가 아직 없으므로 세 번째 기록은 큐가 빌 때까지 기다린다.
+    appended = threading.Event()
+    appender = threading.Thread(target=lambda: (chat_log.chat(1, [b'two']), appended.set()))
+    appender.start()
+    assert not appended.wait(0.1)
+    assert chat_log.append_waits == 1
+
+    chat_log.writer = threading.Thread(target=chat_log.write_loop)
+    chat_log.writer.start()
+    assert appended.wait(5)
+    appender.join()
+    chat_log.close()
+    assert chat_log.records_written == 3
+
+
+def test_close_wakes_waiting_appenders(tmp_path):
+    chat_log = chatlog.ChatLog(str(tmp_path), 'json', history_depth=3, max_pending=1)
+    chat_log.recover()
+    chat_log.room_created(1, 'room')
+    appender = threading.Thread(target=chat_log.chat, args=(1, [b'dropped']))
+    appender.start()
+    chat_log.close()
+    appender.join(5)
+    assert not appender.is_alive()
+
+
+def test_room_destroyed_is_decided_by_backplane():
+    hub = backplane.LoopbackHub()
+    first, second = backplane.LoopbackBackplane(hub), backplane.LoopbackBackplane(hub)
+    destroyed = []
+    first.on_room_destroyed = second.on_room_destroyed = destroyed.append
+
+    room_id = first.create_room('room', 1, 'a')
+    assert second.join_room(room_id, 2, 'b') == 'room'
+    # 첫 node 의 마지막 멤버가 나가도 다른 node 에 멤버가 있으면 방은 남는다.
+    first.leave_room(room_id, 1, 'left')
+    assert destroyed == []
+    second.leave_room(room_id, 2, 'left')
+    assert destroyed == [room_id]
+    assert first.join_room(room_id, 3, 'c') is None
+
+    # 서버 종료로 node 가 빠지는 것은 방 삭제로 기록하지 않는다.
+    room_id = first.create_room('kept', 1, 'a')
+    first.close()
+    assert destroyed == [room_id - 1]
+
+
+class FailingFile:
+    '''쓰기가 디스크 부족으로 실패하는 segment 파일'''
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def close(self):
+        self.f.close()
+
+
+def test_write_failure_stops_log_without_blocking_appenders(tmp_path):
+    failures = []
+    chat_log = chatlog.ChatLog(str(tmp_path), 'json', history_depth=3, max_pending=2, on_failure=lambda: failures.append(True))
+    chat_log.recover()
+    chat_log.start()
+    chat_log.segment_file = FailingFile(chat_log.segment_file)
+
+    # writer 가 멈춘 뒤에도 큐가 가득 찬 채로 기다리지 않고 돌아온다.
+    appender = threading.Thread(target=lambda: [chat_log.chat(1, [b'chat%d' % i]) for i in range(100)])
+    appender.start()
+    appender.join(5)
+    assert not appender.is_alive()
+    chat_log.writer.join(5)
+    assert chat_log.failed and failures == [True]
+    assert chat_log.records_written == 0
+
+    chat_log.chat(1, [b'after'])
+    chat_log.close()
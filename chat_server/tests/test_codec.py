@@ -0,0 +1,58 @@
+import pytest
+
+import codec
+from codec import InvalidMessage, NoTypeFieldInMessage, UnknownTypeInMessage
+
+# 이 환경에 설치된 JSON codec 들
+CODEC_NAMES = [name for name, codec_class in codec.json_codecs.items() if codec_class]
+
+
+@pytest.fixture(params=CODEC_NAMES)
+def json_codec(request):
+    return codec.make_json_codec(request.param)
+
+
+def test_decode_returns_fields_as_attributes(json_codec):
+    msg_type, msg = json_codec.decode(b'{"type": "CSChat", "text": "hello"}')
+    assert msg_type == 'CSChat'
+    assert msg.text == 'hello'
+
+
+def test_decode_fills_defaults(json_codec):
+    msg_type, msg = json_codec.decode(b'{"type": "CSRooms", "cursor": 3}')
+    assert msg_type == 'CSRooms'
+    assert (msg.cursor, msg.limit, msg.summary) == (3, 0, False)
+
+
+def test_decode_accepts_memoryview(json_codec):
+    _, msg = json_codec.decode(memoryview(b'{"type": "CSJoinRoom", "roomId": 7}'))
+    assert msg.roomId == 7
+
+
+@pytest.mark.parametrize('data, error', [
+    (b'{"text": "hello"}', NoTypeFieldInMessage),
+    (b'{"type": "CSUnknown"}', UnknownTypeInMessage),
+    (b'{"type": "CSChat"}', InvalidMessage),
+    (b'{"type": "CSChat", "text": 1}', InvalidMessage),
+    (b'{"type": "CSJoinRoom", "roomId": "1"}', InvalidMessage),
+    # bool 은 int 의 하위 타입이지만 숫자 필드에 받지 않는다.
+    (b'{"type": "CSJoinRoom", "roomId": true}', InvalidMessage),
+    (b'{"type": "CSRooms", "summary": 1}', InvalidMessage),
+    (b'[1, 2]', InvalidMessage),
+    (b'not json', InvalidMessage),
+    # type 이 문자열이 아니면 dict 에서 찾기 전에 거른다.
+    (b'{"type": [1]}', InvalidMessage),
+    (b'{"type": {}}', InvalidMessage),
+    (b'{"type": 1}', InvalidMessage),
+    # 잘못된 UTF-8
+    (b'{"type": "CSChat", "text": "\xff"}', InvalidMessage),
+    (b'\xff\xfe', InvalidMessage),
+])
+def test_invalid_messages_raise_invalid_message(json_codec, data, error):
+    with pytest.raises(error):
+        json_codec.decode(data)
+
+
+def test_unknown_codec_name():
+    with pytest.raises(ValueError):
+        codec.make_json_codec('nope')
@@ -0,0 +1,61 @@
+import pytest
+from absl.testing import flagsaver
+
+import framing
+import message_pb2 as pb
+import server
+from codec import NoTypeFieldInMessage
+from framing import Framing
+
+from .helpers import FakeSocket
+
+
+@pytest.mark.parametrize('name, message_type', pb.Type.MessageType.items())
+def test_envelope_field_number_is_message_type_plus_one(name, message_type):
+    field = pb.Envelope.DESCRIPTOR.fields_by_name[name.lower()]
+    assert field.number == message_type + 1
+    assert field.containing_oneof.name == 'body'
+    assert server.message_names[message_type] == field.message_type.name
+
+
+@pytest.mark.parametrize('messages', [
+    [pb.Type(type=pb.Type.MessageType.SC_CHAT), pb.SCChat(member='m', text='안녕')],
+    [pb.Type(type=pb.Type.MessageType.SC_SYSTEM_MESSAGE), pb.SCSystemMessage(text='x' * 300)],
+    [pb.Type(type=pb.Type.MessageType.SC_ROOMS_RESULT), pb.SCRoomsResult(rooms=[pb.SCRoomsResult.RoomInfo(roomId=1, title='t')])],
+    [pb.Type(type=pb.Type.MessageType.SC_PONG), pb.SCPong(nonce=3)],
+])
+def test_wrap_envelopes_matches_protobuf_serialization(messages):
+    bodies = [msg.SerializeToString() for msg in messages]
+    name = pb.Type.MessageType.Name(messages[0].type).lower()
+    expected = pb.Envelope(**{name: messages[1]}).SerializeToString()
+    assert server.wrap_envelopes(messages, bodies) == [expected]
+
+
+@flagsaver.flagsaver(format='protobuf')
+def test_encode_messages_with_envelope():
+    messages = server.system_messages('hello')
+    encoded = server.encode_messages(messages, Framing.VARINT, envelope=True)
+    [frame] = framing.split_frames(encoded, Framing.VARINT)
+    envelope = pb.Envelope.FromString(bytes(frame))
+    assert envelope.WhichOneof('body') == 'sc_system_message'
+    assert envelope.sc_system_message.text == 'hello'
+
+
+@flagsaver.flagsaver(format='protobuf')
+def test_process_envelope_dispatches_and_replies_in_envelope():
+    connection = server.UserConnection(FakeSocket(), ('test', 0))
+    connection.envelope = True
+    connection.process_message(pb.Envelope(cs_ping=pb.CSPing(nonce=7)).SerializeToString())
+
+    [frame] = framing.split_frames(b''.join(bytes(buffer) for buffer in connection.pending_data), Framing.LEGACY)
+    reply = pb.Envelope.FromString(bytes(frame))
+    assert reply.WhichOneof('body') == 'sc_pong'
+    assert reply.sc_pong.nonce == 7
+
+
+@flagsaver.flagsaver(format='protobuf')
+def test_empty_envelope_is_rejected():
+    connection = server.UserConnection(FakeSocket(), ('test', 0))
+    connection.envelope = True
+    with pytest.raises(NoTypeFieldInMessage):
+        connection.process_message(pb.Envelope().SerializeToString())
@@ -0,0 +1,90 @@
+import pytest
+from absl.testing import flagsaver
+
+import framing
+import server
+from framing import Framing, ReceiveBuffer
+
+from .helpers import FakeSocket
+
+
+def feed_in_chunks(receive_buffer, data, chunk_size):
+    frames = []
+    for i in range(0, len(data), chunk_size):
+        receive_buffer.feed(data[i:i + chunk_size])
+        frames.extend(bytes(frame) for frame in receive_buffer.next_frames())
+    return frames
+
+
+@pytest.mark.parametrize('framing_type', list(Framing))
+@pytest.mark.parametrize('chunk_size', [1, 3, 4096])
+def test_frames_round_trip(framing_type, chunk_size):
+    bodies = [b'', b'a', b'x' * 127, b'y' * 128, b'z' * 300]
+    receive_buffer = ReceiveBuffer(capacity=16)
+    receive_buffer.framing = framing_type
+    data = framing.frame_bodies(bodies, framing_type, 1 << 20)
+    assert feed_in_chunks(receive_buffer, data, chunk_size) == bodies
+    assert [bytes(frame) for frame in framing.split_frames(data, framing_type)] == bodies
+
+
+def test_varint_header_sizes():
+    assert framing.encode_header(Framing.VARINT, 127) == b'\x7f'
+    assert framing.encode_header(Framing.VARINT, 128) == b'\x80\x01'
+    assert framing.parse_header(b'\x80', 0, 1, Framing.VARINT) is None
+    with pytest.raises(framing.FramingError):
+        framing.parse_header(b'\x80' * 5, 0, 5, Framing.VARINT)
+
+
+def test_frame_limits():
+    with pytest.raises(framing.FrameTooLarge):
+        framing.frame_bodies([b'x' * 70000], Framing.LEGACY, 1 << 20)
+    framing.frame_bodies([b'x' * 70000], Framing.U32, 1 << 20)
+
+    receive_buffer = ReceiveBuffer(max_frame_size=100)
+    receive_buffer.framing = Framing.U32
+    receive_buffer.feed(framing.encode_header(Framing.U32, 101))
+    with pytest.raises(framing.FrameTooLarge):
+        receive_buffer.next_frames()
+
+
+def test_read_hello():
+    receive_buffer = ReceiveBuffer()
+    hello = framing.make_hello(Framing.VARINT, framing.HELLO_FLAG_ENVELOPE)
+    receive_buffer.feed(hello[:3])
+    assert receive_buffer.read_hello() is None
+    receive_buffer.feed(hello[3:] + framing.encode_header(Framing.VARINT, 2) + b'hi')
+    assert receive_buffer.read_hello() == (Framing.VARINT, framing.HELLO_FLAG_ENVELOPE)
+    assert [bytes(frame) for frame in receive_buffer.next_frames()] == [b'hi']
+
+
+def test_legacy_client_without_hello():
+    receive_buffer = ReceiveBuffer()
+    receive_buffer.feed(framing.encode_header(Framing.LEGACY, 2) + b'hi')
+    assert receive_buffer.read_hello() is False
+    assert [bytes(frame) for frame in receive_buffer.next_frames()] == [b'hi']
+
+
+def test_unknown_framing_in_hello():
+    receive_buffer = ReceiveBuffer()
+    receive_buffer.feed(framing.HELLO_MAGIC + bytes([9, 0]))
+    with pytest.raises(framing.InvalidHello):
+        receive_buffer.read_hello()
+    with pytest.raises(framing.InvalidHello):
+        framing.parse_hello_ack(framing.HELLO_MAGIC + bytes([9, 0]) + b'\x00' * 4)
+
+
+@pytest.mark.parametrize('format_name, accepted', [('protobuf', framing.HELLO_FLAG_ENVELOPE), ('json', 0)])
+def test_server_answers_hello(format_name, accepted):
+    '''서버는 고른 framing 을 그대로 쓰고, envelope 는 protobuf 일 때만 받아들인다.'''
+    with flagsaver.flagsaver(format=format_name, max_frame_size=4096, heartbeat_interval=0):
+        connection = server.UserConnection(FakeSocket(), ('test', 0))
+        connection.socket_buffer.feed(framing.make_hello(Framing.U32, framing.HELLO_FLAG_ENVELOPE | framing.HELLO_FLAG_HEARTBEAT)
+                                      + framing.encode_header(Framing.U32, 3) + b'abc')
+        frames = connection.take_frames()
+
+    assert [bytes(frame) for frame in frames] == [b'abc']
+    assert connection.framing == Framing.U32
+    assert connection.envelope == bool(accepted)
+    assert not connection.heartbeat
+    ack = bytes(connection.pending_data[0])
+    assert framing.parse_hello_ack(ack) == (Framing.U32, accepted, 4096)
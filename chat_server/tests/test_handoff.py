@@ -0,0 +1,114 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import framing
+import handoff
+import server
+
+SERVER_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+
+class Client:
+    '''json 포맷, 기본 framing 으로 말하는 테스트용 클라이언트'''
+    def __init__(self, port, rcvbuf=None):
+        self.sock = socket.socket()
+        if rcvbuf:
+            # 서버가 보낸 데이터가 소켓 버퍼에 다 들어가지 않고 서버에 남게 한다.
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.settimeout(10)
+        self.sock.connect(('127.0.0.1', port))
+        self.buffer = b''
+
+    def send(self, msg_type, **fields):
+        body = json.dumps(dict(type=msg_type, **fields)).encode()
+        self.sock.sendall(framing.encode_header(framing.Framing.LEGACY, len(body)) + body)
+
+    def recv(self):
+        '''메시지 하나를 받는다. 서버가 연결을 닫았으면 None'''
+        while True:
+            header = framing.parse_header(self.buffer, 0, len(self.buffer), framing.Framing.LEGACY)
+            if header and len(self.buffer) >= header[0] + header[1]:
+                body = self.buffer[header[0]:header[0] + header[1]]
+                self.buffer = self.buffer[header[0] + header[1]:]
+                return json.loads(body)
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+
+    def close(self):
+        self.sock.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, handoff_path, engine):
+    process = subprocess.Popen([sys.executable, SERVER_PY, f'--port={port}', f'--handoff_path={handoff_path}', f'--engine={engine}',
+                                '--drain_timeout=10', '--send_high_watermark=0'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(handoff_path):
+        assert process.poll() is None and time.monotonic() < deadline
+        time.sleep(0.05)
+    return process
+
+
+@pytest.mark.parametrize('engine', ['select', 'asyncio'])
+def test_handoff_flushes_in_flight_data_before_old_server_exits(tmp_path, engine):
+    port = free_port()
+    handoff_path = str(tmp_path / 'handoff.sock')
+    old_server = start_server(port, handoff_path, engine)
+    try:
+        sender = Client(port)
+        sender.send('CSCreateRoom', title='room')
+        assert sender.recv()['type'] == 'SCSystemMessage'
+        receiver = Client(port, rcvbuf=4096)
+        receiver.send('CSJoinRoom', roomId=1)
+        assert receiver.recv()['type'] == 'SCSystemMessage'
+
+        # 받는 쪽이 읽지 않으므로 커널 송신 버퍼(최대 수 MB)를 넘는 채팅들이 이전 서버의 송신 큐에 남는다.
+        texts = [f'{i:05d}' + 'x' * 2000 for i in range(5000)]
+        for text in texts:
+            sender.send('CSChat', text=text)
+        # 같은 연결의 메시지는 순서대로 처리되므로 이 응답이 오면 채팅들도 모두 큐에 들어갔다.
+        sender.send('CSRooms')
+        while sender.recv()['type'] != 'SCRoomsResult':
+            pass
+
+        taken_over = handoff.take_over(handoff_path)
+        assert taken_over
+        listen_sock, old_server_conn = taken_over
+        assert listen_sock.getsockname()[1] == port
+        # 남은 데이터를 보내는 동안에는 이전 서버가 살아 있다.
+        time.sleep(0.2)
+        assert old_server.poll() is None
+
+        received = []
+        while (msg := receiver.recv()) is not None:
+            received.append(msg)
+        assert [msg['text'] for msg in received if msg['type'] == 'SCChat'] == texts
+        assert received[-1] == {'type': 'SCSystemMessage', 'text': server.DRAIN_NOTICE}
+
+        handoff.wait_for_exit(old_server_conn)
+        assert old_server.wait(10) == 0
+
+        # 넘겨받은 소켓은 이전 서버가 끝난 뒤에도 새 접속을 받는다.
+        with socket.create_connection(('127.0.0.1', port), timeout=5):
+            conn, _ = listen_sock.accept()
+            conn.close()
+        listen_sock.close()
+        sender.close()
+        receiver.close()
+    finally:
+        old_server.kill()
+        old_server.wait()
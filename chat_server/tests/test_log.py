@@ -0,0 +1,25 @@
+import threading
+
+import log
+
+
+class ThreadRecordingArg:
+    '''문자열로 만들어진 쓰레드를 기록하는 로그 인자'''
+    def __init__(self):
+        self.formatted_on = []
+
+    def __str__(self):
+        self.formatted_on.append(threading.current_thread())
+        return 'arg'
+
+
+def test_messages_are_formatted_on_listener_thread(capsys):
+    log.start(0)
+    arg = ThreadRecordingArg()
+    try:
+        log.logger.info('형식화 [%s]', arg)
+    finally:
+        log.stop()
+
+    assert '형식화 [arg]' in capsys.readouterr().out
+    assert arg.formatted_on and threading.current_thread() not in arg.formatted_on
@@ -0,0 +1,203 @@
+import json
+import random
+import threading
+import types
+
+import pytest
+from absl.testing import flagsaver
+
+import backplane
+import framing
+import server
+
+from .helpers import FakeSocket
+
+
+@pytest.fixture
+def chat_backplane(monkeypatch):
+    chat_backplane = backplane.LoopbackBackplane()
+    chat_backplane.start(on_deliver=server.on_backplane_deliver, on_shutdown=lambda: None)
+    monkeypatch.setattr(server, 'chat_backplane', chat_backplane)
+    monkeypatch.setattr(server, 'rooms', {})
+    return chat_backplane
+
+
+def connect(name):
+    connection = server.UserConnection(FakeSocket(), ('test', 0))
+    connection.on_cs_name(types.SimpleNamespace(name=name))
+    return connection
+
+
+def join(connection, room_id):
+    connection.on_cs_join_room(types.SimpleNamespace(roomId=room_id))
+
+
+def leave(connection):
+    connection.on_cs_leave_room(types.SimpleNamespace())
+
+
+def directory_names(chat_backplane, room_id):
+    rooms, _ = chat_backplane.list_rooms(room_id - 1, 1)
+    if not rooms or rooms[0][0] != room_id:
+        return None
+    return sorted(rooms[0][3])
+
+
+def run_concurrently(workers):
+    barrier = threading.Barrier(len(workers))
+    errors = []
+
+    def run(worker):
+        barrier.wait()
+        try:
+            worker()
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_concurrent_join_rename_leave(chat_backplane):
+    owner = connect('owner')
+    owner.on_cs_create_room(types.SimpleNamespace(title='room'))
+    room = owner.current_room
+
+    connections = [connect(f'user{i}') for i in range(200)]
+    # 짝수 번째는 입장하고 이름을 바꾼 뒤 남고, 홀수 번째는 입장했다가 나간다.
+    stays = connections[::2]
+
+    def worker(group):
+        def run():
+            shuffled = random.Random(len(group)).sample(group, len(group))
+            for connection in shuffled:
+                join(connection, room.room_id)
+            for connection in shuffled:
+                if connection in stays:
+                    connection.on_cs_name(types.SimpleNamespace(name=f'{connection.name}-renamed'))
+                else:
+                    leave(connection)
+        return run
+
+    run_concurrently([worker(connections[i::8]) for i in range(8)])
+
+    expected = [owner] + stays
+    assert server.rooms[room.room_id] is room
+    assert sorted(room.members) == sorted(connection.conn_id for connection in expected)
+    assert all(room.members[connection.conn_id] is connection for connection in expected)
+    assert directory_names(chat_backplane, room.room_id) == sorted(connection.name for connection in expected)
+    assert all(connection.name.endswith('-renamed') for connection in stays)
+    assert all(connection.current_room is None for connection in connections if connection not in stays)
+
+
+def test_concurrent_leave_of_every_member_removes_room(chat_backplane):
+    owner = connect('owner')
+    owner.on_cs_create_room(types.SimpleNamespace(title='room'))
+    room_id = owner.current_room.room_id
+    connections = [owner] + [connect(f'user{i}') for i in range(100)]
+    for connection in connections[1:]:
+        join(connection, room_id)
+    assert len(server.rooms[room_id].members) == len(connections)
+
+    run_concurrently([lambda group=connections[i::4]: [connection.disconnect() for connection in group] for i in range(4)])
+
+    assert room_id not in server.rooms
+    assert directory_names(chat_backplane, room_id) is None
+    # 방이 없어진 뒤에는 입장할 수 없다.
+    late = connect('late')
+    join(late, room_id)
+    assert late.current_room is None
+
+
+def test_rejoin_while_others_leave(chat_backplane):
+    owner = connect('owner')
+    owner.on_cs_create_room(types.SimpleNamespace(title='room'))
+    room_id = owner.current_room.room_id
+    connections = [connect(f'user{i}') for i in range(16)]
+
+    def churn(connection):
+        def run():
+            for _ in range(50):
+                join(connection, room_id)
+                leave(connection)
+            join(connection, room_id)
+        return run
+
+    run_concurrently([churn(connection) for connection in connections])
+
+    room = server.rooms[room_id]
+    expected = [owner] + connections
+    assert sorted(room.members) == sorted(connection.conn_id for connection in expected)
+    assert directory_names(chat_backplane, room_id) == sorted(connection.name for connection in expected)
+
+
+class RecordingConnection(server.UserConnection):
+    '''broadcast 를 받은 순서대로 연결 번호를 deliveries 에 남기는 연결'''
+    def __init__(self, member_id, deliveries):
+        super().__init__(FakeSocket(), ('test', member_id))
+        self.deliveries = deliveries
+
+    def send_encoded(self, encoded, descriptions=None, kind=server.PendingKind.RESPONSE):
+        self.deliveries.append(self.conn_id)
+
+
+def test_drain_of_large_room_keeps_broadcast_order(chat_backplane):
+    deliveries = []
+    members = [RecordingConnection(i, deliveries) for i in range(10000)]
+    room_id = chat_backplane.create_room('drain', members[0].conn_id, members[0].name)
+    room = server.join_local_room(room_id, 'drain', members[0])
+    members[0].current_room = room
+    for member in members[1:]:
+        assert chat_backplane.join_room(room_id, member.conn_id, member.name) == 'drain'
+        assert room.add_member(member)
+        member.current_room = room
+
+    # 접속 종료는 입장 순서와 상관없이 일어나고, 그 사이의 broadcast 는 남은 멤버들에게 입장 순서대로 간다.
+    drain_order = random.Random(0).sample(members, len(members))
+    for start in range(0, len(drain_order), 1000):
+        deliveries.clear()
+        server.deliver_to_local_members(room, [{'type': 'SCChat', 'member': 'm', 'text': f'{start}'}])
+        assert deliveries == [member.conn_id for member in members if member.current_room]
+        for member in drain_order[start:start + 1000]:
+            member.disconnect()
+
+    assert room.closed and not room.members
+    assert room_id not in server.rooms
+    assert directory_names(chat_backplane, room_id) is None
+
+
+def received_chats(connection):
+    '''연결의 송신 큐에 쌓인 SCChat 들의 text'''
+    data = b''.join(bytes(buffer) for buffer in connection.pending_data)
+    texts = []
+    offset = 0
+    while offset < len(data):
+        header_size, body_size = framing.parse_header(data, offset, len(data), framing.Framing.LEGACY)
+        msg = json.loads(data[offset + header_size:offset + header_size + body_size])
+        if msg['type'] == 'SCChat':
+            texts.append(msg['text'])
+        offset += header_size + body_size
+    return texts
+
+
+@flagsaver.flagsaver(history_depth=3)
+def test_join_replays_recent_chats(chat_backplane):
+    owner = connect('owner')
+    owner.on_cs_create_room(types.SimpleNamespace(title='room'))
+    room_id = owner.current_room.room_id
+    for i in range(4):
+        owner.on_cs_chat(types.SimpleNamespace(text=f'chat{i}'))
+    # 다른 서버의 멤버가 보낸 채팅도 이 서버에 방이 있는 동안에는 기록된다.
+    server.on_backplane_deliver(room_id, [{'type': 'SCChat', 'member': 'remote', 'text': 'remote'}])
+
+    late = connect('late')
+    join(late, room_id)
+    assert received_chats(late) == ['chat2', 'chat3', 'remote']
+
+    # 다음 채팅부터는 broadcast 로 받는다.
+    owner.on_cs_chat(types.SimpleNamespace(text='after'))
+    assert received_chats(late) == ['chat2', 'chat3', 'remote', 'after']
@@ -0,0 +1,58 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+def test_registry_renders_prometheus_text():
+    registry = metrics.Registry()
+    messages = registry.register(metrics.Counter('chat_messages_total', '받은 메시지 수', ('type',)))
+    registry.register(metrics.Gauge('chat_connections', '접속 수', lambda: 3))
+    registry.register(metrics.Gauge('chat_queue_depth', '큐 깊이', lambda: [(('0',), 2), (('1',), 0)], ('worker',)))
+    latency = registry.register(metrics.Histogram('chat_latency_seconds', '처리 시간', [0.1, 0.01], ('engine',)))
+
+    messages.inc('CSChat')
+    messages.inc('CSChat', amount=2)
+    messages.inc('a"b\\c\nd')
+    for value in [0.005, 0.01, 0.05, 1]:
+        latency.observe(value, 'select')
+
+    assert registry.render().decode('utf-8') == '\n'.join([
+        '# HELP chat_messages_total 받은 메시지 수',
+        '# TYPE chat_messages_total counter',
+        'chat_messages_total{type="CSChat"} 3',
+        'chat_messages_total{type="a\\"b\\\\c\\nd"} 1',
+        '# HELP chat_connections 접속 수',
+        '# TYPE chat_connections gauge',
+        'chat_connections 3',
+        '# HELP chat_queue_depth 큐 깊이',
+        '# TYPE chat_queue_depth gauge',
+        'chat_queue_depth{worker="0"} 2',
+        'chat_queue_depth{worker="1"} 0',
+        '# HELP chat_latency_seconds 처리 시간',
+        '# TYPE chat_latency_seconds histogram',
+        # bucket 경계와 같은 값은 그 bucket 에 들어가고, 개수는 누적된다.
+        'chat_latency_seconds_bucket{engine="select",le="0.01"} 2',
+        'chat_latency_seconds_bucket{engine="select",le="0.1"} 3',
+        'chat_latency_seconds_bucket{engine="select",le="+Inf"} 4',
+        'chat_latency_seconds_sum{engine="select"} 1.065',
+        'chat_latency_seconds_count{engine="select"} 4',
+    ]) + '\n'
+
+
+def test_serves_metrics_on_localhost_by_default():
+    httpd = metrics.serve(0)
+    try:
+        host, port = httpd.server_address[:2]
+        assert host == '127.0.0.1'
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+            assert response.read() == metrics.registry.render()
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/other', timeout=5)
+        assert excinfo.value.code == 404
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
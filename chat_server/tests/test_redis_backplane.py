@@ -0,0 +1,215 @@
+import queue
+import socket
+import threading
+import time
+
+import pytest
+
+import backplane
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def redis_server():
+    server = fakeredis.TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class Node:
+    '''RedisBackplane 과 그 backplane 이 전달한 메시지, 종료 요청들'''
+    def __init__(self, redis_server):
+        host, port = redis_server.server_address
+        self.backplane = backplane.RedisBackplane(f'{host}:{port}', 'test', encode=str.encode, decode=bytes.decode)
+        self.delivered = queue.Queue()
+        self.shutdowns = queue.Queue()
+        self.backplane.start(on_deliver=lambda room_id, messages: self.delivered.put((room_id, messages)),
+                             on_shutdown=lambda: self.shutdowns.put(True))
+
+    def close(self):
+        self.backplane.close()
+
+
+@pytest.fixture
+def nodes(redis_server):
+    nodes = [Node(redis_server), Node(redis_server)]
+    yield nodes
+    for node in nodes:
+        node.close()
+
+
+def drop_connection(conn: backplane.RespConnection):
+    try:
+        conn.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        # 이미 끊어져서 닫혔다.
+        pass
+
+
+def test_publish_reaches_other_node(nodes):
+    first, second = nodes
+    room_id = first.backplane.create_room('room', 1, 'a')
+    assert second.backplane.join_room(room_id, 2, 'b') == 'room'
+
+    for i in range(100):
+        first.backplane.publish(room_id, f'chat{i}')
+    assert [second.delivered.get(timeout=5) for _ in range(100)] == [(room_id, f'chat{i}') for i in range(100)]
+    # 자기가 publish 한 메시지는 받지 않는다.
+    assert first.delivered.empty()
+
+    # 응답을 기다리지 않는 명령도 같은 node 의 다음 명령보다 먼저 처리된다.
+    second.backplane.rename_member(room_id, 2, 'renamed')
+    assert second.backplane.list_rooms() == ([(room_id, 'room', 2, ('a', 'renamed'))], 0)
+
+
+def test_join_returns_after_subscribe_is_confirmed(nodes):
+    first, second = nodes
+    for i in range(20):
+        room_id = first.backplane.create_room(f'room{i}', 1, 'a')
+        second.backplane.join_room(room_id, 2, 'b')
+        assert not second.backplane.subscribe_acks
+        # 입장이 반환된 직후에 다른 node 가 publish 한 메시지도 받는다.
+        first.backplane.publish(room_id, 'hello')
+        assert second.delivered.get(timeout=5) == (room_id, 'hello')
+
+
+def test_shutdown_right_after_start_is_not_missed(nodes):
+    first, second = nodes
+    second.backplane.request_shutdown()
+    assert first.shutdowns.get(timeout=5)
+    assert second.shutdowns.get(timeout=5)
+
+
+def test_pipelined_replies_reach_their_callers(nodes):
+    commands = nodes[0].backplane
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append((i, commands.execute('ECHO', str(i))))) for i in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [(i, str(i).encode()) for i in range(50)]
+
+
+def test_error_reply_keeps_pipeline_in_order():
+    # fakeredis 는 오류로 응답한 뒤 연결을 끊으므로, 명령 이름이 ERR 로 시작하면 오류로 응답하는 가짜 서버를 쓴다.
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def serve(conn):
+        reader = conn.makefile('rb')
+        while line := reader.readline():
+            args = [reader.readline() and reader.readline()[:-2] for _ in range(int(line[1:]))]
+            if args[0] == b'SUBSCRIBE':
+                conn.sendall(b''.join(b'*3\r\n$9\r\nsubscribe\r\n$%d\r\n%s\r\n:1\r\n' % (len(channel), channel) for channel in args[1:]))
+            elif args[0].startswith(b'ERR'):
+                conn.sendall(b'-ERR ' + args[0] + b'\r\n')
+            else:
+                conn.sendall(b'+' + args[0] + b'\r\n')
+
+    def accept_loop():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    commands = backplane.RedisBackplane('127.0.0.1:%d' % listener.getsockname()[1], 'test', encode=str.encode, decode=bytes.decode)
+    commands.start(on_deliver=None, on_shutdown=None)
+    try:
+        with pytest.raises(backplane.RedisError):
+            commands.execute('ERR1')
+        commands.execute_async('ERR2')
+        assert commands.execute('OK3') == b'OK3'
+    finally:
+        commands.close()
+        listener.close()
+
+
+def test_reconnects_and_resubscribes(nodes, monkeypatch):
+    monkeypatch.setattr(backplane, 'RECONNECT_INTERVAL', 0.05)
+    first, second = nodes
+    room_id = first.backplane.create_room('room', 1, 'a')
+    second.backplane.join_room(room_id, 2, 'b')
+
+    drop_connection(second.backplane.subscriber)
+    drop_connection(first.backplane.commands)
+
+    # 명령 연결이 다시 맺어지면 publish 가 다시 전달되고, subscribe 연결도 방을 다시 subscribe 한다.
+    for _ in range(100):
+        try:
+            first.backplane.publish(room_id, 'after')
+        except backplane.BackplaneError:
+            pass
+        try:
+            if second.delivered.get(timeout=0.05) == (room_id, 'after'):
+                break
+        except queue.Empty:
+            pass
+    else:
+        pytest.fail('다시 연결한 뒤에도 메시지가 전달되지 않음')
+    assert first.shutdowns.empty() and second.shutdowns.empty()
+
+    second.backplane.request_shutdown()
+    assert first.shutdowns.get(timeout=5)
+
+
+def test_shutdown_when_redis_is_gone(redis_server, monkeypatch):
+    monkeypatch.setattr(backplane, 'RECONNECT_ATTEMPTS', 2)
+    monkeypatch.setattr(backplane, 'RECONNECT_INTERVAL', 0.01)
+    node = Node(redis_server)
+    redis_server.shutdown()
+    redis_server.server_close()
+
+    drop_connection(node.backplane.subscriber)
+    drop_connection(node.backplane.commands)
+    assert node.shutdowns.get(timeout=5)
+    with pytest.raises(backplane.BackplaneError):
+        node.backplane.execute('PING')
+    node.close()
+
+
+def test_requests_fail_fast_while_reconnecting(redis_server, monkeypatch):
+    monkeypatch.setattr(backplane, 'RECONNECT_INTERVAL', 0.5)
+    node = Node(redis_server)
+    room_id = node.backplane.create_room('room', 1, 'a')
+    redis_server.shutdown()
+    redis_server.server_close()
+
+    drop_connection(node.backplane.subscriber)
+    drop_connection(node.backplane.commands)
+    deadline = time.monotonic() + 5
+    while node.backplane.commands_connected or node.backplane.subscriber_connected:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    # 다시 연결하는 동안의 요청은 재시도가 끝나기를 기다리지 않고 바로 실패한다.
+    started = time.monotonic()
+    with pytest.raises(backplane.BackplaneError):
+        node.backplane.execute('PING')
+    with pytest.raises(backplane.BackplaneError):
+        node.backplane.join_room(room_id, 2, 'b')
+    assert time.monotonic() - started < 0.2
+    assert node.shutdowns.empty()
+    node.close()
+
+
+def test_list_rooms_pages(nodes):
+    first, second = nodes
+    room_ids = [first.backplane.create_room(f'room{i}', i, f'a{i}') for i in range(5)]
+    second.backplane.join_room(room_ids[1], 1, 'b')
+    first.backplane.leave_room(room_ids[3], 3, '방폭')
+
+    rooms, cursor = second.backplane.list_rooms(limit=2)
+    assert rooms == [(room_ids[0], 'room0', 1, ('a0',)), (room_ids[1], 'room1', 2, ('a1', 'b'))]
+    assert cursor == room_ids[1]
+    rooms, cursor = second.backplane.list_rooms(cursor, limit=2, with_members=False)
+    # 없어진 방은 목록에 없다.
+    assert rooms == [(room_ids[2], 'room2', 1, ()), (room_ids[4], 'room4', 1, ())]
+    assert cursor == 0
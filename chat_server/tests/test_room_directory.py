@@ -0,0 +1,64 @@
+import pytest
+
+from backplane import RoomDirectory
+
+
+@pytest.fixture
+def directory():
+    directory = RoomDirectory()
+    for i in range(1, 8):
+        directory.create_room(0, f'room{i}', conn_id=i, name=f'user{i}')
+    return directory
+
+
+def all_pages(directory, limit, with_members=True):
+    rooms = []
+    cursor = 0
+    while True:
+        page, cursor = directory.list_rooms(0, cursor, limit, with_members)
+        assert len(page) <= limit
+        rooms.extend(page)
+        if not cursor:
+            return rooms
+
+
+def test_pages_cover_every_room_once(directory):
+    rooms = all_pages(directory, 3)
+    assert [room_id for room_id, *_ in rooms] == list(range(1, 8))
+    assert directory.list_rooms(0)[1] == 0
+    # 마지막 페이지가 딱 맞게 끝나도 다음 cursor 는 0 이다.
+    assert directory.list_rooms(0, 4, 3)[1] == 0
+
+
+def test_cursor_survives_removed_rooms(directory):
+    page, cursor = directory.list_rooms(0, 0, 3)
+    assert cursor == 3
+    # cursor 가 가리키는 방과 그다음 방이 없어져도 그 뒤부터 이어서 본다.
+    directory.leave_room(0, 3, 3, 'gone')
+    directory.leave_room(0, 4, 4, 'gone')
+    page, cursor = directory.list_rooms(0, cursor, 3)
+    assert [room_id for room_id, *_ in page] == [5, 6, 7]
+    assert cursor == 0
+
+
+def test_member_names_follow_changes(directory):
+    directory.join_room(1, 2, 100, 'remote')
+    assert directory.list_rooms(0, 1, 1)[0] == [(2, 'room2', 2, ('user2', 'remote'))]
+
+    directory.rename_member(1, 2, 100, 'renamed')
+    assert directory.list_rooms(0, 1, 1)[0] == [(2, 'room2', 2, ('user2', 'renamed'))]
+
+    directory.leave_room(0, 2, 2, 'left')
+    assert directory.list_rooms(0, 1, 1)[0] == [(2, 'room2', 1, ('renamed',))]
+    assert directory.nodes_of(2) == {1: 1}
+
+
+def test_summary_omits_names(directory):
+    assert all_pages(directory, 10, with_members=False)[0] == (1, 'room1', 1, ())
+
+
+def test_restore_rooms_keeps_order_and_ids():
+    directory = RoomDirectory()
+    directory.restore_rooms({5: 'five', 2: 'two'}, last_room_id=9)
+    assert [room[:3] for room in directory.list_rooms(0)[0]] == [(2, 'two', 0), (5, 'five', 0)]
+    assert directory.create_room(0, 'new', 1, 'u') == 10
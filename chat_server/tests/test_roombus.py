@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import roombus
+from backplane import BackplaneError
+
+
+@pytest.fixture
+def hub(tmp_path):
+    hub = roombus.RoomBusHub(str(tmp_path / 'bus.sock'), b'key')
+    yield hub
+    hub.listener.close()
+
+
+def connect_later(hub, node_id, delay):
+    '''delay 초 뒤에 node_id 로 hub 에 연결하는 쓰레드. 연결은 끊지 않는다.'''
+    clients = []
+
+    def run():
+        time.sleep(delay)
+        clients.append(roombus.RoomBusClient(hub.listener.address, b'key', node_id))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return clients
+
+
+def test_accepts_every_node(hub):
+    connect_later(hub, 0, 0)
+    connect_later(hub, 1, 0.2)
+    hub.accept_nodes(2, timeout=5)
+    assert sorted(hub.nodes) == [0, 1]
+
+
+def test_dead_process_aborts_accept(hub):
+    process = multiprocessing.get_context('fork').Process(target=os._exit, args=(3,))
+    process.start()
+    started = time.monotonic()
+    with pytest.raises(BackplaneError, match='exit code: 3'):
+        hub.accept_nodes(1, [process], timeout=30)
+    assert time.monotonic() - started < 5
+
+
+def test_timeout_aborts_accept(hub):
+    connect_later(hub, 0, 0)
+    with pytest.raises(BackplaneError, match='1개'):
+        hub.accept_nodes(2, timeout=0.3)
+    assert list(hub.nodes) == [0]
+
+
+def test_hub_dying_mid_call_fails_pending_calls(hub):
+    clients = connect_later(hub, 0, 0)
+    hub.accept_nodes(1, timeout=5)
+    while not clients:
+        time.sleep(0.01)
+    client = clients[0]
+    shutdowns = []
+    client.start(on_deliver=None, on_shutdown=lambda: shutdowns.append(True))
+
+    def kill_hub():
+        # 요청을 받은 뒤 응답하지 않고 hub 가 죽는다.
+        conn = hub.nodes[0]
+        assert conn.recv()[2] == 'list_rooms'
+        conn.close()
+
+    killer = threading.Thread(target=kill_hub)
+    killer.start()
+    with pytest.raises(BackplaneError):
+        client.list_rooms()
+    killer.join()
+    client.reader.join(5)
+    assert shutdowns == [True]
+
+    # 끊어진 뒤의 요청은 기다리지 않고 바로 실패한다.
+    with pytest.raises(BackplaneError):
+        client.create_room('room', 1, 'a')
+    with pytest.raises(BackplaneError):
+        client.leave_room(1, 1, 'left')
+    client.close()
+    assert shutdowns == [True]
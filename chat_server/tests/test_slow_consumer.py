@@ -0,0 +1,82 @@
+from absl.testing import flagsaver
+
+import server
+from server import PendingKind
+
+from .helpers import FakeSocket
+
+
+def make_connection(policy, high, low, sock=None):
+    with flagsaver.flagsaver(slow_consumer_policy=policy, send_high_watermark=high, send_low_watermark=low):
+        return server.UserConnection(sock or FakeSocket(), ('test', 0))
+
+
+def pending(connection):
+    return b''.join(bytes(buffer) for buffer in connection.pending_data)
+
+
+def test_drop_oldest_keeps_responses_and_front():
+    connection = make_connection('drop_oldest', 100, 50)
+    connection.send_encoded(b'A' * 10)
+    connection.send_encoded(b'B' * 40, kind=PendingKind.BROADCAST)
+    connection.send_encoded(b'R' * 10)
+    connection.send_encoded(b'C' * 60, kind=PendingKind.BROADCAST)
+
+    # B 부터 버려서 50 바이트 아래로 줄인다. 응답(R)은 버리지 않는다.
+    assert pending(connection) == b'A' * 10 + b'R' * 10
+    assert connection.pending_bytes == 20
+    assert not connection.closing
+
+
+def test_coalesce_replaces_dropped_messages_with_one_notice():
+    connection = make_connection('coalesce', 100, 20)
+    connection.send_encoded(b'A' * 10)
+    for i in range(4):
+        connection.send_encoded(bytes([ord('a') + i]) * 40, kind=PendingKind.BROADCAST)
+
+    assert list(connection.pending_kinds)[-1] == PendingKind.SKIPPED_NOTICE
+    assert list(connection.pending_kinds).count(PendingKind.SKIPPED_NOTICE) == 1
+    assert connection.skipped_notice_count == 3
+    assert connection.pending_bytes == sum(len(buffer) for buffer in connection.pending_data)
+
+
+def test_disconnect_policy_closes_connection():
+    connection = make_connection('disconnect', 100, 50)
+    connection.send_encoded(b'A' * 60, kind=PendingKind.BROADCAST)
+    connection.send_encoded(b'B' * 60, kind=PendingKind.BROADCAST)
+    assert connection.closing
+
+
+def test_partial_send_trims_front():
+    sock = FakeSocket(num_sent=15)
+    connection = make_connection('drop_oldest', 0, 0, sock)
+    connection.send_encoded(b'A' * 10)
+    connection.send_encoded(b'B' * 10)
+    connection.send_pending_data()
+
+    assert sock.sent == b'A' * 10 + b'B' * 5
+    assert pending(connection) == b'B' * 5
+    assert connection.pending_bytes == 5
+
+
+def test_overflow_during_partial_send_keeps_in_flight_buffers():
+    '''
+    sendmsg() 하는 동안 작업 쓰레드가 한도를 넘겨서 방 메시지를 버려도, 전송 중인 버퍼들은 버리지 않아야
+    보낸 만큼 잘라낸 결과와 byte stream 이 맞는다.
+    '''
+    sock = FakeSocket(num_sent=60)
+    connection = make_connection('drop_oldest', 100, 50, sock)
+    connection.send_encoded(b'A' * 10)
+    connection.send_encoded(b'B' * 30, kind=PendingKind.BROADCAST)
+    connection.send_encoded(b'C' * 30, kind=PendingKind.BROADCAST)
+    sock.during_send = lambda: connection.send_encoded(b'D' * 40, kind=PendingKind.BROADCAST)
+
+    connection.send_pending_data()
+
+    assert sock.sent == b'A' * 10 + b'B' * 30 + b'C' * 20
+    # 전송 중이던 A, B, C 는 남기고 그 뒤의 D 를 버렸다.
+    assert pending(connection) == b'C' * 10
+    assert connection.pending_bytes == 10
+    assert len(connection.pending_kinds) == len(connection.pending_data)
+    assert not connection.closing
+    assert connection.in_flight == 0
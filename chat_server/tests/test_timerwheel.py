@@ -0,0 +1,53 @@
+from timerwheel import TimerWheel
+
+
+def test_items_expire_after_their_delay():
+    wheel = TimerWheel(1.0, 30, now=100.0)
+    wheel.schedule('a', 2.5, now=100.0)
+    wheel.schedule('b', 10, now=100.0)
+    assert len(wheel) == 2
+
+    assert wheel.advance(102.0) == []
+    assert wheel.advance(103.0) == ['a']
+    assert wheel.advance(109.5) == []
+    assert wheel.advance(110.0) == ['b']
+    assert len(wheel) == 0
+
+
+def test_schedule_moves_and_cancel_removes():
+    wheel = TimerWheel(1.0, 30, now=0.0)
+    wheel.schedule('a', 1, now=0.0)
+    wheel.schedule('a', 5, now=0.0)
+    wheel.schedule('b', 1, now=0.0)
+    wheel.cancel('b')
+    wheel.cancel('missing')
+
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(5.0) == ['a']
+
+
+def test_delay_is_clamped_to_max_delay():
+    wheel = TimerWheel(1.0, 10, now=0.0)
+    wheel.schedule('a', 1000, now=0.0)
+    assert wheel.advance(10.0) == ['a']
+
+
+def test_long_pause_expires_everything_once():
+    wheel = TimerWheel(1.0, 10, now=0.0)
+    for i in range(10):
+        wheel.schedule(i, i, now=0.0)
+    assert sorted(wheel.advance(1000.0)) == list(range(10))
+    assert wheel.advance(2000.0) == []
+
+
+def test_next_timeout():
+    wheel = TimerWheel(1.0, 10, now=0.0)
+    assert wheel.next_timeout(0.0) is None
+    wheel.schedule('a', 3, now=0.0)
+    # 다음 tick 까지만 기다린다. 항목이 있는 칸은 그 tick 에 확인한다.
+    assert wheel.next_timeout(0.25) == 0.0
+    wheel.advance(0.5)
+    assert wheel.next_timeout(0.5) == 0.5
+    # 비어 있어도 len() 이 0 일 뿐 wheel 자체는 쓸 수 있다.
+    wheel.cancel('a')
+    assert len(wheel) == 0 and wheel.next_timeout(0.5) is None
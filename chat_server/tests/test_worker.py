@@ -0,0 +1,31 @@
+import threading
+
+import server
+
+from .helpers import FakeSocket
+
+
+def test_worker_survives_unexpected_exception(monkeypatch):
+    '''처리 중 예상하지 못한 예외가 나도 그 연결만 끊고, 같은 큐의 다른 연결은 계속 처리한다.'''
+    mailbox = server.WorkQueue(100)
+    worker = threading.Thread(target=server.message_worker, args=[0, mailbox])
+    worker.start()
+    try:
+        bad = server.UserConnection(FakeSocket(), ('bad', 0))
+        good = server.UserConnection(FakeSocket(), ('good', 0))
+        handled = threading.Event()
+
+        def explode(messages):
+            raise TypeError('unhashable')
+        monkeypatch.setattr(bad, 'handle_messages', explode)
+        monkeypatch.setattr(good, 'handle_messages', lambda messages: handled.set())
+
+        mailbox.put((bad, [b'x']))
+        mailbox.put((good, [b'y']))
+        assert handled.wait(5)
+        assert bad.closing
+        assert not good.closing
+        assert worker.is_alive()
+    finally:
+        mailbox.close()
+        worker.join(5)
@@ -0,0 +1,62 @@
+'''
+연결별 timeout 을 위한 hashed timing wheel.
+
+시간을 tick 단위 칸(slot)으로 나누고, 항목은 만료될 tick 의 칸에 넣는다. 칸의 수를 가장 긴
+지연보다 크게 잡으므로 한 칸에는 그 tick 에 만료되는 항목만 들어 있다. 그래서 advance() 는
+모든 항목을 훑지 않고 지나간 칸들에 든 만료된 항목만 꺼낸다.
+
+연결마다 메시지를 받을 때마다 timer 를 옮기면 비싸므로, 사용하는 쪽은 마지막으로 받은 시각만
+기록해 두고 만료됐을 때 남은 시간만큼 다시 schedule() 하는 방식(lazy rescheduling)으로 쓴다.
+'''
+import math
+
+
+class TimerWheel:
+    def __init__(self, tick: float, max_delay: float, now: float):
+        self.tick = tick
+        self.slots: list[set] = [set() for _ in range(math.ceil(max_delay / tick) + 2)]
+        self.max_delay = max_delay
+        # 항목 -> 들어 있는 칸의 번호
+        self.slot_of: dict[object, int] = {}
+        # 다음에 처리할 tick 번호
+        self.current_tick = math.floor(now / tick)
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def schedule(self, item, delay: float, now: float):
+        '''item 을 now + delay 에 만료되게 넣는다. 이미 들어 있다면 옮긴다.'''
+        self.cancel(item)
+        delay = min(max(delay, 0), self.max_delay)
+        # 만료 시각이 지난 뒤에 꺼내도록 올림하고, 아직 처리하지 않은 tick 보다 앞에 넣지 않는다.
+        expire_tick = max(math.ceil((now + delay) / self.tick), self.current_tick)
+        slot = expire_tick % len(self.slots)
+        self.slots[slot].add(item)
+        self.slot_of[item] = slot
+
+    def cancel(self, item):
+        slot = self.slot_of.pop(item, None)
+        if slot is not None:
+            self.slots[slot].discard(item)
+
+    def advance(self, now: float) -> list:
+        '''now 까지 지난 tick 들의 칸을 비우고 만료된 항목들을 돌려준다.'''
+        expired = []
+        last_tick = math.floor(now / self.tick)
+        # 오래 멈춰 있었더라도 칸을 한 바퀴 넘게 돌 필요는 없다.
+        first_tick = max(self.current_tick, last_tick - len(self.slots) + 1)
+        for tick in range(first_tick, last_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                for item in slot:
+                    del self.slot_of[item]
+                expired.extend(slot)
+                slot.clear()
+        self.current_tick = max(self.current_tick, last_tick + 1)
+        return expired
+
+    def next_timeout(self, now: float) -> float | None:
+        '''다음 tick 까지 남은 시간. 들어 있는 항목이 없으면 None'''
+        if not self.slot_of:
+            return None
+        return max(0, self.current_tick * self.tick - now)